@@ -8,15 +8,45 @@ import os
 import sys 
 sys.path.append(os.path.basename(""))
 
+# installed first, so startup can report what every import below costs
+from utils.ImportTimer import import_timer
+import_timer.install()
+
+import asyncio
+import logging
+import shutil
+from dataclasses import dataclass
+
 from utils.logger import get_logger
-from basic_pitch import ICASSP_2022_MODEL_PATH
-from basic_pitch.inference import predict_and_save
-from pydub import AudioSegment
 from utils.aws_utils import S3Helper, initialize_s3, get_bucket_name
+from utils.InputCache import S3InputCache, get_input_cache
 from utils.response_utils import success, error
-import runpod
+from utils.PipelinedExecutor import PipelinedExecutor
+from utils.ConcurrencyController import ConcurrencyController
+from utils.Timings import job_timings, attach_timings, span
+from utils.Profiling import JobProfile, job_profile, profile_requested
 import time 
 
+concurrency_controller = ConcurrencyController("AudioToMidi")
+
+def adjust_concurrency(current_concurrency):
+    return concurrency_controller.adjust(current_concurrency)
+
+
+@dataclass
+class MidiJob:
+    """State of one conversion between the pipeline stages"""
+
+    task_id : str
+    input_file : str
+    output_dir : str
+    sonify_midi : bool
+    save_notes : bool
+
+    @property
+    def input_filename(self) -> str:
+        return self.input_file.split("/")[-1].split(".")[0]
+
 class AudioToMidiConverter:
     AUDIO_FORMAT = "wav"
     TEMP_DIR = "/tmp"
@@ -26,12 +56,19 @@ class AudioToMidiConverter:
         os.makedirs(self.output_dir, exist_ok=True)
         self.s3_helper : S3Helper = initialize_s3()
         self.s3_bucket_name = get_bucket_name()
+        self.input_cache : S3InputCache = get_input_cache(self.s3_helper.transfer)
         self.logger = get_logger("AudioToMidiConverter")
+        # basic pitch keeps one model in the process, conversions take turns on it
+        # while the next input downloads and the previous outputs upload
+        self.job_executor = PipelinedExecutor(
+            "AudioToMidi", self._ingest_job, self._infer_job, self._deliver_job, inference_workers=1,
+            cleanup=self._cleanup_job
+        )
 
     def _download_file_from_s3(self, s3_path: str, task_id: str) -> str:
         """
         Checks in the s3 volume mount if file exists, if not
-        Downloads a file from S3 and converts it to WAV format if necessary.
+        reads it through the local input cache and converts it to WAV format if necessary.
 
         :param s3_path: Path to the S3 file.
         :param task_id: Unique identifier for the project.
@@ -46,13 +83,22 @@ class AudioToMidiConverter:
                     raise FileNotFoundError(f"File not found in S3: {s3_path}")
                 
                 file_ext = os.path.splitext(s3_path)[-1]
-                local_path = os.path.join(self.TEMP_DIR, f"{task_id}_input{file_ext}")
-                self.s3_helper.download_file(s3_path, local_path, self.s3_bucket_name)
+                local_path = os.path.join(self.TEMP_DIR, f"{task_id}_input{file_ext.lower()}")
+                if self.input_cache is not None:
+                    # a link to the cache entry, it stays readable if the entry is evicted
+                    self.input_cache.fetch(self.s3_bucket_name, s3_path, local_path)
+                else:
+                    self.s3_helper.download_file(s3_path, local_path, self.s3_bucket_name)
                 
                 if file_ext.lower() != f".{self.AUDIO_FORMAT}":
                     wav_path = os.path.join(self.TEMP_DIR, f"{task_id}_input.{self.AUDIO_FORMAT}")
-                    audio = AudioSegment.from_file(local_path)
-                    audio.export(wav_path, format=self.AUDIO_FORMAT)
+                    try:
+                        with span("convert"):
+                            from pydub import AudioSegment
+                            audio = AudioSegment.from_file(local_path)
+                            audio.export(wav_path, format=self.AUDIO_FORMAT)
+                    finally:
+                        os.remove(local_path)
                     return wav_path
                 
                 return local_path
@@ -60,23 +106,23 @@ class AudioToMidiConverter:
             self.logger.exception("Failed to download and process file from S3.")
             raise
 
-    def _get_midi_file_path(self, input_filename):
+    def _get_midi_file_path(self, input_filename, output_dir = None):
         """
         Generates the local output file path based on the project ID and conversion type.
         """
-        return os.path.join(self.output_dir, f"{input_filename}_basic_pitch.mid")
+        return os.path.join(output_dir or self.output_dir, f"{input_filename}_basic_pitch.mid")
 
-    def _get_sonify_file_path(self, input_filename):
+    def _get_sonify_file_path(self, input_filename, output_dir = None):
         """
         Generates the local output file path based on the project ID and conversion type.
         """
-        return os.path.join(self.output_dir, f"{input_filename}_basic_pitch.wav")
+        return os.path.join(output_dir or self.output_dir, f"{input_filename}_basic_pitch.wav")
     
-    def _get_notes_file_path(self, input_filename):
+    def _get_notes_file_path(self, input_filename, output_dir = None):
         """
         Generates the local output file path based on the project ID and conversion type.
         """
-        return os.path.join(self.output_dir, f"{input_filename}_basic_pitch.csv")
+        return os.path.join(output_dir or self.output_dir, f"{input_filename}_basic_pitch.csv")
     
     def _get_s3_folder_midi_output(self):
         """
@@ -102,13 +148,13 @@ class AudioToMidiConverter:
         """
         return f"{self._get_s3_folder_midi_output()}/{task_id}.csv"
 
-    def _upload_files_and_create_out_obj(self, task_id, input_filename, sonify_midi, save_notes):
+    def _upload_files_and_create_out_obj(self, task_id, input_filename, sonify_midi, save_notes, output_dir = None):
         """
         Uploads files and creates out object for audio to midi
         """
         try:
             out_obj = {}
-            midi_file_path = self._get_midi_file_path(input_filename)
+            midi_file_path = self._get_midi_file_path(input_filename, output_dir)
             if not os.path.exists(midi_file_path):
                 raise FileNotFoundError(f"MIDI file not found: {midi_file_path}")
             
@@ -119,7 +165,7 @@ class AudioToMidiConverter:
             out_obj['success'] = True
 
             if sonify_midi:
-                sonify_file_path = self._get_sonify_file_path(input_filename)
+                sonify_file_path = self._get_sonify_file_path(input_filename, output_dir)
                 if not os.path.exists(sonify_file_path):
                     raise FileNotFoundError(f"Sonify file not found: {sonify_file_path}")
 
@@ -128,7 +174,7 @@ class AudioToMidiConverter:
                 out_obj['sonify_file_path'] = sonify_s3_key
 
             if save_notes:
-                notes_file_path = self._get_notes_file_path(input_filename)
+                notes_file_path = self._get_notes_file_path(input_filename, output_dir)
                 if not os.path.exists(notes_file_path):
                     raise FileNotFoundError(f"Notes file not found: {notes_file_path}")
 
@@ -143,42 +189,95 @@ class AudioToMidiConverter:
             return {'success' : False, 'error' : f'Error during audio to midi conversion: {str(e)}'}
         
 
-    def run(self, task_id, input_audio, sonify_midi, save_notes):
-        try:
+    def _task_output_dir(self, task_id):
+        # conversions of the same cached input must not overwrite each other's outputs
+        return os.path.join(self.output_dir, task_id)
 
-            input_file = self._download_file_from_s3(input_audio, task_id)
-            input_filename = input_file.split("/")[-1].split(".")[0]
+    def _ingest_job(self, task_id, input_audio, sonify_midi, save_notes) -> MidiJob:
+        input_file = self._download_file_from_s3(input_audio, task_id)
+        output_dir = self._task_output_dir(task_id)
+        os.makedirs(output_dir, exist_ok=True)
+        return MidiJob(task_id, input_file, output_dir, sonify_midi, save_notes)
 
-            # run basic pitch prediction
+    def _infer_job(self, job : MidiJob):
+        # basic pitch brings in tensorflow, the first conversion imports it instead of the worker start
+        from basic_pitch import ICASSP_2022_MODEL_PATH
+        from basic_pitch.inference import predict_and_save
+        # run basic pitch prediction
+        with span("inference/basic_pitch"):
             predict_and_save(
-                [input_file], 
-                self.output_dir, 
+                [job.input_file], 
+                job.output_dir, 
                 True, 
-                sonify_midi, 
+                job.sonify_midi, 
                 False, 
-                save_notes, 
+                job.save_notes, 
                 ICASSP_2022_MODEL_PATH
             )
 
-            return self._upload_files_and_create_out_obj(task_id, input_filename, sonify_midi, save_notes)
-        except Exception as e:
-            self.logger.exception("Failed to run audio to midi conversion.")
-            return {'success' : False, 'error' : f'Error during audio to midi conversion: {str(e)}'}
+    def _deliver_job(self, job : MidiJob) -> dict:
+        return self._upload_files_and_create_out_obj(job.task_id, job.input_filename, job.sonify_midi, job.save_notes, job.output_dir)
+
+    def _cleanup_job(self, task_id, *args):
+        shutil.rmtree(self._task_output_dir(task_id), ignore_errors=True)
+        converted_path = os.path.join(self.TEMP_DIR, f"{task_id}_input.{self.AUDIO_FORMAT}")
+        if os.path.isfile(converted_path):
+            os.remove(converted_path)
+
+    def _upload_profile(self, profile : JobProfile, task_id) -> dict:
+        # the artifacts sit next to the job's outputs
+        return profile.upload(self.s3_helper, self.s3_bucket_name, f"{self._get_s3_folder_midi_output()}/{task_id}")
+
+    def run(self, task_id, input_audio, sonify_midi, save_notes, profile = False):
+        with job_timings(task_id) as timings, job_profile(task_id, profile) as job_profiler:
+            out_obj = {'success' : False}
+            try:
+                out_obj = self.job_executor.submit(task_id, input_audio, sonify_midi, save_notes).result()
+            except Exception as e:
+                self.logger.exception("Failed to run audio to midi conversion.")
+                out_obj = {'success' : False, 'error' : f'Error during audio to midi conversion: {str(e)}'}
+            if job_profiler is not None:
+                out_obj['profile'] = self._upload_profile(job_profiler, task_id)
+            timings.log(self.logger, success=out_obj.get('success', False))
+            return attach_timings(out_obj)
+
+    async def run_async(self, task_id, input_audio, sonify_midi, save_notes, profile = False):
+        """
+        Same as run without blocking the event loop, so concurrent conversions
+        overlap their download and upload with each other's prediction.
+        """
+        start = time.monotonic()
+        with job_timings(task_id) as timings, job_profile(task_id, profile) as job_profiler:
+            out_obj = {'success' : False}
+            try:
+                out_obj = await asyncio.wrap_future(self.job_executor.submit(task_id, input_audio, sonify_midi, save_notes))
+            except Exception as e:
+                self.logger.exception("Failed to run audio to midi conversion.")
+                out_obj = {'success' : False, 'error' : f'Error during audio to midi conversion: {str(e)}'}
+            concurrency_controller.record_job(time.monotonic() - start, out_obj.get('success', False))
+            if job_profiler is not None:
+                out_obj['profile'] = await asyncio.to_thread(self._upload_profile, job_profiler, task_id)
+            timings.log(self.logger, success=out_obj.get('success', False))
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("Job stages : %s", self.job_executor.metrics())
+            return attach_timings(out_obj)
 
 class AudioToMidiRunpod():
     def __init__(self):
         self.audioToMidi = AudioToMidiConverter()
         self.logger = get_logger("AudioToMidiRunpod")
     
-    def handler(self, event):
+    async def handler(self, event):
+        task_id = None
         try:
             arguments = event['input']['arguments']
             task_id = arguments['task_id']
             audio_path = arguments['audio_path']
             sonify_midi = arguments.get('sonify_midi', False)
             save_notes = arguments.get('save_notes', False)
+            profile = profile_requested(arguments.get('profile', False))
 
-            out_obj = self.audioToMidi.run(task_id, audio_path, sonify_midi, save_notes)
+            out_obj = await self.audioToMidi.run_async(task_id, audio_path, sonify_midi, save_notes, profile)
             out_obj['task_id'] = task_id
             return success(out_obj)
         except Exception as e:
@@ -187,8 +286,13 @@ class AudioToMidiRunpod():
             return error(out_obj)
 
 def main():
+    import runpod
     pipeline = AudioToMidiRunpod()
-    runpod.serverless.start({"handler": pipeline.handler})
+    import_timer.log_report("AudioToMidiConverter")
+    runpod.serverless.start({
+        "handler": pipeline.handler,
+        "concurrency_modifier" : adjust_concurrency
+    })
 
 if __name__ == "__main__":
     main()
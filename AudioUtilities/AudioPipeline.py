@@ -2,16 +2,28 @@ import os
 import sys
 sys.path.append(os.path.basename(""))
 
-from typing import List
+import logging
+from dataclasses import dataclass, field
+from typing import List, Optional
 from beam import function, Volume, Image, task_queue, QueueDepthAutoscaler
-from pydub import AudioSegment
 
 # Local module imports
 from utils.s3Utils import S3Helper
 from utils.response_utils import success, error
 from utils.logger import get_logger
-from utils.AudioSeparator import AudioSeparator
-from utils.Elevenlabs import SoundEffectCreator
+from utils.AudioSeparator import AudioSeparator, resolve_quality
+from utils.ResultCache import StemResultCache
+from utils.SilenceDetection import SilenceSkipper, SilenceMap, resolve_skip_silence
+from utils.ResidualStem import resolve_instrumental_strategy
+from utils.StagePipeline import StagePipeline
+from utils.AudioProbe import get_duration
+from utils.OutputStage import OutputStage
+from utils.OutputFormats import OutputFormat, parse_output_formats, format_signature
+from utils.StreamingIngest import IngestedAudio, ingest_s3_audio, ingested_path
+from utils.InputCache import get_input_cache
+from utils.PipelinedExecutor import PipelinedExecutor, inference_slots
+from utils.Timings import job_timings, attach_timings
+from utils.Profiling import job_profile
 
 from AudioUtilities.Context import AudioProcessingContext
 from AudioUtilities.Config import AudioPipelineConfig
@@ -26,6 +38,23 @@ VALID_MODES = [
 
 VALID_AUDIO_FORMATS = ["wav", "flac", "mp3", "aac", "ogg", "m4a", "wma", "aiff", "alac", "webm"]
 
+# formats uploaded per stem when the request does not list output_formats, the first is the primary output
+DEFAULT_OUTPUT_FORMATS = ["mp3", "wav"]
+
+
+
+@dataclass
+class PipelineJob:
+    """A request moving through the pipeline stages"""
+
+    task_id: str
+    context: Optional[AudioProcessingContext] = None
+    wav_path: str = ""
+    model_input_path: str = ""
+    silence_map: Optional[SilenceMap] = None
+    output_files: List[str] = field(default_factory=list)
+    # set when the request is served without inference
+    response: Optional[dict] = None
 
 
 class AudioPipeline:
@@ -40,6 +69,14 @@ class AudioPipeline:
             config.aws_region
         )
         self.separator = self._initialize_audio_separator()
+        self.result_cache = StemResultCache(self.s3_helper, config.aws_bucket)
+        self.output_stage = OutputStage(self.s3_helper, config.aws_bucket)
+        self.input_cache = get_input_cache(self.s3_helper.transfer)
+        # concurrent requests overlap their download and upload with each other's inference
+        self.job_executor = PipelinedExecutor(
+            "AudioPipeline", self._ingest_job, self._infer_job, self._deliver_job, inference_workers=inference_slots(),
+            skip_inference=lambda job: job.response is not None, cleanup=self._cleanup_job
+        )
 
     def _initialize_audio_separator(self) -> AudioSeparator:
         """Initialize audio separator with proper configuration"""
@@ -47,56 +84,59 @@ class AudioPipeline:
         return AudioSeparator(
             output_dir=self.config.output_dir,
             model_file_dir=self.config.model_dir,
-            output_format=self.config.output_format
+            output_format=self.config.output_format,
+            onnx_session_config=self.config.onnx_session_config()
         )
 
     def _get_conversion_duration(self, file_path : str) -> float:
         """ Get the length of passed audio"""
         try:
-            audio = AudioSegment.from_file(file_path)
-            duration = audio.duration_seconds
-            return duration 
+            return get_duration(file_path)
         except Exception as e:
             self.logger.exception("Error fetching audio duration")
             return None
 
-    def _download_input(self, s3_path: str, task_id: str) -> str:
-        """Download input file from S3"""
-        file_ext = os.path.splitext(s3_path)[1][1:]
-        local_path = os.path.join("/tmp", f"{task_id}.{file_ext}")
-        self.s3_helper.download_file(
-            self.config.aws_bucket, s3_path, local_path
-        )
-        return local_path
+    def _ingest_input(self, s3_path: str, task_id: str) -> IngestedAudio:
+        """Stream the input from S3 through the decoder, returns the decoded wav and the digest of its samples"""
+        return ingest_s3_audio(self.s3_helper.transfer, self.config.aws_bucket, s3_path, ingested_path(task_id), self.input_cache)
 
-    def _convert_to_wav(self, file_path: str) -> str:
-        """Convert any audio file to WAV format"""
-        audio = AudioSegment.from_file(file_path)
-        wav_path = os.path.splitext(file_path)[0] + ".wav"
-        audio.export(wav_path, format="wav")
-        return wav_path
+    def _get_model_names(self, config: Optional[AudioPipelineConfig] = None) -> dict:
+        """Models the request runs with, part of the result cache key"""
+        return (config or self.config).model_names()
 
-    def _convert_to_mp3(self, file_path: str, output_path: str):
-        """Convert audio file to MP3 format"""
-        try:
-            audio = AudioSegment.from_file(file_path)
-            audio.export(output_path, format="mp3")
-            return output_path
-        except Exception as e:
-            self.logger.exception(f"Error converting to mp3: {str(e)}")
-            return file_path
+    def _get_cache_key(self, audio_digest: Optional[str], mode: str, quality: Optional[str] = None, instrumental_strategy: str = "model",
+                       output_formats: Optional[List[OutputFormat]] = None, config: Optional[AudioPipelineConfig] = None,
+                       skip_silence: bool = False) -> Optional[str]:
+        """Result cache key, None for jobs without an input audio"""
+        if not audio_digest:
+            return None
+        # keys of the default options stay the same as before the options existed
+        extra = {"instrumental_strategy": instrumental_strategy} if instrumental_strategy != "model" else {}
+        if output_formats and format_signature(output_formats) != DEFAULT_OUTPUT_FORMATS:
+            extra["output_formats"] = format_signature(output_formats)
+        # keyed on the effective flag, deployments with other defaults share the cache
+        if skip_silence:
+            extra["skip_silence"] = True
+        return StemResultCache.make_key(
+            audio_digest, self._get_model_names(config), self.separator.param_signature(quality), mode, **extra
+        )
 
-    def _create_context(self, task_id: str, input_path: str, mode: str, input_prompt: str, audio_length: int) -> AudioProcessingContext:
+    def _create_context(self, task_id: str, input_path: str, mode: str, input_prompt: str, audio_length: int, cache_key: Optional[str] = None, quality: Optional[str] = None, instrumental_strategy: str = "model",
+                        output_formats: Optional[List[OutputFormat]] = None, config: Optional[AudioPipelineConfig] = None) -> AudioProcessingContext:
         """Create processing context"""
         return AudioProcessingContext(
             task_id=task_id,
             input_path=input_path,
             mode=mode,
-            config=self.config,
+            config=config or self.config,
             separator=self.separator,
             s3_helper=self.s3_helper, 
             input_prompt=input_prompt, 
-            audio_length=audio_length
+            audio_length=audio_length,
+            cache_key=cache_key,
+            quality=quality,
+            instrumental_strategy=instrumental_strategy,
+            output_formats=output_formats
         )
     
     def _delete_file_if_exists(self, file_path : str):
@@ -118,68 +158,121 @@ class AudioPipeline:
         """
         return os.path.join(context.config.output_dir, file_path)
     
-    def _get_mp3_file_path(self, file_path : str) -> str:
-        """
-        Get the file path mp3
-        """
-        return os.path.splitext(file_path)[0] + ".mp3"
 
+    def _ingest_job(self, task_id: str, mode: str, s3_input_path: str, input_prompt: str, audio_length:int = None, quality: str = None, skip_silence: Optional[bool] = None, instrumental_strategy: Optional[str] = None, output_formats: Optional[list] = None, model_args: Optional[dict] = None) -> PipelineJob:
+        """Ingest stage: validates the request, decodes the input and serves cache hits"""
+        # Input validation
+        if mode not in VALID_MODES:
+            raise ValueError(f"Invalid processing mode: {mode}")
+        quality = resolve_quality(quality)
+        instrumental_strategy = resolve_instrumental_strategy(instrumental_strategy)
+        output_formats = parse_output_formats(output_formats, DEFAULT_OUTPUT_FORMATS)
+        config = self.config.with_models(model_args)
+        skip_silence = resolve_skip_silence(skip_silence)
 
-    def execute_pipeline(self, task_id: str, mode: str, s3_input_path: str, input_prompt: str, audio_length:int = None) -> dict:
-        """Main pipeline execution flow"""
-        try:
-            # Input validation
-            if mode not in VALID_MODES:
-                raise ValueError(f"Invalid processing mode: {mode}")
+        wav_path, audio_digest = "", None
+        if s3_input_path:
+            # Decode the input while it downloads if s3 input path is given
+            ingested = self._ingest_input(s3_input_path, task_id)
+            wav_path, audio_digest = ingested.path, ingested.digest
 
-            wav_path, local_path = "", ""
-            if s3_input_path:
-                # Download and prepare input if s3 input path is given
-                local_path = self._download_input(s3_input_path, task_id)
-                wav_path = self._convert_to_wav(local_path)
+        # Serve repeated uploads from the stem cache
+        cache_key = self._get_cache_key(audio_digest, mode, quality, instrumental_strategy, output_formats, config, skip_silence)
+        cached_response = self.result_cache.lookup(cache_key, task_id)
+        if cached_response is not None:
+            return PipelineJob(task_id, wav_path=wav_path, response={**cached_response, "task_id": task_id, "success": True})
 
-            # Create processing context
-            context = self._create_context(task_id, wav_path, mode, input_prompt, audio_length)
+        # Only the non silent regions of the input go through the models
+        silence_skipper = None
+        model_input_path = wav_path
+        if wav_path:
+            silence_skipper = SilenceSkipper(wav_path, enabled=skip_silence)
+            model_input_path = silence_skipper.compacted_input()
 
-            # Get processing strategy
-            processor_class = ProcessingStrategyRegistry.get_strategy(mode)
-            processor = processor_class()
+        # Create processing context
+        context = self._create_context(task_id, model_input_path, mode, input_prompt, audio_length, cache_key, quality, instrumental_strategy, output_formats, config)
+        if silence_skipper is not None:
+            context.skipped_fraction = silence_skipper.skipped_fraction
+        return PipelineJob(task_id, context=context, wav_path=wav_path, model_input_path=model_input_path,
+                           silence_map=silence_skipper.silence_map if silence_skipper is not None else None)
 
-            # Execute processing
-            output_files = processor.process(context)
+    def _infer_job(self, job: PipelineJob):
+        """Inference stage: runs the processing strategy of the job's mode"""
+        # Get processing strategy
+        processor_class = ProcessingStrategyRegistry.get_strategy(job.context.mode)
+        processor = processor_class()
 
-            # Handle output and upload
-            response = self._handle_outputs(output_files, context)
+        # Execute processing, intermediate stems stay in the stage scratch dir and
+        # the skipped silence is spliced back as each stem is delivered
+        try:
+            with StagePipeline(self.separator, job.task_id, self.config.output_dir, job.context.quality, silence_map=job.silence_map) as stages:
+                job.context.stages = stages
+                job.output_files = processor.process(job.context)
+        finally:
+            if job.model_input_path != job.wav_path:
+                self._delete_file_if_exists(job.model_input_path)
 
-            self._delete_file_if_exists(local_path)
+    def _deliver_job(self, job: PipelineJob) -> dict:
+        """Delivery stage: encodes and uploads the outputs"""
+        if job.response is not None:
+            return attach_timings(job.response)
+        return self._handle_outputs(job.output_files, job.context)
 
-            return response
+    def _cleanup_job(self, task_id: str, *args):
+        # the decoded input sits in RAM backed scratch, do not leave it behind
+        self._delete_file_if_exists(ingested_path(task_id))
 
-        except Exception as e:
-            self.logger.error(f"Pipeline execution failed: {str(e)}")
-            return {"task_id": task_id, "success" : False, "error": str(e)}
+    def execute_pipeline(self, task_id: str, mode: str, s3_input_path: str, input_prompt: str, audio_length:int = None, quality: str = None, skip_silence: Optional[bool] = None, instrumental_strategy: Optional[str] = None, output_formats: Optional[list] = None, model_args: Optional[dict] = None, profile: bool = False) -> dict:
+        """
+        Main pipeline execution flow, runs the job through the ingest, inference and delivery stages.
+        model_args overrides the configured models for this request only, with profile the job's
+        cpu profile and allocation summary are uploaded next to its outputs.
+        """
+        with job_timings(task_id) as timings, job_profile(task_id, profile) as job_profiler:
+            response = {"task_id": task_id, "success" : False}
+            try:
+                future = self.job_executor.submit(task_id, mode, s3_input_path, input_prompt, audio_length, quality, skip_silence, instrumental_strategy, output_formats, model_args)
+                response = future.result()
+                return response
+            except Exception as e:
+                self.logger.error(f"Pipeline execution failed: {str(e)}")
+                response = attach_timings({"task_id": task_id, "success" : False, "error": str(e)})
+                return response
+            finally:
+                if job_profiler is not None:
+                    response["profile"] = job_profiler.upload(self.s3_helper, self.config.aws_bucket, f"conversions/{task_id}")
+                timings.log(self.logger, mode=mode, success=response.get("success", False))
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug("Job stages : %s", self.job_executor.metrics())
 
     def _handle_outputs(self, output_files: List[str], context: AudioProcessingContext) -> dict:
         """Handle output files and upload to S3"""
-        self.logger.debug(f"Got output files : {output_files}")
+        self.logger.debug("Got output files : %s", output_files)
         results = {}
         conversion_duration = 0
+        output_formats = context.output_formats or parse_output_formats(None, DEFAULT_OUTPUT_FORMATS)
+        # only the requested formats are encoded and uploaded, all stems concurrently
+        batch = self.output_stage.batch()
+        local_files = []
         for file_path in output_files:
             key = self._determine_output_key(file_path, context)
-            s3_path_wav = f"conversions/{context.task_id}_{key}.wav"
-            s3_path_mp3 = f"conversions/{context.task_id}_{key}.mp3"
             file_path = self._get_full_file_path(file_path, context)
-            file_path_mp3 = self._get_mp3_file_path(file_path)
-            file_path_mp3 = self._convert_to_mp3(file_path, file_path_mp3)
+            local_files.append(file_path)
             if not conversion_duration:
                 conversion_duration = self._get_conversion_duration(file_path)
-            self.s3_helper.upload_file(file_path, s3_path_wav, self.config.aws_bucket)
-            self.s3_helper.upload_file(file_path_mp3, s3_path_mp3, self.config.aws_bucket)
+            s3_keys = batch.deliver(file_path, f"conversions/{context.task_id}_{key}", output_formats)
+            # the primary format keeps the bare stem key, the others get a format suffix
+            for index, (output_format, s3_key) in enumerate(s3_keys.items()):
+                results[key if index == 0 else f"{key}_{output_format}"] = s3_key
+        uploaded_files = batch.wait()
+        response = {"task_id" : context.task_id, "success" : True, "conversion_duration" : conversion_duration,
+                    "skipped_fraction" : context.skipped_fraction,
+                    "bytes_written" : dict(context.stages.bytes_written) if context.stages is not None else {},
+                    "output_sizes" : batch.bytes_by_format, **results}
+        self.result_cache.store(context.cache_key, context.task_id, response, uploaded_files)
+        for file_path in local_files:
             self._delete_file_if_exists(file_path)
-            self._delete_file_if_exists(file_path_mp3)
-            results[key] = s3_path_mp3
-            results[f"{key}_wav"] = s3_path_wav
-        return {"task_id" : context.task_id, "success" : True, "conversion_duration" : conversion_duration,  **results}
+        return attach_timings(response)
 
 
 
@@ -1,5 +1,11 @@
 import os 
+import sys
+sys.path.append(os.path.basename(''))
+
+import copy
+from typing import Optional
 from pydantic.dataclasses import dataclass
+from utils.OnnxSession import OnnxSessionConfig
 
 @dataclass
 class AudioConfig:
@@ -13,10 +19,27 @@ class AudioConfig:
     output_format: str = "wav"
 
 
+# request "models" argument -> config attribute holding that model
+MODEL_ARG_ATTRIBUTES = {
+    "vocal_extractor": "vocal_extractor_model",
+    "instrumental_extractor": "instrumental_extractor_model",
+    "lead_back_splitter": "lead_back_splitter",
+    "de_echo": "de_echo_model",
+    "de_reverb": "de_reverb_model",
+    "de_noise": "de_noise_model",
+    "deecho_dereverb_combined": "deecho_dereverb_model_combined",
+    "stem_extractor": "stem_extractor_model",
+}
+
 
 class AudioPipelineConfig(AudioConfig):
-    """Runtime configuration loader extending base AudioConfig"""
-    def __init__(self, model_args : dict):
+    """
+    Runtime configuration loader extending base AudioConfig. A loaded config is
+    shared by every request of the worker and can not be changed, per request
+    models are applied with with_models().
+    """
+    def __init__(self, model_args : Optional[dict] = None):
+        model_args = model_args or {}
         super().__init__(
             aws_access_key=os.getenv("AWS_ACCESS_KEY"),
             aws_secret_key=os.getenv("AWS_SECRET_KEY"),
@@ -68,6 +91,55 @@ class AudioPipelineConfig(AudioConfig):
             os.getenv("STEM_EXTRACTOR_MODEL", "htdemucs_6s.yaml")
         )
 
+        # ONNX Runtime session configuration for .onnx separator models
+        onnx_defaults = OnnxSessionConfig.from_env()
+        self.onnx_graph_optimization_level = onnx_defaults.graph_optimization_level
+        self.onnx_intra_op_threads = onnx_defaults.intra_op_threads
+        self.onnx_inter_op_threads = onnx_defaults.inter_op_threads
+        self.onnx_execution_mode = onnx_defaults.execution_mode
+        self.onnx_enable_cpu_mem_arena = onnx_defaults.enable_cpu_mem_arena
+        self.onnx_enable_mem_pattern = onnx_defaults.enable_mem_pattern
+        self.onnx_cache_optimized_graph = onnx_defaults.cache_optimized_graph
+        # overlays copy the attribute dict, so they are frozen as well
+        self.__dict__["_frozen"] = True
+
+    def onnx_session_config(self) -> OnnxSessionConfig:
+        """Session settings for the separator, built from the onnx_* attributes"""
+        return OnnxSessionConfig(
+            graph_optimization_level=self.onnx_graph_optimization_level,
+            intra_op_threads=self.onnx_intra_op_threads,
+            inter_op_threads=self.onnx_inter_op_threads,
+            execution_mode=self.onnx_execution_mode,
+            enable_cpu_mem_arena=self.onnx_enable_cpu_mem_arena,
+            enable_mem_pattern=self.onnx_enable_mem_pattern,
+            cache_optimized_graph=self.onnx_cache_optimized_graph,
+        )
+
+    def model_names(self) -> dict:
+        """Configured model per models argument"""
+        return {model_arg: getattr(self, attribute) for model_arg, attribute in MODEL_ARG_ATTRIBUTES.items()}
+
+    def with_models(self, model_args : Optional[dict]) -> "AudioPipelineConfig":
+        """
+        Frozen copy of the config with the requested models swapped in, the
+        config itself when the request overrides nothing. Only the attribute
+        dict is copied, so an overlay costs microseconds per request.
+        """
+        overrides = {
+            MODEL_ARG_ATTRIBUTES[model_arg]: model_name for model_arg, model_name in (model_args or {}).items()
+            if model_arg in MODEL_ARG_ATTRIBUTES and model_name and getattr(self, MODEL_ARG_ATTRIBUTES[model_arg]) != model_name
+        }
+        if not overrides:
+            return self
+        overlay = copy.copy(self)
+        overlay.__dict__.update(overrides)
+        return overlay
+
+    def __setattr__(self, name, value):
+        if self.__dict__.get("_frozen"):
+            raise AttributeError(f"AudioPipelineConfig is shared between requests, use with_models() instead of setting {name}")
+        super().__setattr__(name, value)
+
 OUTPUT_NAME_CONFIG = {
     "model_bs_roformer_ep_317_sdr_12.9755.ckpt": ("vocals", "instrumental"),
     "Kim_Vocal_2.onnx" : ("vocals", "instrumental"),
@@ -5,6 +5,8 @@ sys.path.append(os.path.basename(''))
 from pydantic.dataclasses import dataclass
 from utils.AudioSeparator import AudioSeparator
 from utils.s3Utils import S3Helper
+from utils.StagePipeline import StagePipeline
+from utils.OutputFormats import OutputFormat
 from .Config import AudioPipelineConfig
 from typing import Dict, Optional, List, Union
 
@@ -22,6 +24,12 @@ class AudioProcessingContext:
     output_channels: Optional[int] = None
     input_prompt : str = ''
     audio_length : Union[int, float, None] = None
+    cache_key : Optional[str] = None
+    quality : Optional[str] = None
+    skipped_fraction : float = 0.0
+    instrumental_strategy : str = "model"
+    stages : Optional[StagePipeline] = None
+    output_formats : Optional[List[OutputFormat]] = None
 
     def generate_output_names(self, *keys: str) -> Dict[str, str]:
         return {key: f"{self.task_id}_{key.replace(' ', '')}" for key in keys}
@@ -8,6 +8,7 @@ from .Config import OUTPUT_NAME_CONFIG
 from typing import List, Dict, Type
 from utils.exceptions import OutputNameConfigNotFoundException
 from utils.Elevenlabs import SoundEffectCreator
+from utils.ResidualStem import write_residual
 
 class AudioProcessor(ABC):
     """Abstract base class for audio processing strategies"""
@@ -32,20 +33,18 @@ class BaseExtractorProcessor(AudioProcessor):
         """ Returns the full file path, respective to the output director"""
         return os.path.join(context.config.output_dir, file_path)
 
-    def _filter_outputs(self, output_files, output_stems, context : AudioProcessingContext):
+    def _filter_outputs(self, stem_paths, output_stems, context : AudioProcessingContext):
         """
-        Filter the outputs. Only returns the output_files for the respective output_stems
+        Filter the outputs. Only returns the stem_paths for the respective output_stems
         """
         filtered_outputs = []
-        for file_path in output_files:
-            output_key = self._determine_output_key(file_path, context)
+        for stem_path in stem_paths:
+            output_key = self._determine_output_key(stem_path, context)
             if output_key in output_stems:
-                filtered_outputs.append(file_path)
-            else:
-                # its an unexpected files: remove it 
-                file_path = self._get_full_file_path(file_path, context)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
+                filtered_outputs.append(stem_path)
+            elif os.path.isfile(stem_path):
+                # its an unexpected stem: drop it from the scratch dir
+                os.remove(stem_path)
         return filtered_outputs
 
     def process(self, context: 'AudioProcessingContext') -> List[str]:
@@ -57,10 +56,8 @@ class BaseExtractorProcessor(AudioProcessor):
                 f"Output name config not found for model: {model_name}"
             )
         output_names = context.generate_output_names(*output_stems_)
-        out_files =  context.separator.run_extractor(
-            model_name, context.input_path, custom_output_names=output_names
-        )
-        return out_files
+        stem_paths = context.stages.separate("separate", model_name, context.input_path, output_names)
+        return [context.stages.deliver(stem_path) for stem_path in stem_paths]
 
 class VocalExtractorProcessor(BaseExtractorProcessor):
     def get_model_name(self, context : 'AudioProcessingContext') -> str:
@@ -72,58 +69,59 @@ class InstrumentalExtractorProcessor(BaseExtractorProcessor):
 
 class VocalInstrumentalExtractor(BaseExtractorProcessor):
     def process(self, context: 'AudioProcessingContext') -> List[str]:
+        stages = context.stages
         # Run the vocal extractor first
         model_name = context.config.vocal_extractor_model
         output_stems_ = ("vocals",)
         output_names = context.generate_output_names(*output_stems_)
-        vocal_files = context.separator.run_extractor(
-            model_name, context.input_path, custom_output_names=output_names
-        )
-        vocal_files = self._filter_outputs(vocal_files, output_stems_, context)
+        vocal_paths = stages.separate("vocals", model_name, context.input_path, output_names)
+        vocal_paths = self._filter_outputs(vocal_paths, output_stems_, context)
 
-        # Run instrumental extractor
         output_stems_ = ("instrumental",)
-        output_names = context.generate_output_names(*output_stems_)
-        # Run the instrumental extractor on the same input
-        instrumental_files = context.separator.run_extractor(
-            context.config.instrumental_extractor_model, context.input_path, output_names
-        )
-        instrumental_files = self._filter_outputs(instrumental_files, output_stems_, context)
+        if context.instrumental_strategy == "residual":
+            # Derive the instrumental as mix - vocals, no second model pass
+            vocal_path = stages.scratch_path(f"{context.task_id}_vocals.wav")
+            assert vocal_path in vocal_paths, "Error extracting vocal stems"
+            instrumental_path = write_residual(
+                context.input_path, vocal_path, stages.scratch_path(f"{context.task_id}_instrumental.wav")
+            )
+            stages.record("residual", [instrumental_path])
+            instrumental_paths = [instrumental_path]
+        else:
+            # Run the instrumental extractor on the same input
+            output_names = context.generate_output_names(*output_stems_)
+            instrumental_paths = stages.separate(
+                "instrumental", context.config.instrumental_extractor_model, context.input_path, output_names
+            )
+            instrumental_paths = self._filter_outputs(instrumental_paths, output_stems_, context)
         # Combine the results
-        return vocal_files + instrumental_files
+        return [stages.deliver(stem_path) for stem_path in vocal_paths + instrumental_paths]
     
 class LeadBackVocalExtractor(BaseExtractorProcessor):
     def process(self, context: 'AudioProcessingContext') -> List[str]:
+        stages = context.stages
         # Run the vocal extractor first
         model_name = context.config.vocal_extractor_model
         output_stems_ = ("vocals", "instrumental")
         output_names = context.generate_output_names(*output_stems_)
-        vocal_files = context.separator.run_extractor(
-            model_name, context.input_path, custom_output_names=output_names
-        )
-        # Run Back Vocal Extractor on the extracted vocals
-        vocal_files = self._filter_outputs(vocal_files, output_stems_, context)
-
-        vocal_filepath = f"{context.task_id}_vocals.wav"
-        instrumental_filepath = f"{context.task_id}_instrumental.wav"
-        assert instrumental_filepath in vocal_files, "Error extracting instrumental stems"
-        assert vocal_filepath in vocal_files, "Error extracting vocal stems"
+        stem_paths = stages.separate("vocals", model_name, context.input_path, output_names)
+        stem_paths = self._filter_outputs(stem_paths, output_stems_, context)
 
-        input_filename = self._get_full_file_path(vocal_filepath, context)
-        output_stems_ = ("vocal_front", "vocal_back")
+        vocal_path = stages.scratch_path(f"{context.task_id}_vocals.wav")
+        instrumental_path = stages.scratch_path(f"{context.task_id}_instrumental.wav")
+        assert instrumental_path in stem_paths, "Error extracting instrumental stems"
+        assert vocal_path in stem_paths, "Error extracting vocal stems"
 
+        # Run Back Vocal Extractor on the extracted vocals, straight from the scratch dir
         ## use a custom output name format for the lead back splitter
         output_names = {
-            'vocals' : 'vocal_back', 
-            'instrumental' : 'vocal_front'
+            'vocals' : f'{context.task_id}_vocal_back',
+            'instrumental' : f'{context.task_id}_vocal_front'
         }
         model_name = context.config.lead_back_splitter
-        output_files = context.separator.run_extractor(
-            model_name, input_filename, output_names
-        )
+        lead_back_paths = stages.separate("lead_back", model_name, vocal_path, output_names)
         # appending instrumental stem to output files
-        output_files.append(instrumental_filepath)
-        return output_files
+        return [stages.deliver(stem_path) for stem_path in lead_back_paths + [instrumental_path]]
 
 class DeNoiseProcessor(BaseExtractorProcessor):
     def get_model_name(self, context : 'AudioProcessingContext') -> str:
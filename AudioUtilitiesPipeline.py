@@ -3,13 +3,33 @@ import sys
 
 sys.path.append(os.path.basename(''))
 
-import runpod
+# installed first, so startup can report what every import below costs
+from utils.ImportTimer import import_timer
+import_timer.install()
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Optional
 from utils.s3Utils import S3Helper
 from utils.response_utils import success, error
 from utils.logger import get_logger
-from utils.AudioSeparator import AudioSeparator
-from pydub import AudioSegment
+from utils.AudioSeparator import AudioSeparator, resolve_quality
 from utils.Elevenlabs import SoundEffectCreator
+from utils.ResultCache import StemResultCache
+from utils.SilenceDetection import SilenceSkipper, resolve_skip_silence
+from utils.ResidualStem import resolve_instrumental_strategy, write_residual
+from utils.StagePipeline import StagePipeline
+from utils.AudioProbe import get_duration
+from utils.OutputStage import OutputStage, OutputBatch
+from utils.OutputFormats import parse_output_formats, format_signature
+from utils.StreamingIngest import IngestedAudio, ingest_s3_audio, ingested_path
+from utils.InputCache import get_input_cache
+from utils.PipelinedExecutor import PipelinedExecutor, inference_slots
+from utils.ConcurrencyController import ConcurrencyController
+from utils.Timings import job_timings, attach_timings
+from utils.Profiling import JobProfile, job_profile, profile_requested, run_profiled
 # from audiocraft.models import AudioGen
 # from audiocraft.data.audio import audio_write
 
@@ -37,10 +57,38 @@ os.makedirs(audiogen_model_cache_dir, exist_ok=True)
 os.environ["TORCH_HOME"] = audiogen_model_cache_dir  # For PyTorch
 os.environ["HF_HOME"] = audiogen_model_cache_dir     # For Hugging Face
 
-concurrency_modifier = int(os.environ.get("CONCURRENCY_MODIFIER", 3))
+concurrency_controller = ConcurrencyController("AudioUtilities")
 
 def adjust_concurrency(current_concurrency):
-    return concurrency_modifier
+    return concurrency_controller.adjust(current_concurrency)
+
+
+@dataclass
+class AudioJob:
+    """State of one job, nothing job specific lives on the shared pipeline"""
+
+    task_id : str
+    arguments : dict
+    mode : str
+    model_args : dict = field(default_factory=dict)
+    quality : Optional[str] = None
+    instrumental_strategy : str = "model"
+    output_formats : Optional[list] = None
+    output_audio_channels : Optional[int] = None
+    orig_audio_channel : Optional[int] = None
+    input_filepath : Optional[str] = None
+    model_input_filepath : Optional[str] = None
+    silence_skipper : Optional[SilenceSkipper] = None
+    cache_key : Optional[str] = None
+    output_filepaths : list = field(default_factory=list)
+    skipped_fraction : float = 0.0
+    bytes_written : dict = field(default_factory=dict)
+    # set when the job is served without inference, e.g. from the result cache
+    response : Optional[dict] = None
+
+    @property
+    def needs_inference(self) -> bool:
+        return self.response is None and self.mode != "sound_creator"
 
 
 
@@ -54,31 +102,37 @@ class AudioUtiltiesServerlessPipeline():
             os.makedirs(self.model_dir, exist_ok=True)
             os.makedirs(self.output_dir, exist_ok=True)
             self.output_format = "wav"
-            self.orig_audio_channel = None
-            self.output_audio_channels = None
             self.separator = AudioSeparator(output_dir=self.output_dir, model_file_dir=self.model_dir, output_format=self.output_format)
+            self.result_cache = StemResultCache(self.s3Helper, aws_bucket_name)
+            self.output_stage = OutputStage(self.s3Helper, aws_bucket_name)
+            self.input_cache = get_input_cache(self.s3Helper.transfer)
+            # concurrent jobs share the models, inference is bounded by the device, I/O runs beside it
+            slots = inference_slots()
+            self.logger.info(f"Running up to {slots} jobs on the models at once")
+            self.job_executor = PipelinedExecutor(
+                "AudioUtilities", self._prepare_job, self._infer_job, self._deliver_job, inference_workers=slots,
+                skip_inference=lambda job: not job.needs_inference,
+                cleanup=lambda task_id, arguments: self._cleanup_job(task_id)
+            )
         except Exception as e:
             self.logger.exception(e)
             self.logger.error("Error initializing the pipeline")
             raise 
         
-    def _download_input_audio(self, audio_path, task_id):
+    def _ingest_input_audio(self, audio_path, task_id) -> IngestedAudio:
         """
-        Download input audio from s3
+        Stream input audio from s3 through the decoder, the download overlaps
+        decoding and hashing and only the decoded wav is written
         """
         try:
-            fileext = self._get_file_ext(audio_path)
-            download_path = os.path.join("/tmp", f"{task_id}.{fileext}")
-            self.s3Helper.download_file(aws_bucket_name, audio_path, download_path )
-            return download_path
+            return ingest_s3_audio(self.s3Helper.transfer, aws_bucket_name, audio_path, ingested_path(task_id), self.input_cache)
         except Exception:
-            self.logger.error(f"Error downloading input audio from s3")
+            self.logger.error(f"Error ingesting input audio from s3")
             raise 
 
-    def run_extractor(self, model_name, input_filepath, return_vocal_only = False, custom_output_names = None):
+    def run_extractor(self, model_name, input_filepath, return_vocal_only = False, custom_output_names = None, quality = None):
         try:
-            self.separator.load_model(model_name)
-            out_filepaths = self.separator.run(input_filepath, custom_output_names = custom_output_names)
+            out_filepaths = self.separator.run_extractor(model_name, input_filepath, custom_output_names = custom_output_names, quality = quality)
             if return_vocal_only:
                 out_filepaths = [out_filepaths[0]]
             return out_filepaths
@@ -134,130 +188,149 @@ class AudioUtiltiesServerlessPipeline():
         de_noise = de_noise_arg if de_noise_arg else de_noise_model_name
         return de_noise
 
+    def get_model_names(self, model_args : dict) -> dict:
+        """ All models a job may run with the given args, part of the result cache key """
+        return {
+            "vocal_extractor": self.get_vocal_extractor_model(model_args),
+            "instrumental_extractor": self.get_instrumental_extractor_model(model_args),
+            "front_back_vocal_extractor": self.get_front_back_vocal_extractor_model(model_args),
+            "de_reverb": self.get_reverb_extractor_model(model_args),
+            "stem_extractor": self.get_stem_extractor_model(model_args),
+            "de_echo": self.get_de_echo_model(model_args),
+            "de_noise": self.get_de_noise_model(model_args),
+            "deecho_dereverb_combined": deecho_dereverb_model_combined,
+            "denoise_vocal_extractor": denoise_model_vocal_extractor,
+        }
+
     def get_full_file_path(self, file_path : str):
         return os.path.join(self.output_dir, file_path)
 
-    def _convert_audio_channels(self, file_path : str, num_channels : int = 0):
-        """
-        Convert given audio to mono
-        """
-        try:
-            if not num_channels:
-                num_channels = self.output_audio_channels or self.orig_audio_channel or 2
-            if num_channels not in (1,2):
-                raise ValueError("Invalid channel type")
-            audio = AudioSegment.from_file(file_path)
-            audio.set_channels(num_channels)
-            audio.export(file_path, format=self.output_format)
-        except Exception as e:
-            self.logger.exception(e)
-            raise 
-    
-    def _audio_cleanup(self, input_filepath : str):
-        """Performs dereverb, deecho and denoise on given input audio"""
+    def _get_output_channels(self, job : AudioJob) -> int:
+        """Channel count of the delivered vocal stems"""
+        return job.output_audio_channels or job.orig_audio_channel or 2
+
+    def _audio_cleanup(self, stages : StagePipeline, stem_path : str, quality : str = None) -> str:
+        """Performs dereverb, deecho and denoise on given stem, returns the path of the cleaned stem"""
         try:
-            self.logger.debug(f"Cleaning up audio for {input_filepath}")
-            input_filename = input_filepath.split("/")[-1].split(".")[0]
+            self.logger.debug("Cleaning up audio for %s", stem_path)
+            stem_name = os.path.splitext(os.path.basename(stem_path))[0]
             # clean the audio using UVR_Decho_Denoise_Model
             custom_output_names = {
-                'no reverb' : input_filename
+                'no reverb' : f"{stem_name}_dereverb"
             }
-            output_filepaths_ = self.run_extractor(deecho_dereverb_model_combined, input_filepath, custom_output_names = custom_output_names)
-            self.logger.debug(f"Echo reverb removal output filepaths : {output_filepaths_}")
+            output_filepaths_ = stages.separate("dereverb_deecho", deecho_dereverb_model_combined, stem_path, custom_output_names)
+            self.logger.debug("Echo reverb removal output filepaths : %s", output_filepaths_)
+            dereverb_path = stages.scratch_path(f"{stem_name}_dereverb.wav")
+            assert dereverb_path in output_filepaths_, "Error removing echo and reverb"
             # denoise the audi using UVR_Denoise model
             custom_output_names = {
-                'no noise' : input_filename
+                'no noise' : f"{stem_name}_denoise"
             }
-            output_filepaths_ = self.run_extractor(denoise_model_vocal_extractor, input_filepath, custom_output_names=custom_output_names)
-            self.logger.debug(f"Denoise output filepaths : {output_filepaths_}")
+            output_filepaths_ = stages.separate("denoise", denoise_model_vocal_extractor, dereverb_path, custom_output_names)
+            self.logger.debug("Denoise output filepaths : %s", output_filepaths_)
+            denoise_path = stages.scratch_path(f"{stem_name}_denoise.wav")
+            assert denoise_path in output_filepaths_, "Error denoising"
+            return denoise_path
         except Exception as e:
             self.logger.exception(e)
-            return 
+            return stem_path
 
-    def process_audio(self, input_filepath, mode, model_args, task_id: str) -> list:
+    def process_audio(self, input_filepath, mode, model_args, task_id: str, quality: str = None, instrumental_strategy: str = "model", stages: StagePipeline = None,
+                      output_channels: int = 2) -> list:
+        """
+        Runs the model stages of the given mode. Intermediate stems stay in the
+        stage scratch dir, only the returned stems are delivered to the output dir.
+        """
         try:
-            self.logger.debug(f"Processing audio with mode: {mode}, model_args: {model_args}")
+            self.logger.debug("Processing audio with mode: %s, model_args: %s, quality: %s", mode, model_args, quality)
 
             # Define output names for common modes
             def generate_output_names(task_id, *keys):
                 return {key: f"{task_id}_{key.replace(' ','')}" for key in keys}
 
-            # Helper to clean and convert audio channels
-            def clean_and_convert(audio_path, channels=0):
-                self._audio_cleanup(self.get_full_file_path(audio_path))
-                self._convert_audio_channels(self.get_full_file_path(audio_path), channels)
+            # Helper to clean a stem and deliver it with the output channel count
+            def clean_and_deliver(stem_path, channels=0):
+                cleaned_path = self._audio_cleanup(stages, stem_path, quality)
+                return stages.deliver(cleaned_path, channels or output_channels, file_name=os.path.basename(stem_path))
 
             # Mode handlers
             if mode == "vocal_extractor":
                 output_names = generate_output_names(task_id, "vocals", "instrumental")
                 extractor = self.get_vocal_extractor_model(model_args)
 
-                self.logger.debug(f"Running vocal extractor with model: {extractor}")
-                extracted_files = self.run_extractor(extractor, input_filepath, custom_output_names=output_names)
+                self.logger.debug("Running vocal extractor with model: %s", extractor)
+                extracted_paths = stages.separate("vocals", extractor, input_filepath, output_names)
 
-                vocal_path = f"{task_id}_vocals.wav"
-                assert vocal_path in extracted_files, "Error extracting vocal stem"
+                vocal_path = stages.scratch_path(f"{task_id}_vocals.wav")
+                assert vocal_path in extracted_paths, "Error extracting vocal stem"
 
-                clean_and_convert(vocal_path)
-                return extracted_files
+                return [clean_and_deliver(vocal_path)] + [stages.deliver(path) for path in extracted_paths if path != vocal_path]
 
             elif mode == "instrumental_extractor":
                 output_names = generate_output_names(task_id, "vocals", "instrumental")
                 extractor = self.get_instrumental_extractor_model(model_args)
 
-                self.logger.debug(f"Running instrumental extractor with model: {extractor}")
-                extracted_files = self.run_extractor(extractor, input_filepath, custom_output_names=output_names)
+                self.logger.debug("Running instrumental extractor with model: %s", extractor)
+                extracted_paths = stages.separate("instrumental", extractor, input_filepath, output_names)
 
-                instrumental_path = f"{task_id}_instrumental.wav"
-                assert instrumental_path in extracted_files, "Error extracting instrumental stem"
+                instrumental_path = stages.scratch_path(f"{task_id}_instrumental.wav")
+                assert instrumental_path in extracted_paths, "Error extracting instrumental stem"
 
-                # clean_and_convert(instrumental_path)
-                self.logger.debug(f"Extracted files : {extracted_files}")
-                return extracted_files
+                self.logger.debug("Extracted files : %s", extracted_paths)
+                return [stages.deliver(path) for path in extracted_paths]
 
             elif mode == "vocal_instrumental_extractor":
                 output_names = generate_output_names(task_id, "vocals", "instrumental")
                 vocal_extractor = self.get_vocal_extractor_model(model_args)
 
-                self.logger.debug(f"Running vocal extractor with model: {vocal_extractor}")
-                extracted_files = self.run_extractor(vocal_extractor, input_filepath, custom_output_names=output_names)
-
-                vocal_path = f"{task_id}_vocals.wav"
-                assert vocal_path in extracted_files, "Error extracting vocal stem"
-
-                # Re-run for instrumental extraction
-                output_names = generate_output_names(task_id, "instrumental")
-                instrumental_extractor = self.get_instrumental_extractor_model(model_args)
+                self.logger.debug("Running vocal extractor with model: %s", vocal_extractor)
+                extracted_paths = stages.separate("vocals", vocal_extractor, input_filepath, output_names)
+
+                vocal_path = stages.scratch_path(f"{task_id}_vocals.wav")
+                assert vocal_path in extracted_paths, "Error extracting vocal stem"
+
+                instrumental_path = stages.scratch_path(f"{task_id}_instrumental.wav")
+                if instrumental_strategy == "residual":
+                    # Derive the instrumental as mix - vocals, replacing the vocal model's own instrumental
+                    self.logger.debug("Deriving instrumental as the residual of the vocal stem")
+                    write_residual(input_filepath, vocal_path, instrumental_path)
+                    stages.record("residual", [instrumental_path])
+                    # the vocal model may have written its own instrumental to the same path, now overwritten
+                    if instrumental_path not in extracted_paths:
+                        extracted_paths.append(instrumental_path)
+                else:
+                    # Re-run for instrumental extraction
+                    output_names = generate_output_names(task_id, "instrumental")
+                    instrumental_extractor = self.get_instrumental_extractor_model(model_args)
 
-                self.logger.debug(f"Running instrumental extractor with model: {instrumental_extractor}")
-                extracted_files += self.run_extractor(instrumental_extractor, input_filepath, custom_output_names=output_names)
+                    self.logger.debug("Running instrumental extractor with model: %s", instrumental_extractor)
+                    extracted_paths += stages.separate("instrumental", instrumental_extractor, input_filepath, output_names)
 
-                instrumental_path = f"{task_id}_instrumental.wav"
-                assert instrumental_path in extracted_files, "Error extracting instrumental stem"
+                assert instrumental_path in extracted_paths, "Error extracting instrumental stem"
 
-                clean_and_convert(vocal_path)
-                clean_and_convert(instrumental_path)
-                self.logger.debug(f"Extracted files : {extracted_files}")
-                return extracted_files
+                self.logger.debug("Extracted files : %s", extracted_paths)
+                return [clean_and_deliver(vocal_path), clean_and_deliver(instrumental_path)]
 
             elif mode == "2_step_vocal_extractor":
                 # Step 1: Separate vocal and instrumental
                 output_names = generate_output_names(task_id, "vocals", "instrumental")
                 vocal_extractor = self.get_vocal_extractor_model(model_args)
-                extracted_files = self.run_extractor(vocal_extractor, input_filepath, custom_output_names=output_names)
+                extracted_paths = stages.separate("vocals", vocal_extractor, input_filepath, output_names)
 
-                vocal_path = f"{task_id}_vocals.wav"
-                assert vocal_path in extracted_files, "Error extracting vocal stem"
+                vocal_path = stages.scratch_path(f"{task_id}_vocals.wav")
+                assert vocal_path in extracted_paths, "Error extracting vocal stem"
 
-                # Step 2: Separate front and back vocals
-                input_filename = self.get_full_file_path(vocal_path)
+                # Step 2: Separate front and back vocals, straight from the scratch dir
                 output_names = generate_output_names(task_id, "vocal_front", "vocal_back")
                 front_back_extractor = self.get_front_back_vocal_extractor_model(model_args)
-                second_stage_files = self.run_extractor(front_back_extractor, input_filename, custom_output_names=output_names)
+                second_stage_paths = stages.separate("lead_back", front_back_extractor, vocal_path, output_names)
 
-                clean_and_convert(f"{task_id}_vocal_front.wav")
-                self.logger.debug(f"Extracted files : {extracted_files}")
-                return extracted_files + second_stage_files
+                front_vocal_path = stages.scratch_path(f"{task_id}_vocal_front.wav")
+                self.logger.debug("Extracted files : %s", extracted_paths + second_stage_paths)
+                return [
+                    clean_and_deliver(path) if path == front_vocal_path else stages.deliver(path)
+                    for path in extracted_paths + second_stage_paths if path != vocal_path
+                ]
 
             elif mode in ["de_reverb", "de_echo", "de_noise"]:
                 extractor_map = {
@@ -272,14 +345,14 @@ class AudioUtiltiesServerlessPipeline():
                             "de_noise": ["dry", "noise", "other", "no noise"]}
                 output_names = generate_output_names(task_id, *output_keys[mode])
 
-                self.logger.debug(f"Running {mode} extractor with model: {extractor}")
-                return self.run_extractor(extractor, input_filepath, custom_output_names=output_names)
+                self.logger.debug("Running %s extractor with model: %s", mode, extractor)
+                return [stages.deliver(path) for path in stages.separate(mode, extractor, input_filepath, output_names)]
 
             elif mode == "stem_extractor":
                 stem_extractor = self.get_stem_extractor_model(model_args)
 
-                self.logger.debug(f"Running stem extractor with model: {stem_extractor}")
-                return self.run_extractor(stem_extractor, input_filepath)
+                self.logger.debug("Running stem extractor with model: %s", stem_extractor)
+                return [stages.deliver(path) for path in stages.separate("stems", stem_extractor, input_filepath)]
 
             else:
                 raise ValueError(f"Invalid mode provided: {mode}")
@@ -292,19 +365,6 @@ class AudioUtiltiesServerlessPipeline():
     def _get_file_ext(self, filename : str):
         return filename.split(".")[-1].lower()
 
-    def convert_file_to_wav(self, filename : str):
-        try:
-            """Converts any given file to wav, using AudioSegment"""
-            self.logger.debug(f"Converting {filename} to wav")
-            audio = AudioSegment.from_file(filename)
-            self.orig_audio_channel = audio.channels
-            wav_filename = filename.split(".")[0] + ".wav"
-            audio.export(wav_filename, format="wav")
-            return wav_filename
-        except Exception as e:
-            self.logger.exception(e)
-            raise e
-        
     # def _save_audio_locally_audiogen(self, audio, file_name):
     #     local_path = f"{self.output_dir}/{file_name}"
     #     audio_write(local_path, audio.cpu(), self.audiogen_model.sample_rate, strategy="loudness", loudness_compressor=True)
@@ -316,8 +376,20 @@ class AudioUtiltiesServerlessPipeline():
         self.s3Helper.upload_file(local_path, s3_key, aws_bucket_name)
         return s3_key
 
+    def _upload_output(self, file_path : str, s3_key : str, batch : OutputBatch, output_formats : list = None) -> str:
+        """
+        Queues the upload of a job output, the batch records it for the result cache.
+        With output_formats only the requested formats are encoded and uploaded,
+        returns the s3 key of the primary format.
+        """
+        if not output_formats:
+            batch.upload(file_path, s3_key)
+            return s3_key
+        s3_keys = batch.deliver(file_path, os.path.splitext(s3_key)[0], output_formats)
+        return next(iter(s3_keys.values()))
+
     def _get_audio_duration(self, local_path):
-        return AudioSegment.from_file(local_path).duration_seconds
+        return get_duration(local_path)
 
 
     def _save_and_upload_audiogen_audio(self, task_id, audio_outputs):
@@ -331,7 +403,7 @@ class AudioUtiltiesServerlessPipeline():
                 # Save audio locally
                 local_path = self._save_audio_locally_audiogen(one_wav, file_name)
 
-                self.logger.debug(f"Outputs : {os.listdir(self.output_dir)}")
+                self.logger.debug("Outputs : %s", os.listdir(self.output_dir))
                 if not os.path.exists(local_path):
                     raise Exception("Error saving audio locally")
                 # Upload to S3
@@ -357,7 +429,7 @@ class AudioUtiltiesServerlessPipeline():
 
     def process_sound_creator(self, input_prompt : str, task_id : str):
         try:
-            self.logger.debug(f"Got input prompt : {input_prompt}")
+            self.logger.debug("Got input prompt : %s", input_prompt)
             desccriptions = [input_prompt]
             audio_outputs = self.audiogen_model.generate(desccriptions)
             uploaded_files = self._save_and_upload_audiogen_audio(task_id, audio_outputs)
@@ -368,68 +440,175 @@ class AudioUtiltiesServerlessPipeline():
             raise e
 
 
-    def run(self, task_id : str, arguments : dict):
+    def _prepare_job(self, task_id : str, arguments : dict) -> AudioJob:
+        """
+        I/O phase before inference: validates the arguments, ingests the input
+        and serves cache hits. Sound creator jobs are generated here, they need no model.
+        """
+        mode = arguments.get("mode")
+        assert mode in valid_modes
+        job = AudioJob(task_id=task_id, arguments=arguments, mode=mode)
+
+        if mode == "sound_creator":
+            """
+            Process Sound Creator
+            """
+            input_prompt = arguments['prompt']
+            audio_length = int(arguments.get("audio_length", 5))
+
+
+            ## initialize and run elevenlabs
+            el_ = SoundEffectCreator(api_key=elevenlabs_api_key)
+            output_filepath = el_.run(task_id, input_prompt, audio_length)
+            assert os.path.exists(output_filepath), "Error generating sound"
+
+            file_ext = self._get_file_ext(output_filepath)
+            file_name = f"{task_id}"
+            file_name_s3 = f"conversions/{task_id}.{file_ext}"
+            file_name_s3 = self._upload_to_s3(output_filepath, file_name, file_name_s3)
+            conversion_duration = self._get_audio_duration(output_filepath)
+            os.remove(output_filepath)
+            out_obj = {
+                'local_path' : output_filepath, 
+                'conversion_path' : file_name_s3,
+                'conversion_duration' : conversion_duration
+                       }
+            job.output_filepaths = [out_obj]
+            # initialize audiogen model for sound creator only
+            # self.audiogen_model = AudioGen.get_pretrained('facebook/audiogen-medium')
+            # self.audiogen_model.set_generation_params(audio_length)
+            # output_filepaths = self.process_sound_creator(input_prompt, task_id)
+            return job
+
+        """
+        Process for audio cleanup tasks
+        """
+        audio_path_s3 : str = arguments['audio_path_s3']
+        job.model_args = arguments.get("models", {})
+        job.quality = resolve_quality(arguments.get("quality"))
+        job.instrumental_strategy = resolve_instrumental_strategy(arguments.get("instrumental_strategy"))
+        # without output_formats the stems are uploaded in the separator output format
+        if arguments.get("output_formats"):
+            job.output_formats = parse_output_formats(arguments.get("output_formats"), [])
+        output_channels = arguments.get("output_audio_channels", None)
+        if output_channels:
+            job.output_audio_channels = int(output_channels)
+        assert audio_path_s3.endswith(tuple(valid_audio_formats)), "Invalid input audio path"
+        # all inputs are decoded to wav while they download
+        ingested = self._ingest_input_audio(audio_path_s3, task_id)
+        job.input_filepath, job.orig_audio_channel = ingested.path, ingested.channels
+        skip_silence = resolve_skip_silence(arguments.get("skip_silence"))
+        job.cache_key = StemResultCache.make_key(
+            ingested.digest, self.get_model_names(job.model_args), self.separator.param_signature(job.quality), mode,
+            output_audio_channels=job.output_audio_channels,
+            # keys of the default strategy stay the same as before the option existed
+            **({"instrumental_strategy": job.instrumental_strategy} if job.instrumental_strategy != "model" else {}),
+            **({"output_formats": format_signature(job.output_formats)} if job.output_formats else {}),
+            # silence skipping changes the stems around the spliced spans, keyed on the effective flag
+            # so deployments with other defaults sharing the cache never mix them up
+            **({"skip_silence": True} if skip_silence else {})
+        )
+        job.response = self.result_cache.lookup(job.cache_key, task_id)
+        if job.response is not None:
+            return job
+        # only the non silent regions go through the models, silence is spliced back as stems are delivered
+        job.silence_skipper = SilenceSkipper(job.input_filepath, enabled=skip_silence)
+        job.model_input_filepath = job.silence_skipper.compacted_input()
+        job.skipped_fraction = job.silence_skipper.skipped_fraction
+        return job
+
+    def _infer_job(self, job : AudioJob):
+        """Inference phase, runs the model stages of the job"""
+        if not job.needs_inference:
+            return
         try:
-            mode = arguments.get("mode")
-            assert mode in valid_modes
-
-            if mode == "sound_creator":
-                """
-                Process Sound Creator
-                """
-                input_prompt = arguments['prompt']
-                audio_length = int(arguments.get("audio_length", 5))
-
-
-                ## initialize and run elevenlabs
-                el_ = SoundEffectCreator(api_key=elevenlabs_api_key)
-                output_filepath = el_.run(task_id, input_prompt, audio_length)
-                assert os.path.exists(output_filepath), "Error generating sound"
-
-                file_ext = self._get_file_ext(output_filepath)
-                file_name = f"{task_id}"
-                file_name_s3 = f"conversions/{task_id}.{file_ext}"
-                file_name_s3 = self._upload_to_s3(output_filepath, file_name, file_name_s3)
-                conversion_duration = self._get_audio_duration(output_filepath)
-                os.remove(output_filepath)
-                out_obj = {
-                    'local_path' : output_filepath, 
-                    'conversion_path' : file_name_s3,
-                    'conversion_duration' : conversion_duration
-                           }
-                output_filepaths = [out_obj]
-                # initialize audiogen model for sound creator only
-                # self.audiogen_model = AudioGen.get_pretrained('facebook/audiogen-medium')
-                # self.audiogen_model.set_generation_params(audio_length)
-                # output_filepaths = self.process_sound_creator(input_prompt, task_id)
-            else:
-                """
-                Process for audio cleanup tasks
-                """
-                
-                audio_path_s3 : str = arguments['audio_path_s3']
-                model_args = arguments.get("models", {})
-                output_channels = arguments.get("output_audio_channels", None)
-                if output_channels:
-                    self.output_audio_channels = int(output_channels)
-                assert audio_path_s3.endswith(tuple(valid_audio_formats)), "Invalid input audio path"
-                input_filepath = self._download_input_audio(audio_path_s3, task_id)
-                if not os.path.exists(input_filepath):
-                    raise Exception("Invalid Input File Provided")
-                # converting all audio files to wav before processing
-                input_filepath = self.convert_file_to_wav(input_filepath)
-                output_filepaths = self.process_audio(input_filepath, mode, model_args, task_id)
-            out_obj = self.create_output_obj(output_filepaths, mode, task_id)
+            with StagePipeline(self.separator, job.task_id, self.output_dir, job.quality, silence_map=job.silence_skipper.silence_map) as stages:
+                job.output_filepaths = self.process_audio(job.model_input_filepath, job.mode, job.model_args, job.task_id, job.quality,
+                                                          job.instrumental_strategy, stages, self._get_output_channels(job))
+            job.bytes_written = dict(stages.bytes_written)
+        finally:
+            if job.model_input_filepath != job.input_filepath and os.path.isfile(job.model_input_filepath):
+                os.remove(job.model_input_filepath)
+
+    def _deliver_job(self, job : AudioJob) -> dict:
+        """I/O phase after inference, uploads the outputs and stores the result"""
+        if job.response is not None:
+            return attach_timings(job.response)
+        uploaded_files = {}
+        out_obj = self.create_output_obj(job.output_filepaths, job.mode, job.task_id, uploaded_files, job.output_formats)
+        if job.mode != "sound_creator":
+            out_obj['skipped_fraction'] = job.skipped_fraction
+            out_obj['bytes_written'] = job.bytes_written
+        self.result_cache.store(job.cache_key, job.task_id, out_obj, uploaded_files)
+        return out_obj
+
+    def _cleanup_job(self, task_id : str):
+        # the decoded input sits in RAM backed scratch, drop it on every exit path
+        input_wav = ingested_path(task_id)
+        if os.path.isfile(input_wav):
+            os.remove(input_wav)
+
+    def _upload_profile(self, profile : JobProfile, task_id : str) -> dict:
+        # the artifacts sit next to the job's outputs
+        return profile.upload(self.s3Helper, aws_bucket_name, f"conversions/{task_id}")
+
+    def run(self, task_id : str, arguments : dict):
+        with job_timings(task_id) as timings, job_profile(task_id, profile_requested(arguments.get("profile"))) as profile:
+            succeeded = False
+            profile_keys = None
+            try:
+                job = run_profiled(self._prepare_job, task_id, arguments)
+                run_profiled(self._infer_job, job)
+                out_obj = run_profiled(self._deliver_job, job)
+                succeeded = True
+            except Exception as e:
+                self.logger.error("Error during audio processing")
+                self.logger.error(e)
+                raise e 
+            finally:
+                self._cleanup_job(task_id)
+                if profile is not None:
+                    profile_keys = self._upload_profile(profile, task_id)
+                timings.log(self.logger, mode=arguments.get("mode"), success=succeeded)
+            if profile_keys:
+                out_obj['profile'] = profile_keys
             return out_obj
-        except Exception as e:
-            self.logger.error("Error during audio processing")
-            self.logger.error(e)
-            raise e 
+
+    async def run_async(self, task_id : str, arguments : dict):
+        """
+        Same phases as run on the pipelined executor, so concurrent jobs overlap
+        their download and upload with each other's inference.
+        """
+        start = time.monotonic()
+        succeeded = False
+        profile_keys = None
+        with job_timings(task_id) as timings, job_profile(task_id, profile_requested(arguments.get("profile"))) as profile:
+            try:
+                out_obj = await asyncio.wrap_future(self.job_executor.submit(task_id, arguments))
+                succeeded = True
+            except Exception as e:
+                self.logger.error("Error during audio processing")
+                self.logger.error(e)
+                raise e 
+            finally:
+                concurrency_controller.record_job(time.monotonic() - start, succeeded)
+                if profile is not None:
+                    profile_keys = await asyncio.to_thread(self._upload_profile, profile, task_id)
+                timings.log(self.logger, mode=arguments.get("mode"), success=succeeded)
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug("Job stages : %s", self.job_executor.metrics())
+        if profile_keys:
+            out_obj['profile'] = profile_keys
+        return out_obj
     
-    def create_output_obj(self, output_filepaths : list, mode : str, task_id : str):
+    def create_output_obj(self, output_filepaths : list, mode : str, task_id : str, uploaded_files : dict = None, output_formats : list = None):
         try:
             out_obj = {}
-            self.logger.debug(f"Got output filepaths : {output_filepaths}")
+            if uploaded_files is None:
+                uploaded_files = {}
+            # uploads of all stems run concurrently on the output stage
+            batch = self.output_stage.batch()
+            self.logger.debug("Got output filepaths : %s", output_filepaths)
             ## if not pipline, it should be either of the individual extractor
             if mode == "sound_creator": 
                 out_obj = {
@@ -449,14 +628,12 @@ class AudioUtiltiesServerlessPipeline():
                         file_ext = file_path.split(".")[-1]
                         if primary_output_name in file_path:
                             s3_key = f"conversions/{task_id}_vocal.{file_ext}"
-                            self.s3Helper.upload_file(file_path, s3_key, "lalals")
-                            output_vocal = s3_key
+                            output_vocal = self._upload_output(file_path, s3_key, batch, output_formats)
                             # get length from vocal stem 
-                            conversion_length = AudioSegment.from_file(file_path).duration_seconds
+                            conversion_length = get_duration(file_path)
                         elif secondary_output_name in file_path:
                             s3_key = f"conversions/{task_id}_instrumental.{file_ext}"
-                            self.s3Helper.upload_file(file_path, s3_key, "lalals")
-                            output_instrumental = s3_key
+                            output_instrumental = self._upload_output(file_path, s3_key, batch, output_formats)
                         else:
                             ## file not required
                             pass
@@ -482,18 +659,15 @@ class AudioUtiltiesServerlessPipeline():
                         file_ext = file_path.split(".")[-1]
                         if primary_output_name in file_path:
                             s3_key = f"conversions/{task_id}_vocal.{file_ext}"
-                            self.s3Helper.upload_file(file_path, s3_key, "lalals")
-                            output_vocal = s3_key
+                            output_vocal = self._upload_output(file_path, s3_key, batch, output_formats)
                             # get conversion length from  main vocal track
-                            conversion_length = AudioSegment.from_file(file_path).duration_seconds
+                            conversion_length = get_duration(file_path)
                         elif secondary_output_name in file_path:
                             s3_key = f"conversions/{task_id}_instrumental.{file_ext}"
-                            self.s3Helper.upload_file(file_path, s3_key, "lalals")
-                            output_instrumental = s3_key
+                            output_instrumental = self._upload_output(file_path, s3_key, batch, output_formats)
                         elif back_vocal_output_name in file_path:
                             s3_key = f"conversions/{task_id}_vocal_back.{file_ext}"
-                            self.s3Helper.upload_file(file_path, s3_key, "lalals")
-                            output_back_vocal = s3_key
+                            output_back_vocal = self._upload_output(file_path, s3_key, batch, output_formats)
                         else:
                             ## file not required
                             pass
@@ -516,13 +690,11 @@ class AudioUtiltiesServerlessPipeline():
                         file_ext = file_path.split(".")[-1]
                         if primary_output_name in file_path:
                             s3_key = f"conversions/{task_id}_noreverb.{file_ext}"
-                            self.s3Helper.upload_file(file_path, s3_key, "lalals")
-                            output_noreverb = s3_key
-                            conversion_length = AudioSegment.from_file(file_path).duration_seconds
+                            output_noreverb = self._upload_output(file_path, s3_key, batch, output_formats)
+                            conversion_length = get_duration(file_path)
                         elif secondary_output_name in file_path:
                             s3_key = f"conversions/{task_id}_reverb.{file_ext}"
-                            self.s3Helper.upload_file(file_path, s3_key, "lalals")
-                            output_reverb = s3_key
+                            output_reverb = self._upload_output(file_path, s3_key, batch, output_formats)
                         else:
                             pass
                     out_obj = {
@@ -543,13 +715,11 @@ class AudioUtiltiesServerlessPipeline():
                         file_ext = file_path.split(".")[-1]
                         if primary_output_name in file_path:
                             s3_key = f"conversions/{task_id}_no_echo.{file_ext}"
-                            self.s3Helper.upload_file(file_path, s3_key, "lalals")
-                            output_no_echo = s3_key
-                            conversion_length = AudioSegment.from_file(file_path).duration_seconds
+                            output_no_echo = self._upload_output(file_path, s3_key, batch, output_formats)
+                            conversion_length = get_duration(file_path)
                         elif secondary_output_name in file_path:
                             s3_key = f"conversions/{task_id}_echo.{file_ext}"
-                            self.s3Helper.upload_file(file_path, s3_key, "lalals")
-                            output_echo = s3_key
+                            output_echo = self._upload_output(file_path, s3_key, batch, output_formats)
                         else:
                             pass
                     out_obj = {
@@ -570,13 +740,11 @@ class AudioUtiltiesServerlessPipeline():
                         file_ext = file_path.split(".")[-1]
                         if primary_output_name in file_path:
                             s3_key = f"conversions/{task_id}_no_noise.{file_ext}"
-                            self.s3Helper.upload_file(file_path, s3_key, "lalals")
-                            output_no_noise = s3_key
-                            conversion_length = AudioSegment.from_file(file_path).duration_seconds
+                            output_no_noise = self._upload_output(file_path, s3_key, batch, output_formats)
+                            conversion_length = get_duration(file_path)
                         elif secondary_output_name in file_path:
                             s3_key = f"conversions/{task_id}_noise.{file_ext}"
-                            self.s3Helper.upload_file(file_path, s3_key, "lalals")
-                            output_noise = s3_key
+                            output_noise = self._upload_output(file_path, s3_key, batch, output_formats)
                         else:
                             pass
                     out_obj = {
@@ -603,28 +771,36 @@ class AudioUtiltiesServerlessPipeline():
                 for file_path in output_filepaths:
                     file_path = self.get_full_file_path(file_path)
                     if not conversion_length:
-                        conversion_length = AudioSegment.from_file(file_path).duration_seconds
+                        conversion_length = get_duration(file_path)
                         out_obj['conversion_duration'] = conversion_length
-                    self.logger.debug(f"Got file path : {file_path}")
+                    self.logger.debug("Got file path : %s", file_path)
                     file_ext = file_path.split(".")[-1]
                     for key in out_obj.keys():
                         if key.capitalize() in file_path:
                             s3_key = f"conversions/{task_id}_{key}.{file_ext}"
-                            self.s3Helper.upload_file(file_path, s3_key, "lalals")
-                            out_obj[key] = s3_key
+                            out_obj[key] = self._upload_output(file_path, s3_key, batch, output_formats)
                             break
-            return out_obj
+            uploaded_files.update(batch.wait())
+            if output_formats:
+                # the primary format keeps the output field, the others get a format suffix
+                for field, s3_key in list(out_obj.items()):
+                    for output_format, format_key in batch.delivered.get(s3_key, {}).items():
+                        if format_key != s3_key:
+                            out_obj[f"{field}_{output_format}"] = format_key
+                out_obj['output_sizes'] = batch.bytes_by_format
+            return attach_timings(out_obj)
         except Exception as e:
             self.logger.exception(e)
             raise e
 
     
-    def handler(self, event):
+    async def handler(self, event):
         global valid_modes
+        task_id = None
         try:
             arguments = event['input']['arguments']
             task_id = arguments['task_id']
-            out_obj = self.run(task_id, arguments)
+            out_obj = await self.run_async(task_id, arguments)
             out_obj['task_id'] = task_id
             return success(out_obj)
         except Exception as e:
@@ -638,7 +814,9 @@ class AudioUtiltiesServerlessPipeline():
 
 
 def main():
+    import runpod
     pipeline = AudioUtiltiesServerlessPipeline()
+    import_timer.log_report("AudioUtilitiesPipeline")
     runpod.serverless.start({
         "handler": pipeline.handler,
         "concurrency_modifier" : adjust_concurrency
@@ -1,11 +1,45 @@
-from beam import function, task_queue, QueueDepthAutoscaler, Image, Volume
 import os 
 import sys 
 sys.path.append(os.path.basename(''))
 
+# installed first, so startup can report what every import below costs
+from utils.ImportTimer import import_timer
+import_timer.install()
+
+from beam import function, task_queue, QueueDepthAutoscaler, Image, Volume
+
 from AudioUtilities.AudioPipeline import AudioPipelineConfig, AudioPipeline
+from utils.Profiling import profile_requested
+
+
+def load_pipeline() -> AudioPipeline:
+    """
+    Runs once per worker before its first task. The pipeline, its S3 client,
+    separator and output threads are shared by every task of the worker,
+    per request models are applied as an overlay on the shared config.
+    """
+    pipeline = AudioPipeline(AudioPipelineConfig())
+    import_timer.log_report("BeamEndpoints.AudioUtilities")
+    return pipeline
+
+
+def run_task(pipeline : AudioPipeline, **inputs):
+    model_args = inputs.get("models", {})
+    task_id = inputs['task_id']
+    mode = inputs['mode']
+    s3_path = inputs.get("audio_path_s3")
+    input_prompt = inputs.get("input_prompt", "")
+    audio_length = inputs.get("audio_length")
+    quality = inputs.get("quality")
+    skip_silence = inputs.get("skip_silence")
+    instrumental_strategy = inputs.get("instrumental_strategy")
+    output_formats = inputs.get("output_formats")
+    profile = profile_requested(inputs.get("profile"))
+    return pipeline.execute_pipeline(task_id, mode, s3_path, input_prompt, audio_length, quality, skip_silence, instrumental_strategy, output_formats, model_args, profile)
+
 
 @task_queue(
+    on_start = load_pipeline,
     cpu = 12, 
     workers = 2,
     memory = "32Gi",
@@ -25,16 +59,8 @@ from AudioUtilities.AudioPipeline import AudioPipelineConfig, AudioPipeline
     ],
     secrets=["AWS_ACCESS_KEY", "AWS_SECRET_KEY", "AWS_REGION", "AWS_BUCKET_NAME", "ELEVENLABS_API_KEY"])
 
-def audio_utilities_processor(**inputs):
-    model_args = inputs.get("models", {})
-    config = AudioPipelineConfig(model_args)
-    pipeline = AudioPipeline(config)
-    task_id = inputs['task_id']
-    mode = inputs['mode']
-    s3_path = inputs.get("audio_path_s3")
-    input_prompt = inputs.get("input_prompt", "")
-    audio_length = inputs.get("audio_length")
-    return pipeline.execute_pipeline(task_id, mode, s3_path, input_prompt, audio_length)
+def audio_utilities_processor(context, **inputs):
+    return run_task(context.on_start_value, **inputs)
 
 
 
@@ -46,5 +72,5 @@ if __name__ == "__main__":
         'input_prompt': 'sad sound echo for movie background in emotional scene', 
         'audio_length' : None
     }
-    resp = audio_utilities_processor(**inputs)
+    resp = run_task(load_pipeline(), **inputs)
     print(resp)
\ No newline at end of file
@@ -2,12 +2,17 @@ import os
 import sys 
 sys.path.append(os.path.basename(''))
 
-import runpod
+# installed first, so startup can report what every import below costs
+from utils.ImportTimer import import_timer
+import_timer.install()
+
 from utils.s3Utils import S3Helper
 from utils.response_utils import success, error
 from utils.logger import get_logger
 from utils.redisUtils import RedisHelper
 from utils.stringUtils import validate_youtube_audio_url
+from utils.ConcurrencyController import ConcurrencyController
+import time
 import uuid
 
 from YoutubeDownloader.YoutubeAPI import YoutubeAPI
@@ -19,10 +24,12 @@ aws_secret_key = os.environ.get("aws_secret_key")
 aws_region = os.environ.get("aws_region", "us-east-1")
 aws_bucket_name = "lalals"
 
-concurrency_modifier = int(os.environ.get("CONCURRENCY_MODIFIER", 3))
+concurrency_controller = ConcurrencyController("YoutubeDownloader")
+# separation is chunked for long inputs, so the length cap is a deployment choice
+max_audio_length_minutes = int(os.environ.get("MAX_AUDIO_LENGTH_MINUTES", 8))
 
 def adjust_concurrency(current_concurrency):
-    return concurrency_modifier
+    return concurrency_controller.adjust(current_concurrency)
 
 
 class AudioDownloaderPipeline():
@@ -86,11 +93,11 @@ class AudioDownloaderPipeline():
             if validate_youtube_audio_url(url):
                 ## use vdaDownloader for youtube links 
                 self.logger.debug(f"Youtube link detected, using vda...")
-                title, download_path, audio_length = self.vdaDownloader.run(url)
+                title, download_path, audio_length = self.vdaDownloader.run(url, max_length=max_audio_length_minutes)
             else:
                 self.logger.debug(f"Non youtube link detected, using ytdlp...")
                 ## use ytdlp for other links
-                title, download_path, audio_length = self.ytdlpDownloader.run(url)
+                title, download_path, audio_length = self.ytdlpDownloader.run(url, max_length=max_audio_length_minutes)
             if not title or not download_path:
                 raise Exception("Error downloading audio")
             s3_key = self._get_s3_key(download_path)
@@ -114,10 +121,14 @@ class AudioDownloaderPipeline():
             return error(out_obj)
     
     def handler(self, event):
+        start = time.monotonic()
         try:
             audio_url = event['input']['arguments']['url']
-            return self.run(audio_url)
+            response = self.run(audio_url)
+            concurrency_controller.record_job(time.monotonic() - start, response['success'])
+            return response
         except Exception as e:
+            concurrency_controller.record_job(time.monotonic() - start, False)
             self.logger.error(e)
             out_obj = {
                 'audio_length' : 0,
@@ -128,7 +139,9 @@ class AudioDownloaderPipeline():
             return error(out_obj)
         
 if __name__ == "__main__":
+    import runpod
     pipeline = AudioDownloaderPipeline()
+    import_timer.log_report("YoutubeDownloader")
     runpod.serverless.start({
         "handler": pipeline.handler, 
         "concurrency_modifier" : adjust_concurrency
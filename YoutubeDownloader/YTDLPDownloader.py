@@ -4,8 +4,8 @@ import sys
 sys.path.append(os.path.basename(""))
 import uuid
 import yt_dlp
-from pydub import AudioSegment
 from utils.logger import get_logger
+from utils.AudioProbe import get_duration
 
 
 def duration_filter_factory(max_minutes):
@@ -63,7 +63,7 @@ class YTDLPDownloader:
                 self.logger.debug(f"Downloaded temporary file: {temp_audio_file}")
                 os.replace(temp_audio_file, output_path)
 
-                duration = info_dict.get("duration", self._get_audio_length_local(output_path))
+                duration = info_dict.get("duration") or self._get_audio_length_local(output_path)
                 video_title = info_dict.get("title", "Unknown Title")
 
                 return duration, video_title
@@ -74,12 +74,11 @@ class YTDLPDownloader:
     
     def _get_audio_length_local(self, file_path):
         """
-        Helper method to get the length of an audio file using pydub.
+        Helper method to get the length of an audio file from its headers.
         """
         try:
             self.logger.debug(f"Getting audio length for: {file_path} locally")
-            audio = AudioSegment.from_file(file_path)
-            return audio.duration_seconds
+            return get_duration(file_path)
         except Exception as e:
             self.logger.error(f"Error getting audio length: {e}")
             raise
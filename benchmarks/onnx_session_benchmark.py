@@ -0,0 +1,96 @@
+"""
+Benchmarks ONNX Runtime session settings on a separator model and reports the
+real-time factor (inference seconds per second of audio) for each setting.
+
+    python -m benchmarks.onnx_session_benchmark --model /runpod-volume/audio-separator-models/Kim_Vocal_2.onnx
+"""
+import os
+import sys
+sys.path.append(os.path.basename(''))
+
+import argparse
+import itertools
+import json
+import time
+import numpy as np
+import onnxruntime as ort
+from utils.OnnxSession import OnnxSessionConfig, apply_session_config, GRAPH_OPTIMIZATION_LEVELS, EXECUTION_MODES
+
+
+def _input_feed(session, dim_t : int, batch_size : int) -> dict:
+    """Random spectrogram shaped for the model, dynamic dims filled from the args"""
+    model_input = session.get_inputs()[0]
+    shape = list(model_input.shape)
+    defaults = [batch_size, 4, 3072, dim_t]
+    shape = [dim if isinstance(dim, int) and dim > 0 else defaults[i] for i, dim in enumerate(shape)]
+    return {model_input.name: np.random.randn(*shape).astype(np.float32)}
+
+
+def _audio_seconds(feed : dict, hop_length : int, sample_rate : int) -> float:
+    """Seconds of audio one run covers, batch x frames x hop"""
+    shape = next(iter(feed.values())).shape
+    return shape[0] * (shape[-1] - 1) * hop_length / sample_rate
+
+
+def benchmark_setting(model_path : str, config : OnnxSessionConfig, providers, args) -> dict:
+    options = apply_session_config(ort.SessionOptions(), config, ort)
+    load_start = time.perf_counter()
+    session = ort.InferenceSession(model_path, sess_options=options, providers=providers)
+    load_seconds = time.perf_counter() - load_start
+
+    feed = _input_feed(session, args.dim_t, args.batch_size)
+    for _ in range(args.warmup):
+        session.run(None, feed)
+    timings = []
+    for _ in range(args.iterations):
+        start = time.perf_counter()
+        session.run(None, feed)
+        timings.append(time.perf_counter() - start)
+
+    audio_seconds = _audio_seconds(feed, args.hop_length, args.sample_rate)
+    median = float(np.median(timings))
+    return {
+        "config": config.as_dict(),
+        "load_seconds": round(load_seconds, 4),
+        "median_run_seconds": round(median, 5),
+        "audio_seconds_per_run": round(audio_seconds, 4),
+        "real_time_factor": round(median / audio_seconds, 5),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", required=True, help="path to the .onnx separator model")
+    parser.add_argument("--levels", nargs="+", default=list(GRAPH_OPTIMIZATION_LEVELS), choices=list(GRAPH_OPTIMIZATION_LEVELS))
+    parser.add_argument("--execution-modes", nargs="+", default=list(EXECUTION_MODES), choices=list(EXECUTION_MODES))
+    parser.add_argument("--intra-op-threads", nargs="+", type=int, default=[0, 1, os.cpu_count() or 1])
+    parser.add_argument("--inter-op-threads", nargs="+", type=int, default=[0])
+    parser.add_argument("--providers", nargs="+", default=None, help="execution providers, defaults to all available")
+    parser.add_argument("--dim-t", type=int, default=256, help="spectrogram frames per run, the model segment size")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--hop-length", type=int, default=1024)
+    parser.add_argument("--sample-rate", type=int, default=44100)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--output", help="write the results as json to this path")
+    args = parser.parse_args()
+
+    providers = args.providers or ort.get_available_providers()
+    results = []
+    for level, mode, intra, inter in itertools.product(args.levels, args.execution_modes, args.intra_op_threads, args.inter_op_threads):
+        config = OnnxSessionConfig(graph_optimization_level=level, execution_mode=mode, intra_op_threads=intra,
+                                   inter_op_threads=inter, cache_optimized_graph=False)
+        result = benchmark_setting(args.model, config, providers, args)
+        results.append(result)
+        print(f"level={level:<9} mode={mode:<10} intra={intra:<3} inter={inter:<3} "
+              f"load={result['load_seconds']:.3f}s run={result['median_run_seconds']:.4f}s rtf={result['real_time_factor']:.4f}")
+
+    best = min(results, key=lambda r: r["real_time_factor"])
+    print(f"best setting : {json.dumps(best['config'])} rtf={best['real_time_factor']}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"model": args.model, "providers": providers, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,386 @@
+"""
+End-to-end benchmark of the audio pipelines for every mode, without GPUs or
+real S3. Synthetic multi-stem fixtures of several durations and formats are
+uploaded to a local S3 stand-in (moto in process, or --endpoint-url for a
+local server) and run through AudioUtiltiesServerlessPipeline.run (runpod) and
+AudioPipeline.execute_pipeline (beam) with a stub separator in place of the
+models. Per case it records wall time, the wall time of each stage, the
+overhead around inference, peak RSS and bytes moved, as json.
+
+    python -m benchmarks.pipeline_benchmark --durations 5 30 120 --formats wav flac mp3 --output results.json
+
+--separator module:Class plugs in another separator, audio_separator.separator:Separator
+runs the real models. Caches are cold for every case unless --warm-caches.
+Needs ffmpeg on the path and moto unless --endpoint-url is given.
+"""
+import os
+import sys
+sys.path.append(os.path.basename(''))
+
+import argparse
+import functools
+import importlib
+import json
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+import soundfile as sf
+
+BENCHMARK_BUCKET = "lalals"
+BENCHMARK_REGION = "us-east-1"
+FIXTURE_PREFIX = "benchmarks/fixtures"
+SAMPLE_RATE = 44100
+# formats soundfile writes itself, the others are encoded with ffmpeg
+SOUNDFILE_FORMATS = {"wav": "WAV", "flac": "FLAC", "ogg": "OGG"}
+DEFAULT_STEMS = ("vocals", "instrumental")
+# stages timed in every target, (module, owner, attribute, stage)
+COMMON_STAGES = [
+    ("utils.SilenceDetection", "SilenceSkipper", "compacted_input", "silence"),
+    ("utils.AudioSeparator", "AudioSeparator", "run_extractor", "inference"),
+    ("utils.StagePipeline", "StagePipeline", "deliver", "convert"),
+    ("utils.OutputStage", "OutputBatch", "_stream_encode", "encode_upload"),
+    ("utils.OutputStage", "OutputBatch", "_upload", "upload"),
+]
+
+
+class StubSeparator:
+    """
+    Stands in for audio_separator's Separator. Every stem is a gain scaled copy
+    of the input, so reads and writes match a real run while inference costs
+    nothing, or seconds_per_audio_second of sleep when simulating a model.
+    """
+
+    seconds_per_audio_second = 0.0
+
+    def __init__(self, output_dir : str = None, model_file_dir : str = None, output_format : str = "WAV", **kwargs):
+        self.output_dir = output_dir
+        self.output_format = output_format.lower()
+        self.model_instance = None
+        self.model_name = None
+
+    def load_model(self, model_filename : str):
+        self.model_name = model_filename
+
+    def _stems(self, custom_output_names : Optional[Dict[str, str]]) -> Tuple[str, ...]:
+        """Stems the model writes, custom names only rename them like they do in audio-separator"""
+        from AudioUtilities.Config import OUTPUT_NAME_CONFIG
+        return OUTPUT_NAME_CONFIG.get(self.model_name) or tuple(custom_output_names or DEFAULT_STEMS)
+
+    def separate(self, audio_file_path : str, custom_output_names : Optional[Dict[str, str]] = None) -> List[str]:
+        samples, sample_rate = sf.read(audio_file_path, dtype="float32", always_2d=True)
+        if self.seconds_per_audio_second:
+            time.sleep(len(samples) / sample_rate * self.seconds_per_audio_second)
+        base_name = os.path.splitext(os.path.basename(audio_file_path))[0]
+        custom_names = {stem.lower(): name for stem, name in (custom_output_names or {}).items()}
+        output_files = []
+        for index, stem in enumerate(self._stems(custom_output_names)):
+            output_name = custom_names.get(stem.lower(), f"{base_name}_({stem})_{os.path.splitext(self.model_name)[0]}")
+            output_file = f"{output_name}.{self.output_format}"
+            if output_file in output_files:
+                continue
+            sf.write(os.path.join(self.output_dir, output_file), samples * (0.5 + 0.1 * index), sample_rate, subtype="PCM_16")
+            output_files.append(output_file)
+        return output_files
+
+
+class StubSoundEffectCreator:
+    """Stands in for the ElevenLabs client, writes a synthetic clip of the requested length"""
+
+    def __init__(self, api_key = None):
+        self.api_key = api_key
+
+    def run(self, task_id, input_prompt, audio_length, prompt_strength = 0.3, out_file_path = ''):
+        out_file_path = out_file_path or f"/tmp/{task_id}.mp3"
+        mix = sum(synthesize_stems(float(audio_length or 5), SAMPLE_RATE, seed=len(input_prompt or "")).values())
+        # written as wav whatever the extension, the probes go by content
+        sf.write(out_file_path, mix, SAMPLE_RATE, format="WAV", subtype="PCM_16")
+        return out_file_path
+
+
+class StageTimer:
+    """Wall seconds and calls per stage, summed over every thread that ran it"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals : Dict[str, Dict[str, float]] = {}
+
+    def wrap(self, owner, attribute : str, stage : str):
+        original = getattr(owner, attribute, None)
+        if original is None or getattr(original, "_benchmark_stage", None):
+            return
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+
+        timed._benchmark_stage = stage
+        setattr(owner, attribute, timed)
+
+    def add(self, stage : str, seconds : float):
+        with self._lock:
+            totals = self._totals.setdefault(stage, {"seconds": 0.0, "calls": 0})
+            totals["seconds"] += seconds
+            totals["calls"] += 1
+
+    def reset(self):
+        with self._lock:
+            self._totals = {}
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {stage: {"seconds": round(totals["seconds"], 4), "calls": totals["calls"]} for stage, totals in self._totals.items()}
+
+
+def synthesize_stems(duration : float, sample_rate : int = SAMPLE_RATE, seed : int = 0, silence_seconds : float = 3.0) -> Dict[str, np.ndarray]:
+    """
+    Stereo vocals, drums, bass and other stems. Inputs of 10s and longer get a
+    silent gap in the middle so silence skipping has something to skip.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sample_rate)) / sample_rate
+    vibrato = 0.01 * np.sin(2 * np.pi * 5 * t)
+    vocals = 0.3 * np.sin(2 * np.pi * 440 * t * (1 + vibrato)) * (0.6 + 0.4 * np.sin(2 * np.pi * 0.5 * t))
+    beat = (t % 0.5) < 0.05
+    drums = 0.4 * rng.standard_normal(len(t)) * beat
+    bass = 0.3 * np.sin(2 * np.pi * 55 * t)
+    other = 0.1 * np.sin(2 * np.pi * 660 * t + rng.uniform(0, np.pi))
+    stems = {"vocals": vocals, "drums": drums, "bass": bass, "other": other}
+    if duration >= 10:
+        start = int((duration - silence_seconds) / 2 * sample_rate)
+        for samples in stems.values():
+            samples[start:start + int(silence_seconds * sample_rate)] = 0.0
+    # slightly different left and right channels
+    return {name: np.stack([samples, np.roll(samples, 17)], axis=1).astype(np.float32) for name, samples in stems.items()}
+
+
+def write_fixture(path : str, samples : np.ndarray, sample_rate : int, file_format : str):
+    if file_format in SOUNDFILE_FORMATS:
+        sf.write(path, samples, sample_rate, format=SOUNDFILE_FORMATS[file_format])
+        return
+    from utils.StreamingEncoder import FFMPEG_BINARY
+    wav_path = path + ".wav"
+    sf.write(wav_path, samples, sample_rate, subtype="FLOAT")
+    try:
+        subprocess.run([FFMPEG_BINARY, "-nostdin", "-v", "error", "-y", "-i", wav_path, path], check=True)
+    finally:
+        os.remove(wav_path)
+
+
+def make_fixtures(work_dir : str, durations : List[float], formats : List[str]) -> List[dict]:
+    fixtures = []
+    for duration in durations:
+        mix = sum(synthesize_stems(duration, seed=int(duration)).values())
+        for file_format in formats:
+            name = f"mix_{duration:g}s.{file_format}"
+            path = os.path.join(work_dir, name)
+            write_fixture(path, mix, SAMPLE_RATE, file_format)
+            fixtures.append({"name": name, "path": path, "format": file_format, "duration": duration,
+                             "bytes": os.path.getsize(path), "s3_key": f"{FIXTURE_PREFIX}/{name}"})
+    return fixtures
+
+
+def _reset_peak_rss():
+    # writing 5 to clear_refs resets VmHWM of the process (linux only)
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _bytes_moved(before : dict, after : dict) -> Dict[str, int]:
+    return {direction: int(totals["bytes"] - before.get(direction, {}).get("bytes", 0)) for direction, totals in after.items()}
+
+
+@contextmanager
+def local_s3(endpoint_url : Optional[str]):
+    """moto in process, or the S3 compatible server at endpoint_url"""
+    for name in ("aws_access_key", "AWS_ACCESS_KEY", "aws_secret_key", "AWS_SECRET_KEY"):
+        os.environ.setdefault(name, "benchmark")
+    os.environ.setdefault("AWS_REGION", BENCHMARK_REGION)
+    if endpoint_url:
+        os.environ["S3_ENDPOINT_URL"] = endpoint_url
+        yield
+        return
+    from moto import mock_aws
+    with mock_aws():
+        yield
+
+
+def _instrument(timer : StageTimer, module, owner_name : str, job_stages : Dict[str, str]):
+    """Times the common stages, the ingest and probe of the pipeline module and its job phases"""
+    for module_name, owner, attribute, stage in COMMON_STAGES:
+        timer.wrap(getattr(importlib.import_module(module_name), owner), attribute, stage)
+    timer.wrap(module, "ingest_s3_audio", "decode")
+    timer.wrap(module, "get_duration", "probe")
+    for attribute, stage in job_stages.items():
+        timer.wrap(getattr(module, owner_name), attribute, stage)
+
+
+def _use_stub_sound_effects(*modules):
+    for module in modules:
+        module.SoundEffectCreator = StubSoundEffectCreator
+
+
+def load_runpod(timer : StageTimer) -> Tuple[List[str], Callable, object]:
+    module = importlib.import_module("AudioUtilitiesPipeline")
+    _instrument(timer, module, "AudioUtiltiesServerlessPipeline",
+                {"_prepare_job": "job.ingest", "_infer_job": "job.inference", "_deliver_job": "job.delivery"})
+    _use_stub_sound_effects(module)
+    pipeline = module.AudioUtiltiesServerlessPipeline()
+
+    def run(task_id : str, mode : str, fixture : dict) -> dict:
+        arguments = {"mode": mode, "audio_path_s3": fixture["s3_key"], "prompt": "benchmark", "audio_length": fixture["duration"]}
+        return pipeline.run(task_id, arguments)
+    return list(module.valid_modes), run, pipeline.s3Helper.transfer
+
+
+def load_beam(timer : StageTimer) -> Tuple[List[str], Callable, object]:
+    module = importlib.import_module("AudioUtilities.AudioPipeline")
+    _instrument(timer, module, "AudioPipeline",
+                {"_ingest_job": "job.ingest", "_infer_job": "job.inference", "_deliver_job": "job.delivery"})
+    _use_stub_sound_effects(importlib.import_module("AudioUtilities.Processor"))
+    pipeline = module.AudioPipeline(module.AudioPipelineConfig())
+
+    def run(task_id : str, mode : str, fixture : dict) -> dict:
+        s3_key = None if mode == "sound_creator" else fixture["s3_key"]
+        return pipeline.execute_pipeline(task_id, mode, s3_key, "benchmark", fixture["duration"])
+    return list(module.ProcessingStrategyRegistry._strategies), run, pipeline.s3_helper.transfer
+
+
+TARGETS = {"runpod": load_runpod, "beam": load_beam}
+
+
+def run_case(timer : StageTimer, transfer, run : Callable, target : str, mode : str, fixture : dict, repeat : int) -> dict:
+    task_id = f"bench_{target}_{mode}_{os.path.splitext(fixture['name'])[0].replace('.', '_')}_{fixture['format']}_{repeat}"
+    timer.reset()
+    transfer_before = transfer.metrics.snapshot()
+    _reset_peak_rss()
+    error = None
+    start = time.perf_counter()
+    try:
+        response = run(task_id, mode, fixture)
+        if isinstance(response, dict) and response.get("success") is False:
+            error = response.get("error", "failed")
+    except Exception as e:
+        error = str(e)
+    wall_seconds = time.perf_counter() - start
+    stages = timer.snapshot()
+    inference_seconds = stages.get("inference", {}).get("seconds", 0.0)
+    return {
+        "target": target,
+        "mode": mode,
+        "fixture": {key: fixture[key] for key in ("name", "format", "duration", "bytes")},
+        "repeat": repeat,
+        "success": error is None,
+        "error": error,
+        "wall_seconds": round(wall_seconds, 4),
+        # everything but the models: decode, convert, probe, encode and upload
+        "overhead_seconds": round(wall_seconds - inference_seconds, 4),
+        "overhead_per_audio_second": round((wall_seconds - inference_seconds) / fixture["duration"], 5),
+        "stages": stages,
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "bytes_moved": _bytes_moved(transfer_before, transfer.metrics.snapshot()),
+    }
+
+
+def _load_class(spec : str):
+    module_name, _, attribute = spec.partition(":")
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--targets", nargs="+", default=list(TARGETS), choices=list(TARGETS))
+    parser.add_argument("--modes", nargs="+", default=None, help="modes to run, defaults to every mode of the target")
+    parser.add_argument("--durations", nargs="+", type=float, default=[5, 30, 120], help="fixture durations in seconds")
+    parser.add_argument("--formats", nargs="+", default=["wav", "flac", "mp3"], help="fixture formats, non soundfile formats need ffmpeg")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--separator", default="benchmarks.pipeline_benchmark:StubSeparator", help="separator class as module:Class")
+    parser.add_argument("--inference-rtf", type=float, default=0.0, help="seconds the stub separator sleeps per second of audio")
+    parser.add_argument("--endpoint-url", default=None, help="local S3 compatible server, defaults to moto in process")
+    parser.add_argument("--warm-caches", action="store_true", help="keep the input and stem caches between cases")
+    parser.add_argument("--output", help="write the results as json to this path")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="pipeline_benchmark_")
+    # module settings are read at import, so the environment is set before the pipelines load
+    os.environ.setdefault("INPUT_CACHE_DIR", os.path.join(work_dir, "input_cache"))
+    os.environ.setdefault("STEM_CACHE_DIR", os.path.join(work_dir, "stem_cache"))
+    if not args.warm_caches:
+        os.environ["INPUT_CACHE_ENABLED"] = "false"
+        os.environ["STEM_CACHE_ENABLED"] = "false"
+
+    results = []
+    try:
+        with local_s3(args.endpoint_url):
+            import boto3
+            from utils.S3Transfer import S3_ENDPOINT_URL
+            client = boto3.client("s3", region_name=BENCHMARK_REGION, endpoint_url=S3_ENDPOINT_URL)
+            if not args.endpoint_url:
+                client.create_bucket(Bucket=BENCHMARK_BUCKET)
+            fixtures = make_fixtures(work_dir, args.durations, args.formats)
+            for fixture in fixtures:
+                client.upload_file(fixture["path"], BENCHMARK_BUCKET, fixture["s3_key"])
+
+            separator_class = _load_class(args.separator)
+            if hasattr(separator_class, "seconds_per_audio_second"):
+                separator_class.seconds_per_audio_second = args.inference_rtf
+            importlib.import_module("utils.AudioSeparator").Separator = separator_class
+
+            timer = StageTimer()
+            for target in args.targets:
+                try:
+                    modes, run, transfer = TARGETS[target](timer)
+                except ImportError as e:
+                    print(f"{target:<7} skipped : {e}")
+                    continue
+                for mode in args.modes or modes:
+                    # generated audio does not depend on the input, one run per duration is enough
+                    mode_fixtures = [f for f in fixtures if f["format"] == args.formats[0]] if mode == "sound_creator" else fixtures
+                    for fixture in mode_fixtures:
+                        for repeat in range(args.repeat):
+                            result = run_case(timer, transfer, run, target, mode, fixture, repeat)
+                            results.append(result)
+                            print(f"{target:<7} {mode:<29} {fixture['name']:<16} wall={result['wall_seconds']:.3f}s "
+                                  f"overhead={result['overhead_seconds']:.3f}s rss={result['peak_rss_mb']:.0f}MB "
+                                  f"{'ok' if result['success'] else 'failed: ' + str(result['error'])}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "cpu_count": os.cpu_count(),
+                "separator": args.separator,
+                "inference_rtf": args.inference_rtf,
+                "warm_caches": args.warm_caches,
+                "results": results,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
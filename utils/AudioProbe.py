@@ -0,0 +1,240 @@
+import os
+import sys
+sys.path.append(os.path.basename(''))
+
+import json
+import struct
+import subprocess
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Tuple
+from utils.logger import get_logger
+from utils.exceptions import AudioProbeError
+from utils.Timings import span
+
+### Probe cache size, entries are keyed by path + mtime + size
+AUDIO_PROBE_CACHE_SIZE = int(os.environ.get("AUDIO_PROBE_CACHE_SIZE", 1024))
+FFPROBE_BINARY = os.environ.get("FFPROBE_BINARY", "ffprobe")
+# how far into an mp3 to look for the first frame, past junk and album art
+MP3_SYNC_SEARCH_BYTES = 256 * 1024
+
+logger = get_logger("AudioProbe")
+
+
+@dataclass(frozen=True)
+class AudioInfo:
+    """Stream metadata of an audio file"""
+
+    duration_seconds : float
+    channels : int
+    sample_rate : int
+    format : str
+
+
+def _skip_id3v2(f) -> int:
+    """Returns the offset of the first byte after an ID3v2 tag, 0 when there is none"""
+    f.seek(0)
+    header = f.read(10)
+    if len(header) == 10 and header[:3] == b"ID3":
+        size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+        footer = 10 if header[5] & 0x10 else 0
+        return 10 + size + footer
+    return 0
+
+
+def _probe_wav(f, file_size : int) -> Optional[AudioInfo]:
+    f.seek(0)
+    header = f.read(12)
+    if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+        return None
+    channels = sample_rate = byte_rate = None
+    while True:
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            return None
+        chunk_id, chunk_size = chunk[:4], struct.unpack("<I", chunk[4:])[0]
+        if chunk_id == b"fmt ":
+            fmt = f.read(chunk_size)
+            _, channels, sample_rate, byte_rate = struct.unpack("<HHII", fmt[:12])
+            f.seek(chunk_size % 2, os.SEEK_CUR)
+        elif chunk_id == b"data":
+            if not byte_rate:
+                return None
+            # streamed writers leave the size unset, the data then runs to the end of the file
+            data_size = min(chunk_size, file_size - f.tell())
+            return AudioInfo(data_size / byte_rate, channels, sample_rate, "wav")
+        else:
+            f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+
+def _probe_flac(f, file_size : int) -> Optional[AudioInfo]:
+    f.seek(_skip_id3v2(f))
+    if f.read(4) != b"fLaC":
+        return None
+    block_header = f.read(4)
+    # STREAMINFO is always the first metadata block
+    if len(block_header) < 4 or block_header[0] & 0x7F != 0:
+        return None
+    streaminfo = f.read(34)
+    if len(streaminfo) < 34:
+        return None
+    packed = int.from_bytes(streaminfo[10:18], "big")
+    sample_rate = packed >> 44
+    channels = ((packed >> 41) & 0x7) + 1
+    total_samples = packed & 0xFFFFFFFFF
+    if not sample_rate or not total_samples:
+        return None
+    return AudioInfo(total_samples / sample_rate, channels, sample_rate, "flac")
+
+
+_MP3_BITRATES = {
+    # (version is MPEG1, layer) -> kbps by index
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+def _parse_mp3_header(header : bytes) -> Optional[Tuple[bool, int, int, int, int]]:
+    """Returns (is_mpeg1, layer, bitrate, sample_rate, channels) of a frame header"""
+    value = int.from_bytes(header, "big")
+    if (value >> 21) & 0x7FF != 0x7FF:
+        return None
+    version_bits = (value >> 19) & 0x3
+    layer = 4 - ((value >> 17) & 0x3)
+    bitrate_index = (value >> 12) & 0xF
+    sample_rate_index = (value >> 10) & 0x3
+    if version_bits == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    is_mpeg1 = version_bits == 3
+    bitrate = _MP3_BITRATES[(is_mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version_bits][sample_rate_index]
+    channels = 1 if (value >> 6) & 0x3 == 3 else 2
+    return is_mpeg1, layer, bitrate, sample_rate, channels
+
+
+def _probe_mp3(f, file_size : int) -> Optional[AudioInfo]:
+    start = _skip_id3v2(f)
+    f.seek(start)
+    data = f.read(MP3_SYNC_SEARCH_BYTES)
+    offset = data.find(b"\xff")
+    frame = None
+    while 0 <= offset <= len(data) - 4:
+        frame = _parse_mp3_header(data[offset:offset + 4])
+        if frame is not None:
+            break
+        offset = data.find(b"\xff", offset + 1)
+    if frame is None:
+        return None
+    is_mpeg1, layer, bitrate, sample_rate, channels = frame
+    if layer == 1:
+        samples_per_frame = 384
+    elif layer == 2 or is_mpeg1:
+        samples_per_frame = 1152
+    else:
+        samples_per_frame = 576
+
+    # VBR files carry the frame count in a Xing/Info or VBRI header in the first frame
+    side_info = (32 if channels == 2 else 17) if is_mpeg1 else (17 if channels == 2 else 9)
+    xing_offset = offset + 4 + side_info
+    if data[xing_offset:xing_offset + 4] in (b"Xing", b"Info"):
+        flags = struct.unpack(">I", data[xing_offset + 4:xing_offset + 8])[0]
+        if flags & 0x1:
+            frames = struct.unpack(">I", data[xing_offset + 8:xing_offset + 12])[0]
+            samples = frames * samples_per_frame
+            # the LAME extension after the Xing fields records the encoder delay and padding
+            lame_offset = xing_offset + 8 + 4 * (flags & 0x1) + 4 * ((flags >> 1) & 0x1) + 100 * ((flags >> 2) & 0x1) + 4 * ((flags >> 3) & 0x1)
+            if data[lame_offset:lame_offset + 4] == b"LAME" and len(data) >= lame_offset + 24:
+                delay_padding = int.from_bytes(data[lame_offset + 21:lame_offset + 24], "big")
+                samples = max(0, samples - (delay_padding >> 12) - (delay_padding & 0xFFF))
+            return AudioInfo(samples / sample_rate, channels, sample_rate, "mp3")
+    vbri_offset = offset + 36
+    if data[vbri_offset:vbri_offset + 4] == b"VBRI":
+        frames = struct.unpack(">I", data[vbri_offset + 14:vbri_offset + 18])[0]
+        return AudioInfo(frames * samples_per_frame / sample_rate, channels, sample_rate, "mp3")
+
+    # CBR, estimate from the audio payload size
+    audio_bytes = file_size - start - offset
+    f.seek(max(0, file_size - 128))
+    if f.read(3) == b"TAG":
+        audio_bytes -= 128
+    return AudioInfo(audio_bytes * 8 / bitrate, channels, sample_rate, "mp3")
+
+
+_HEADER_PARSERS = {
+    ".wav": _probe_wav,
+    ".wave": _probe_wav,
+    ".flac": _probe_flac,
+    ".mp3": _probe_mp3,
+}
+
+
+def _ffprobe(file_path : str) -> AudioInfo:
+    command = [
+        FFPROBE_BINARY, "-v", "error", "-select_streams", "a:0",
+        "-show_entries", "stream=channels,sample_rate,duration:format=duration,format_name",
+        "-of", "json", file_path,
+    ]
+    try:
+        result = subprocess.run(command, capture_output=True, check=True, text=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise AudioProbeError(f"ffprobe failed for {file_path}: {e}") from e
+    output = json.loads(result.stdout or "{}")
+    streams = output.get("streams") or [{}]
+    stream, container = streams[0], output.get("format", {})
+    duration = stream.get("duration") or container.get("duration")
+    if duration is None:
+        raise AudioProbeError(f"ffprobe found no audio duration in {file_path}")
+    return AudioInfo(
+        float(duration), int(stream.get("channels", 0)), int(stream.get("sample_rate", 0)),
+        container.get("format_name", "").split(",")[0]
+    )
+
+
+def _probe_uncached(file_path : str, file_size : int) -> AudioInfo:
+    parser = _HEADER_PARSERS.get(os.path.splitext(file_path)[1].lower())
+    if parser is not None:
+        try:
+            with open(file_path, "rb") as f:
+                info = parser(f, file_size)
+            if info is not None:
+                return info
+        except (OSError, struct.error) as e:
+            logger.debug("Header parse failed for %s: %s", file_path, e)
+    logger.debug("Falling back to ffprobe for %s", file_path)
+    return _ffprobe(file_path)
+
+
+_probe_cache : "OrderedDict[tuple, AudioInfo]" = OrderedDict()
+_probe_cache_lock = threading.Lock()
+
+
+def probe_audio(file_path : str) -> AudioInfo:
+    """
+    Returns duration, channels and sample rate of an audio file, read from the
+    WAV/FLAC/MP3 headers where possible and from ffprobe otherwise. Results are
+    memoized per path, mtime and size, so rewritten files are probed again.
+    """
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+    with _probe_cache_lock:
+        info = _probe_cache.get(key)
+        if info is not None:
+            _probe_cache.move_to_end(key)
+            return info
+    with span("probe"):
+        info = _probe_uncached(file_path, stat.st_size)
+    with _probe_cache_lock:
+        _probe_cache[key] = info
+        while len(_probe_cache) > AUDIO_PROBE_CACHE_SIZE:
+            _probe_cache.popitem(last=False)
+    return info
+
+
+def get_duration(file_path : str) -> float:
+    return probe_audio(file_path).duration_seconds
@@ -1,21 +1,85 @@
-from audio_separator.separator import Separator
+import os
+import copy
+import threading
+from contextlib import contextmanager
+from functools import partial
 from utils.logger import get_logger
+from utils.Timings import span
+from utils.ModelCache import get_model_cache
+from utils.OnnxSession import OnnxSessionConfig, onnx_session_overrides
+from utils.ChunkedSeparation import ChunkedSeparation, SEPARATOR_CHUNK_OVERLAP_SECONDS
+from utils.ParallelSeparation import SeparatorProcessPool, resolve_execution_mode, SEPARATOR_EXECUTION_MODE, SEPARATOR_POOL_CHUNK_SECONDS
 from pydantic import GetCoreSchemaHandler
 from pydantic_core import core_schema
-from typing import List
+from typing import List, Optional
+
+# audio_separator pulls in torch and librosa, the first model load imports it.
+# A class assigned here beforehand, e.g. a benchmark stub, is used instead
+Separator = None
+
+DEFAULT_QUALITY = os.environ.get("SEPARATOR_DEFAULT_QUALITY", "best")
+
+# Separator param profiles per quality tier, one set of params per architecture.
+# "best" is what every job ran with before tiers existed.
+QUALITY_PROFILES = {
+    "fast": {
+        "mdx": {"hop_length": 1024, "segment_size": 256, "overlap": 0.1, "batch_size": 1, "enable_denoise": False},
+        "vr": {"batch_size": 1, "window_size": 512, "aggression": 5, "enable_tta": False, "enable_post_process": False, "post_process_threshold": 0.2, "high_end_process": False},
+        "demucs": {"segment_size": "Default", "shifts": 1, "overlap": 0.25, "segments_enabled": True},
+        "mdxc": {"segment_size": 256, "override_model_segment_size": False, "batch_size": 1, "overlap": 2, "pitch_shift": 0},
+    },
+    "balanced": {
+        "mdx": {"hop_length": 1024, "segment_size": 256, "overlap": 0.25, "batch_size": 1, "enable_denoise": False},
+        "vr": {"batch_size": 1, "window_size": 1024, "aggression": 5, "enable_tta": False, "enable_post_process": True, "post_process_threshold": 0.2, "high_end_process": False},
+        "demucs": {"segment_size": "Default", "shifts": 2, "overlap": 0.5, "segments_enabled": True},
+        "mdxc": {"segment_size": 256, "override_model_segment_size": False, "batch_size": 1, "overlap": 8, "pitch_shift": 0},
+    },
+    "best": {
+        "mdx": {"hop_length": 1024, "segment_size": 256, "overlap": 0.25, "batch_size": 1, "enable_denoise": False},
+        "vr": {"batch_size": 1, "window_size": 1024, "aggression": 5, "enable_tta": True, "enable_post_process": True, "post_process_threshold": 0.2, "high_end_process": False},
+        "demucs": {"segment_size": "Default", "shifts": 4, "overlap": 0.9, "segments_enabled": True},
+        "mdxc": {"segment_size": 512, "override_model_segment_size": True, "batch_size": 1, "overlap": 25, "pitch_shift": 0},
+    },
+}
+
+
+def _separator_class():
+    global Separator
+    if Separator is None:
+        from audio_separator.separator import Separator as separator_class
+        Separator = separator_class
+    return Separator
+
+
+def resolve_quality(quality : Optional[str]) -> str:
+    """ Returns the quality tier to use, falling back to the default tier """
+    quality = (quality or DEFAULT_QUALITY).lower()
+    if quality not in QUALITY_PROFILES:
+        raise ValueError(f"Invalid quality tier: {quality}, expected one of {list(QUALITY_PROFILES)}")
+    return quality
+
 
 class AudioSeparator():
-    def __init__(self, output_dir = "/tmp/outputs", model_file_dir = "/runpod-volume/audio-separator-models", output_format = "WAV") -> None:
+    def __init__(self, output_dir = "/tmp/outputs", model_file_dir = "/runpod-volume/audio-separator-models", output_format = "WAV", execution_mode = SEPARATOR_EXECUTION_MODE, onnx_session_config : Optional[OnnxSessionConfig] = None) -> None:
         try:
             self.logger = get_logger("AudioSeparator")
 
-            mdx_params={"hop_length": 1024, "segment_size": 256, "overlap": 0.25, "batch_size": 1, "enable_denoise": False}
-            vr_params={"batch_size": 1, "window_size": 1024, "aggression": 5, "enable_tta": True, "enable_post_process": True, "post_process_threshold": 0.2, "high_end_process": False}
-            demucs_params={"segment_size": "Default", "shifts": 4, "overlap": 0.9, "segments_enabled": True}
-            mdxc_params={"segment_size": 512, "override_model_segment_size": True, "batch_size": 1, "overlap": 25, "pitch_shift": 0}
-            self.separator = Separator(output_dir=output_dir, model_file_dir=model_file_dir, output_format = output_format, mdx_params=mdx_params, vr_params=vr_params, demucs_params=demucs_params, mdxc_params=mdxc_params )
-
-            # self.separator = Separator(output_dir=output_dir, model_file_dir=model_file_dir, output_format=output_format)
+            self.output_dir = output_dir
+            self.model_file_dir = model_file_dir
+            self.output_format = output_format
+            self.onnx_session_config = onnx_session_config or OnnxSessionConfig.from_env()
+            # loaded separators are shared through the process wide model cache
+            self.model_cache = get_model_cache()
+            # long inputs are separated in overlapping windows to bound peak memory
+            self.chunker = ChunkedSeparation(output_dir)
+            self.execution_mode = resolve_execution_mode(execution_mode)
+            self.process_pool = None
+            if self.execution_mode == "process_pool":
+                # fixed size chunks fanned out to worker processes, each with its own loaded model
+                self.process_pool = SeparatorProcessPool(output_dir, model_file_dir, output_format, onnx_session_config=self.onnx_session_config)
+                self.pool_chunker = ChunkedSeparation(output_dir, SEPARATOR_POOL_CHUNK_SECONDS, SEPARATOR_CHUNK_OVERLAP_SECONDS)
+            # (model name, quality) set by load_model, the separator itself stays in the model cache
+            self.loaded_model = None
             self.logger.info("Audio Separator Initialized Successfully")
         except Exception as e:
             self.logger.error(e)
@@ -27,25 +91,98 @@ class AudioSeparator():
     ) -> core_schema.CoreSchema:
         return core_schema.is_instance_schema(cls)
 
-    def load_model(self, model_name : str):
+    def _create_separator(self, quality : str) -> "Separator":
+        profile = QUALITY_PROFILES[quality]
+        return _separator_class()(output_dir=self.output_dir, model_file_dir=self.model_file_dir, output_format=self.output_format, mdx_params=dict(profile["mdx"]), vr_params=dict(profile["vr"]), demucs_params=dict(profile["demucs"]), mdxc_params=dict(profile["mdxc"]))
+
+    def _load_separator(self, model_name : str, quality : str) -> "Separator":
+        separator = self._create_separator(quality)
+        # .onnx models get the tuned session options and the optimized graph cache
+        with span(f"model_load/{model_name}"), onnx_session_overrides(self.onnx_session_config):
+            separator.load_model(model_name)
+        # a loaded separator keeps per run state, concurrent jobs on the same model take turns
+        separator.run_lock = threading.Lock()
+        return separator
+
+    def _bind_output_dir(self, separator : "Separator"):
+        """ Cached separators may be shared between pipelines, point them at this instance's output dir """
+        separator.output_dir = self.output_dir
+        if separator.model_instance is not None:
+            separator.model_instance.output_dir = self.output_dir
+
+    def with_output_dir(self, output_dir : str) -> "AudioSeparator":
+        """ Returns a view of this separator writing to output_dir, sharing the model cache and process pool """
+        view = copy.copy(self)
+        view.output_dir = output_dir
+        view.chunker = ChunkedSeparation(output_dir, self.chunker.chunk_seconds, self.chunker.overlap_seconds)
+        if self.process_pool is not None:
+            view.pool_chunker = ChunkedSeparation(output_dir, self.pool_chunker.chunk_seconds, self.pool_chunker.overlap_seconds)
+        view.loaded_model = None
+        return view
+
+    @contextmanager
+    def use_separator(self, model_name : str, quality : Optional[str] = None):
+        """
+        Yields a separator with the given model loaded at the given quality tier,
+        from the model cache when possible. It is pinned in the cache and held
+        by this run for the block, with its output dir bound to this instance.
+        """
+        quality = resolve_quality(quality)
+        key = (model_name, quality)
+        with self.model_cache.checkout(key, model_name, partial(self._load_separator, model_name, quality)) as separator:
+            with separator.run_lock:
+                self._bind_output_dir(separator)
+                yield separator
+
+    def param_signature(self, quality : Optional[str] = None) -> dict:
+        """ Everything about this separator's settings that changes its output """
+        quality = resolve_quality(quality)
+        return {
+            "quality": quality,
+            "output_format": self.output_format,
+            **QUALITY_PROFILES[quality],
+        }
+
+    def cache_stats(self) -> dict:
+        return self.model_cache.stats()
+
+    def load_model(self, model_name : str, quality : Optional[str] = None):
         try:
-            self.separator.load_model(model_name)
+            quality = resolve_quality(quality)
+            # loads the model now, later runs get it back from the cache
+            with self.use_separator(model_name, quality):
+                pass
+            self.loaded_model = (model_name, quality)
         except Exception as e:
             self.logger.error(e)
             raise e 
     
     def run(self, file_path : str, custom_output_names = None):
         try:
-            out_filepaths = self.separator.separate(file_path, custom_output_names=custom_output_names)
+            if self.loaded_model is None:
+                raise ValueError("No model loaded, call load_model first")
+            with self.use_separator(*self.loaded_model) as separator:
+                out_filepaths = separator.separate(file_path, custom_output_names=custom_output_names)
             return out_filepaths
         except Exception as e:
             self.logger.error(e)
             raise e
 
-    def run_extractor(self, model_name : str, file_path : str, custom_output_names = None) -> List[str]:
+    def _separate_chunks(self, separator : "Separator", chunks):
+        """ Separates chunks one after the other on the already loaded separator """
+        for chunk_path, chunk_output_names in chunks:
+            yield separator.separate(chunk_path, custom_output_names=chunk_output_names)
+
+    def run_extractor(self, model_name : str, file_path : str, custom_output_names = None, quality : Optional[str] = None) -> List[str]:
         try:
-            self.load_model(model_name)
-            out_filepaths = self.separator.separate(file_path, custom_output_names=custom_output_names)
+            if self.process_pool is not None and self.pool_chunker.should_chunk(file_path, self.output_format):
+                with span(f"inference/{model_name}"):
+                    return self.pool_chunker.run(file_path, custom_output_names, partial(self.process_pool.separate_chunks, model_name, quality, output_dir=self.output_dir))
+            # cached separators are shared between jobs, the output dir is bound for this run only
+            with self.use_separator(model_name, quality) as separator, span(f"inference/{model_name}"):
+                if self.chunker.should_chunk(file_path, self.output_format):
+                    return self.chunker.run(file_path, custom_output_names, partial(self._separate_chunks, separator))
+                out_filepaths = separator.separate(file_path, custom_output_names=custom_output_names)
             return out_filepaths
         except Exception as e:
             self.logger.error(e)
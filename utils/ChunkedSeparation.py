@@ -0,0 +1,186 @@
+import os
+import sys
+sys.path.append(os.path.basename(''))
+
+import shutil
+import tempfile
+import numpy as np
+import soundfile as sf
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from utils.logger import get_logger
+
+### Chunking configuration, inputs longer than one chunk are separated window by window
+SEPARATOR_CHUNK_SECONDS = float(os.environ.get("SEPARATOR_CHUNK_SECONDS", 300))
+SEPARATOR_CHUNK_OVERLAP_SECONDS = float(os.environ.get("SEPARATOR_CHUNK_OVERLAP_SECONDS", 2))
+
+CHUNK_MARKER = "__chunk"
+STITCHABLE_FORMATS = ("wav", "flac")
+
+
+def plan_windows(total_frames : int, chunk_frames : int, overlap_frames : int) -> List[Tuple[int, int]]:
+    """
+    Splits [0, total_frames) into windows of chunk_frames, each overlapping the
+    previous one by overlap_frames. The last window ends at total_frames.
+    """
+    if chunk_frames <= overlap_frames:
+        raise ValueError("Chunk length must be greater than the overlap")
+    step = chunk_frames - overlap_frames
+    windows = []
+    start = 0
+    while True:
+        stop = min(start + chunk_frames, total_frames)
+        windows.append((start, stop))
+        if stop >= total_frames:
+            break
+        start += step
+    return windows
+
+
+class CrossfadeStitcher:
+    """
+    Streams overlapping chunks of one stem into a single file. The last
+    `overlap` frames of each chunk are held back and linearly crossfaded with
+    the head of the next chunk, so only one overlap region is ever in memory.
+    """
+
+    def __init__(self, path : str, overlap_seconds : float):
+        self.path = path
+        self.overlap_seconds = overlap_seconds
+        self._file = None
+        self._tail = None
+        self._overlap_frames = 0
+
+    @property
+    def sample_rate(self) -> Optional[int]:
+        return self._file.samplerate if self._file is not None else None
+
+    @property
+    def channels(self) -> Optional[int]:
+        return self._file.channels if self._file is not None else None
+
+    def _open(self, sample_rate : int, channels : int, subtype : Optional[str]):
+        self._overlap_frames = int(round(self.overlap_seconds * sample_rate))
+        self._file = sf.SoundFile(self.path, mode="w", samplerate=sample_rate, channels=channels, subtype=subtype)
+
+    def add(self, samples : np.ndarray, sample_rate : int, is_last : bool, subtype : Optional[str] = None):
+        """Adds the next chunk, samples shaped (frames, channels)"""
+        if self._file is None:
+            self._open(sample_rate, samples.shape[1], subtype)
+
+        if self._tail is not None:
+            n = min(len(self._tail), len(samples))
+            fade_in = ((np.arange(n, dtype=np.float32) + 0.5) / max(n, 1))[:, None]
+            self._file.write(self._tail[:n] * (1.0 - fade_in) + samples[:n] * fade_in)
+            samples = samples[n:]
+            self._tail = None
+
+        if is_last or self._overlap_frames == 0:
+            self._file.write(samples)
+            return
+        split = max(len(samples) - self._overlap_frames, 0)
+        self._file.write(samples[:split])
+        self._tail = np.array(samples[split:], copy=True)
+
+    def close(self):
+        if self._file is None:
+            return
+        if self._tail is not None:
+            self._file.write(self._tail)
+            self._tail = None
+        self._file.close()
+        self._file = None
+
+
+class ChunkedSeparation:
+    """
+    Runs a separation over overlapping windows of the input so peak memory
+    depends on the chunk length, not the track length. Chunk outputs are
+    stitched back into the same file names an unchunked run would produce.
+    """
+
+    def __init__(self, output_dir : str, chunk_seconds : float = SEPARATOR_CHUNK_SECONDS, overlap_seconds : float = SEPARATOR_CHUNK_OVERLAP_SECONDS):
+        self.logger = get_logger("ChunkedSeparation")
+        self.output_dir = output_dir
+        self.chunk_seconds = chunk_seconds
+        self.overlap_seconds = overlap_seconds
+
+    def should_chunk(self, file_path : str, output_format : str = "wav") -> bool:
+        """Only inputs longer than one chunk, readable by soundfile and written to a stitchable format are chunked"""
+        if self.chunk_seconds <= 0 or output_format.lower() not in STITCHABLE_FORMATS:
+            return False
+        try:
+            duration = sf.info(file_path).duration
+        except RuntimeError:
+            return False
+        return duration > self.chunk_seconds + self.overlap_seconds
+
+    def _chunk_output_names(self, custom_output_names : Optional[Dict[str, str]], index : int) -> Optional[Dict[str, str]]:
+        if not custom_output_names:
+            return None
+        return {stem: f"{name}{CHUNK_MARKER}{index}" for stem, name in custom_output_names.items()}
+
+    def _chunk_path(self, file_path : str, work_dir : str, index : int) -> str:
+        base = os.path.splitext(os.path.basename(file_path))[0]
+        return os.path.join(work_dir, f"{base}{CHUNK_MARKER}{index}.wav")
+
+    def iter_chunk_files(self, file_path : str, work_dir : str, windows : List[Tuple[int, int]],
+                         custom_output_names : Optional[Dict[str, str]]) -> Iterator[Tuple[str, Optional[Dict[str, str]]]]:
+        """Yields (chunk path, chunk output names), each chunk is written just before it is consumed"""
+        with sf.SoundFile(file_path) as source:
+            for index, (start, stop) in enumerate(windows):
+                source.seek(start)
+                samples = source.read(stop - start, dtype="float32", always_2d=True)
+                chunk_path = self._chunk_path(file_path, work_dir, index)
+                sf.write(chunk_path, samples, source.samplerate, subtype="FLOAT")
+                del samples
+                yield chunk_path, self._chunk_output_names(custom_output_names, index)
+
+    def run(self, file_path : str, custom_output_names : Optional[Dict[str, str]],
+            separate_chunks : Callable[[Iterable[Tuple[str, Optional[Dict[str, str]]]]], Iterable[List[str]]]) -> List[str]:
+        """
+        Separates file_path chunk by chunk. `separate_chunks` consumes
+        (chunk path, output names) pairs and yields, in chunk order, the output
+        file names relative to output_dir for each chunk.
+        """
+        info = sf.info(file_path)
+        chunk_frames = int(self.chunk_seconds * info.samplerate)
+        overlap_frames = int(self.overlap_seconds * info.samplerate)
+        windows = plan_windows(info.frames, chunk_frames, overlap_frames)
+        self.logger.info(f"Separating {file_path} in {len(windows)} chunks of {self.chunk_seconds}s")
+
+        work_dir = tempfile.mkdtemp(prefix="chunks_")
+        stitchers : Dict[str, CrossfadeStitcher] = {}
+        try:
+            chunks = self.iter_chunk_files(file_path, work_dir, windows, custom_output_names)
+            for index, output_files in enumerate(separate_chunks(chunks)):
+                is_last = index == len(windows) - 1
+                start, stop = windows[index]
+                self._stitch_chunk(output_files, index, is_last, (stop - start) / info.samplerate, stitchers)
+                os.remove(self._chunk_path(file_path, work_dir, index))
+        finally:
+            for stitcher in stitchers.values():
+                stitcher.close()
+            shutil.rmtree(work_dir, ignore_errors=True)
+        return list(stitchers.keys())
+
+    def _stitch_chunk(self, output_files : List[str], index : int, is_last : bool, chunk_seconds : float, stitchers : Dict[str, CrossfadeStitcher]):
+        marker = f"{CHUNK_MARKER}{index}"
+        for output_file in output_files:
+            final_name = output_file.replace(marker, "")
+            chunk_path = os.path.join(self.output_dir, output_file)
+            stitcher = stitchers.get(final_name)
+            if stitcher is None:
+                stitcher = CrossfadeStitcher(os.path.join(self.output_dir, final_name), self.overlap_seconds)
+                stitchers[final_name] = stitcher
+
+            if os.path.isfile(chunk_path):
+                subtype = sf.info(chunk_path).subtype
+                samples, sample_rate = sf.read(chunk_path, dtype="float32", always_2d=True)
+                os.remove(chunk_path)
+            else:
+                # separators skip writing near silent stems, keep the timeline intact
+                sample_rate = stitcher.sample_rate or 44100
+                channels = stitcher.channels or 2
+                samples = np.zeros((int(round(chunk_seconds * sample_rate)), channels), dtype=np.float32)
+                subtype = None
+            stitcher.add(samples, sample_rate, is_last, subtype)
@@ -0,0 +1,148 @@
+import os
+import sys
+sys.path.append(os.path.basename(''))
+
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional, Tuple
+from utils.logger import get_logger
+
+### Bounds of the jobs a worker takes at once, CONCURRENCY_MODIFIER is where it starts
+CONCURRENCY_MODIFIER = int(os.environ.get("CONCURRENCY_MODIFIER", 3))
+CONCURRENCY_MIN = int(os.environ.get("CONCURRENCY_MIN", 1))
+CONCURRENCY_MAX = int(os.environ.get("CONCURRENCY_MAX", 8))
+### Memory one job needs, a step up must leave room for one more job on top of the reserve
+CONCURRENCY_JOB_MEMORY_MB = int(os.environ.get("CONCURRENCY_JOB_MEMORY_MB", 2048))
+CONCURRENCY_MEMORY_RESERVE_MB = int(os.environ.get("CONCURRENCY_MEMORY_RESERVE_MB", 1024))
+### 1 minute load average per cpu above which it steps down, below LOW it may step up
+CONCURRENCY_MAX_LOAD = float(os.environ.get("CONCURRENCY_MAX_LOAD", 1.0))
+CONCURRENCY_LOW_LOAD = float(os.environ.get("CONCURRENCY_LOW_LOAD", 0.7))
+### Error rate and latency growth over the recent jobs that make it step down
+CONCURRENCY_MAX_ERROR_RATE = float(os.environ.get("CONCURRENCY_MAX_ERROR_RATE", 0.2))
+CONCURRENCY_LATENCY_RATIO = float(os.environ.get("CONCURRENCY_LATENCY_RATIO", 1.5))
+CONCURRENCY_WINDOW = int(os.environ.get("CONCURRENCY_WINDOW", 20))
+# seconds between two changes, memory pressure steps down without waiting
+CONCURRENCY_COOLDOWN_SECONDS = float(os.environ.get("CONCURRENCY_COOLDOWN_SECONDS", 30))
+
+# weight of a new job in the long running latency baseline
+LATENCY_BASELINE_ALPHA = 0.05
+CGROUP_MEMORY_MAX = "/sys/fs/cgroup/memory.max"
+CGROUP_MEMORY_CURRENT = "/sys/fs/cgroup/memory.current"
+
+
+def available_memory_mb() -> Optional[float]:
+    """MemAvailable of the host, capped by the container's cgroup limit, None if unknown"""
+    available = None
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) / 1024
+                    break
+    except OSError:
+        pass
+    try:
+        with open(CGROUP_MEMORY_MAX) as memory_max, open(CGROUP_MEMORY_CURRENT) as memory_current:
+            limit = memory_max.read().strip()
+            if limit != "max":
+                cgroup_available = (int(limit) - int(memory_current.read().strip())) / (1024 * 1024)
+                available = cgroup_available if available is None else min(available, cgroup_available)
+    except (OSError, ValueError):
+        pass
+    return available
+
+
+def load_per_cpu() -> Optional[float]:
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except OSError:
+        return None
+
+
+class ConcurrencyController:
+    """
+    Picks the runpod concurrency from live signals: free memory, cpu load and
+    the latency and error rate of recent jobs. Any pressure steps it down by
+    one, stepping up needs every signal clearly below its limit, so it does
+    not flap around a threshold. Changes are spaced by a cooldown and kept
+    within min/max. Every decision is logged with its reason.
+    """
+
+    def __init__(self, name : str, initial : int = CONCURRENCY_MODIFIER, minimum : int = CONCURRENCY_MIN,
+                 maximum : int = CONCURRENCY_MAX, job_memory_mb : int = CONCURRENCY_JOB_MEMORY_MB):
+        self.logger = get_logger(f"ConcurrencyController.{name}")
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.job_memory_mb = job_memory_mb
+        self.concurrency = min(max(initial, self.minimum), self.maximum)
+        self._jobs = deque(maxlen=max(1, CONCURRENCY_WINDOW))
+        self._baseline_latency : Optional[float] = None
+        self._last_change = 0.0
+        self._lock = threading.Lock()
+
+    def record_job(self, seconds : float, succeeded : bool = True):
+        """Feeds the latency and outcome of a finished job"""
+        with self._lock:
+            self._jobs.append((seconds, succeeded))
+            if succeeded:
+                if self._baseline_latency is None:
+                    self._baseline_latency = seconds
+                else:
+                    self._baseline_latency += LATENCY_BASELINE_ALPHA * (seconds - self._baseline_latency)
+
+    def signals(self) -> Dict[str, Optional[float]]:
+        with self._lock:
+            jobs = list(self._jobs)
+            baseline = self._baseline_latency
+        latencies = [seconds for seconds, succeeded in jobs if succeeded]
+        recent_latency = sum(latencies) / len(latencies) if latencies else None
+        return {
+            "available_memory_mb": available_memory_mb(),
+            "load_per_cpu": load_per_cpu(),
+            "error_rate": sum(1 for _, succeeded in jobs if not succeeded) / len(jobs) if jobs else 0.0,
+            "latency_ratio": recent_latency / baseline if recent_latency is not None and baseline else None,
+            "recent_jobs": len(jobs),
+        }
+
+    def _decide(self, signals : dict) -> Tuple[int, str, bool]:
+        """Returns (step, reason, urgent), urgent steps ignore the cooldown"""
+        memory = signals["available_memory_mb"]
+        load = signals["load_per_cpu"]
+        latency_ratio = signals["latency_ratio"]
+        if memory is not None and memory < CONCURRENCY_MEMORY_RESERVE_MB:
+            return -1, f"available memory {memory:.0f}MB below the {CONCURRENCY_MEMORY_RESERVE_MB}MB reserve", True
+        if load is not None and load > CONCURRENCY_MAX_LOAD:
+            return -1, f"load per cpu {load:.2f} above {CONCURRENCY_MAX_LOAD}", False
+        if signals["error_rate"] > CONCURRENCY_MAX_ERROR_RATE:
+            return -1, f"error rate {signals['error_rate']:.2f} above {CONCURRENCY_MAX_ERROR_RATE}", False
+        if latency_ratio is not None and latency_ratio > CONCURRENCY_LATENCY_RATIO:
+            return -1, f"recent job latency {latency_ratio:.2f}x the baseline", False
+        if memory is not None and memory < CONCURRENCY_MEMORY_RESERVE_MB + self.job_memory_mb:
+            return 0, f"available memory {memory:.0f}MB leaves no room for another job", False
+        if load is not None and load > CONCURRENCY_LOW_LOAD:
+            return 0, f"load per cpu {load:.2f} between {CONCURRENCY_LOW_LOAD} and {CONCURRENCY_MAX_LOAD}", False
+        if signals["error_rate"] > CONCURRENCY_MAX_ERROR_RATE / 2:
+            return 0, f"error rate {signals['error_rate']:.2f} not yet low enough to grow", False
+        if latency_ratio is not None and latency_ratio > (1 + CONCURRENCY_LATENCY_RATIO) / 2:
+            return 0, f"recent job latency {latency_ratio:.2f}x the baseline not yet low enough to grow", False
+        if signals["recent_jobs"] < self.concurrency:
+            return 0, f"{signals['recent_jobs']} jobs finished at this concurrency, too few to grow", False
+        return 1, "memory, load, errors and latency all have headroom", False
+
+    def adjust(self, current_concurrency : int) -> int:
+        """runpod concurrency_modifier, returns the concurrency to run with"""
+        signals = self.signals()
+        step, reason, urgent = self._decide(signals)
+        with self._lock:
+            now = time.monotonic()
+            target = min(max(self.concurrency + step, self.minimum), self.maximum)
+            if target != self.concurrency and (urgent or now - self._last_change >= CONCURRENCY_COOLDOWN_SECONDS):
+                self.logger.info(f"Concurrency {self.concurrency} -> {target} : {reason} {signals}")
+                self.concurrency = target
+                self._last_change = now
+                # latencies measured at the old concurrency say little about the new one
+                self._jobs.clear()
+            else:
+                self.logger.debug("Concurrency stays at %s (runpod at %s) : %s", self.concurrency, current_concurrency, reason)
+            return self.concurrency
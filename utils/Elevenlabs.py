@@ -1,11 +1,11 @@
-from elevenlabs.client import ElevenLabs
-from elevenlabs import save
 from utils.logger import get_logger
 
 class SoundEffectCreator:
     def __init__(self, api_key):
         try:
             self.logger = get_logger("SoundEffectCreator")
+            # only sound creator jobs need the client, separation workers never import it
+            from elevenlabs.client import ElevenLabs
             self.client = ElevenLabs(
                 api_key = api_key
             )
@@ -25,6 +25,7 @@ class SoundEffectCreator:
                 duration_seconds=audio_length, 
                 prompt_influence=prompt_strength
             )
+            from elevenlabs import save
             save(resp, out_file_path)
             return out_file_path
         except Exception as e:
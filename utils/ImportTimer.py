@@ -0,0 +1,150 @@
+import os
+import sys
+sys.path.append(os.path.basename(''))
+
+import argparse
+import importlib
+import threading
+import time
+from typing import Dict, List, Optional
+from utils.logger import get_logger
+
+### Seconds from an entry point's first import until it is ready for jobs, startup warns past it
+STARTUP_BUDGET_SECONDS = float(os.environ.get("STARTUP_BUDGET_SECONDS", 5))
+# modules listed in the startup report, slowest first
+STARTUP_REPORT_TOP = int(os.environ.get("STARTUP_REPORT_TOP", 20))
+STARTUP_IMPORT_TIMING = os.environ.get("STARTUP_IMPORT_TIMING", "true").lower() in ("1", "true", "yes")
+
+
+class ImportTimer:
+    """
+    Times every module executed while installed, like python -X importtime
+    but inside the process, so the report can be logged at startup. A meta
+    path finder lets the regular finders resolve the module and times the
+    exec_module of the loader it got. Cumulative time includes the imports
+    a module makes, self time does not.
+    """
+
+    def __init__(self, enabled : bool = STARTUP_IMPORT_TIMING, budget_seconds : float = STARTUP_BUDGET_SECONDS):
+        self.logger = get_logger("ImportTimer")
+        self.enabled = enabled
+        self.budget_seconds = budget_seconds
+        self.started_at : Optional[float] = None
+        self.finished_at : Optional[float] = None
+        # module -> (cumulative seconds, self seconds)
+        self.modules : Dict[str, List[float]] = {}
+        self._stack = threading.local()
+        self._lock = threading.Lock()
+
+    def install(self):
+        if not self.enabled or self in sys.meta_path:
+            return
+        self.started_at = time.perf_counter()
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+            self.finished_at = time.perf_counter()
+
+    def find_spec(self, fullname, path, target = None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is None:
+                continue
+            loader = spec.loader
+            # builtin and frozen importers are shared classes, their modules cost nothing to time
+            if loader is not None and not isinstance(loader, type) and hasattr(loader, "exec_module"):
+                try:
+                    loader.exec_module = self._timed(fullname, loader.exec_module)
+                except AttributeError:
+                    pass
+            return spec
+        return None
+
+    def _timed(self, fullname : str, exec_module):
+        loader = exec_module.__self__
+
+        def timed_exec(module):
+            # the loader is left as it was found once the module ran
+            try:
+                del loader.exec_module
+            except AttributeError:
+                pass
+            stack = self._stack.__dict__.setdefault("frames", [])
+            stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                exec_module(module)
+            finally:
+                cumulative = time.perf_counter() - start
+                nested = stack.pop()
+                if stack:
+                    stack[-1] += cumulative
+                with self._lock:
+                    self.modules[fullname] = [cumulative, cumulative - nested]
+
+        return timed_exec
+
+    def total_seconds(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.perf_counter()) - self.started_at
+
+    def report(self, top : int = STARTUP_REPORT_TOP) -> dict:
+        """
+        Startup wall time so far, the part of it spent importing and the
+        slowest modules by self time, with their cumulative time
+        """
+        with self._lock:
+            modules = sorted(self.modules.items(), key=lambda item: item[1][1], reverse=True)
+        return {
+            "total_seconds": round(self.total_seconds(), 4),
+            "import_seconds": round(sum(self_seconds for _, (_, self_seconds) in modules), 4),
+            "budget_seconds": self.budget_seconds,
+            "modules_imported": len(modules),
+            "slowest": [{"module": name, "self_seconds": round(self_seconds, 4), "cumulative_seconds": round(cumulative, 4)}
+                        for name, (cumulative, self_seconds) in modules[:top]],
+        }
+
+    def log_report(self, entry_point : str) -> bool:
+        """
+        Stops timing and logs the report once the entry point is ready, returns
+        False and warns when its startup went over the budget
+        """
+        self.uninstall()
+        if self.started_at is None:
+            return True
+        report = self.report()
+        self.logger.info("startup_imports", extra={"fields": {"event": "startup_imports", "entry_point": entry_point, **report}})
+        within_budget = report["total_seconds"] <= self.budget_seconds
+        if not within_budget:
+            self.logger.warning("Startup of %s took %.2fs, %.2fs of it importing, over the %.2fs budget", entry_point,
+                                report["total_seconds"], report["import_seconds"], self.budget_seconds)
+        return within_budget
+
+
+import_timer = ImportTimer()
+
+
+def main():
+    """
+    Imports an entry point module and exits non zero when its imports go over
+    the startup budget, one entry point per process so shared imports count for each
+    """
+    parser = argparse.ArgumentParser(description="Import time report of an entry point")
+    parser.add_argument("module", help="entry point module, e.g. AudioUtilitiesPipeline")
+    parser.add_argument("--budget", type=float, default=STARTUP_BUDGET_SECONDS, help="seconds the imports may take")
+    args = parser.parse_args()
+    # entry points install the timer of utils.ImportTimer, not the one of this __main__ module
+    from utils.ImportTimer import import_timer as timer
+    timer.enabled, timer.budget_seconds = True, args.budget
+    timer.install()
+    importlib.import_module(args.module)
+    sys.exit(0 if timer.log_report(args.module) else 1)
+
+
+if __name__ == "__main__":
+    main()
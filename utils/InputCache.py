@@ -0,0 +1,234 @@
+import os
+import sys
+sys.path.append(os.path.basename(''))
+
+import fcntl
+import hashlib
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+from utils.logger import get_logger
+from utils.S3Transfer import S3Transfer
+
+### Read-through disk cache of S3 inputs, shared by every worker process on the host
+INPUT_CACHE_ENABLED = os.environ.get("INPUT_CACHE_ENABLED", "true").lower() == "true"
+INPUT_CACHE_DIR = os.environ.get("INPUT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "input_cache"))
+INPUT_CACHE_MAX_MB = int(os.environ.get("INPUT_CACHE_MAX_MB", 4096))
+
+TMP_SUFFIX = ".tmp"
+LOCK_SUFFIX = ".lock"
+EVICTION_LOCK = ".eviction.lock"
+
+
+@contextmanager
+def _flock(lock_path : str, blocking : bool = True):
+    """
+    Exclusive lock between processes, released when the block exits. Yields
+    False instead of waiting when not blocking and the lock is held. Eviction
+    unlinks lock files it holds, a lock taken on an unlinked file is retaken.
+    """
+    while True:
+        with open(lock_path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                current = os.stat(lock_path).st_ino
+            except FileNotFoundError:
+                current = None
+            if current != os.fstat(lock_file.fileno()).st_ino:
+                continue
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return
+
+
+class TeeWriter:
+    """Writes every chunk to the sink and to the cache file, for download_fileobj"""
+
+    def __init__(self, sink, cache_file):
+        self.sink = sink
+        self.cache_file = cache_file
+
+    def write(self, data : bytes) -> int:
+        self.cache_file.write(data)
+        return self.sink.write(data)
+
+    def seekable(self) -> bool:
+        return False
+
+
+class S3InputCache:
+    """
+    Size capped, LRU evicted disk cache of S3 objects keyed by bucket, key and
+    ETag, so a re-uploaded key is never served stale. Entries are written to
+    a temp file and renamed into place, readers only ever see complete files.
+    Downloads of the same entry are serialized with a file lock, eviction runs
+    under a cache wide lock, so worker processes can share one directory.
+    Callers get a hard link to the entry, which stays readable when the entry
+    is evicted, and eviction skips entries whose lock is held.
+    """
+
+    def __init__(self, transfer : S3Transfer, cache_dir : str = INPUT_CACHE_DIR, max_bytes : int = INPUT_CACHE_MAX_MB * 1024 * 1024):
+        self.logger = get_logger("S3InputCache")
+        self.transfer = transfer
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_path(self, bucket_name : str, s3_key : str, etag : str) -> str:
+        digest = hashlib.sha256(f"{bucket_name}/{s3_key}/{etag}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest + os.path.splitext(s3_key)[1].lower())
+
+    def _link(self, entry_path : str, output_path : str) -> bool:
+        """
+        Hard links the entry to output_path, copying it when they are on
+        different filesystems, and marks it recently used. Returns False when
+        there is no entry.
+        """
+        if os.path.lexists(output_path):
+            os.remove(output_path)
+        try:
+            os.link(entry_path, output_path)
+        except FileNotFoundError:
+            return False
+        except OSError:
+            try:
+                source = open(entry_path, "rb")
+            except FileNotFoundError:
+                return False
+            # the open file stays readable if the entry is evicted while copying
+            with source, open(output_path, "wb") as target:
+                shutil.copyfileobj(source, target)
+        try:
+            # the mtime is the LRU clock
+            os.utime(entry_path)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def lookup(self, bucket_name : str, s3_key : str, output_path : str) -> Tuple[Optional[str], str]:
+        """Links a cached object to output_path, returns (output_path or None on a miss, current ETag of the object)"""
+        etag = self.transfer.head(bucket_name, s3_key)["ETag"]
+        if self._link(self._entry_path(bucket_name, s3_key, etag), output_path):
+            self.logger.debug("Input cache hit for s3://%s/%s", bucket_name, s3_key)
+            return output_path, etag
+        return None, etag
+
+    @contextmanager
+    def writer(self, bucket_name : str, s3_key : str, etag : str):
+        """
+        Yields a file to write the object into, it becomes the cache entry when
+        the block succeeds and is discarded when it raises. Callers hold the
+        download_lock of the entry.
+        """
+        entry_path = self._entry_path(bucket_name, s3_key, etag)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=os.path.basename(entry_path), suffix=TMP_SUFFIX)
+        try:
+            with os.fdopen(fd, "wb") as cache_file:
+                yield cache_file
+            os.replace(tmp_path, entry_path)
+        except BaseException:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict(keep=entry_path)
+
+    @contextmanager
+    def download_lock(self, bucket_name : str, s3_key : str, etag : str, output_path : str):
+        """
+        Holds the entry lock for a download into the cache, so processes on the
+        same object download it once. Yields output_path linked to the entry
+        when another process cached it while we waited, else None.
+        """
+        entry_path = self._entry_path(bucket_name, s3_key, etag)
+        with _flock(entry_path + LOCK_SUFFIX):
+            yield output_path if self._link(entry_path, output_path) else None
+
+    def fetch(self, bucket_name : str, s3_key : str, output_path : str) -> str:
+        """Links the object to output_path, downloading it into the cache on a miss, returns output_path"""
+        cached_path, etag = self.lookup(bucket_name, s3_key, output_path)
+        if cached_path is not None:
+            return cached_path
+        entry_path = self._entry_path(bucket_name, s3_key, etag)
+        with self.download_lock(bucket_name, s3_key, etag, output_path) as cached_path:
+            if cached_path is not None:
+                return cached_path
+            with self.writer(bucket_name, s3_key, etag) as cache_file:
+                self.transfer.download_fileobj(bucket_name, s3_key, cache_file)
+            # eviction skips the entry while its lock is held
+            if not self._link(entry_path, output_path):
+                raise FileNotFoundError(f"Input cache entry {entry_path} disappeared after its download")
+        return output_path
+
+    def evict(self, keep : Optional[str] = None):
+        """
+        Drops the least recently used entries until the cache fits max_bytes,
+        keep is never dropped. Entries and lock files are only removed while
+        their lock is taken here, a download in progress keeps its entry.
+        """
+        with _flock(os.path.join(self.cache_dir, EVICTION_LOCK)):
+            entries = []
+            lock_paths = []
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith(LOCK_SUFFIX) and not entry.name.startswith("."):
+                    lock_paths.append(entry.path)
+                    continue
+                if entry.name.startswith(".") or entry.name.endswith(TMP_SUFFIX) or entry.path == keep:
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries) + (os.path.getsize(keep) if keep and os.path.isfile(keep) else 0)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                # readers hold hard links to the entry, they keep reading the unlinked file
+                if self._remove_locked(path):
+                    total -= size
+                    self.logger.debug("Evicted %s from the input cache", path)
+            # locks left by downloads that failed
+            for lock_path in lock_paths:
+                entry_path = lock_path[:-len(LOCK_SUFFIX)]
+                if entry_path != keep and not os.path.exists(entry_path):
+                    self._remove_locked(None, lock_path)
+
+    def _remove_locked(self, entry_path : Optional[str], lock_path : Optional[str] = None) -> bool:
+        """Removes the entry and its lock file if the lock is free, returns False when it is held"""
+        lock_path = lock_path or entry_path + LOCK_SUFFIX
+        with _flock(lock_path, blocking=False) as locked:
+            if not locked:
+                return False
+            for path in (entry_path, lock_path):
+                if path is None:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        return True
+
+
+_input_caches : Dict[Tuple, S3InputCache] = {}
+_input_caches_lock = threading.Lock()
+
+
+def get_input_cache(transfer : S3Transfer, cache_dir : str = INPUT_CACHE_DIR) -> Optional[S3InputCache]:
+    """Input cache of the process, None when INPUT_CACHE_ENABLED is off"""
+    if not INPUT_CACHE_ENABLED:
+        return None
+    key = (id(transfer), cache_dir)
+    with _input_caches_lock:
+        input_cache = _input_caches.get(key)
+        if input_cache is None:
+            input_cache = S3InputCache(transfer, cache_dir)
+            _input_caches[key] = input_cache
+        return input_cache
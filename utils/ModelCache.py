@@ -0,0 +1,222 @@
+import os
+import sys
+sys.path.append(os.path.basename(''))
+
+import gc
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Callable, Dict, Hashable, Optional
+from utils.logger import get_logger
+
+### Model cache budget, shared by RAM and VRAM resident models
+MODEL_CACHE_BUDGET_MB = int(os.environ.get("MODEL_CACHE_BUDGET_MB", 6144))
+MODEL_CACHE_DEFAULT_MODEL_MB = int(os.environ.get("MODEL_CACHE_DEFAULT_MODEL_MB", 1024))
+
+
+class _CacheEntry:
+    __slots__ = ("separator", "size_bytes", "users")
+
+    def __init__(self, separator, size_bytes : int):
+        self.separator = separator
+        self.size_bytes = size_bytes
+        # runs holding the separator, an entry is only evicted while this is 0
+        self.users = 0
+
+
+class SeparatorModelCache:
+    """
+    LRU cache of loaded separator models, bounded by a memory budget.
+
+    Entries are keyed by (model name, param profile) and hold a Separator
+    with that model already loaded, so repeated runs skip load_model.
+    Separators are handed out pinned by checkout, eviction only drops idle
+    entries, so a model is never released under a running separation. Loads
+    run outside the cache lock, concurrent requests for the same key wait
+    for the one load.
+    """
+
+    def __init__(self, budget_bytes : int = MODEL_CACHE_BUDGET_MB * 1024 * 1024):
+        self.logger = get_logger("SeparatorModelCache")
+        self.budget_bytes = budget_bytes
+        self._entries : "OrderedDict[Hashable, _CacheEntry]" = OrderedDict()
+        self._loading : Dict[Hashable, Future] = {}
+        # loads started so far, a load only trusts its VRAM delta when no other load overlapped it
+        self._loads_started = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def used_bytes(self) -> int:
+        return sum(entry.size_bytes for entry in self._entries.values())
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the hit/miss/eviction counters and current occupancy"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "in_use": sum(1 for entry in self._entries.values() if entry.users),
+                "used_bytes": self.used_bytes,
+                "budget_bytes": self.budget_bytes,
+            }
+
+    def _acquire(self, key : Hashable, model_name : str, factory : Callable[[], object]) -> _CacheEntry:
+        """Returns the entry of key pinned, loading it on a miss"""
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    entry.users += 1
+                    self.hits += 1
+                    self.logger.debug("Model cache hit for %s", key)
+                    return entry
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = Future()
+                    loaded_alone = not self._loading
+                    self._loading[key] = loading
+                    self._loads_started += 1
+                    load_number = self._loads_started
+                    self.misses += 1
+                    break
+            # another job is loading this model, its entry is picked up on the next pass
+            loading.result()
+
+        self.logger.debug("Model cache miss for %s, loading %s", key, model_name)
+        try:
+            gpu_before = _gpu_allocated_bytes()
+            separator = factory()
+            gpu_delta = _gpu_allocated_bytes() - gpu_before
+            with self._lock:
+                if not loaded_alone or self._loads_started != load_number:
+                    # the delta includes what the other loads allocated, the checkpoint size is used instead
+                    gpu_delta = 0
+            size_bytes = self._estimate_size(separator, model_name, gpu_delta)
+        except BaseException as e:
+            with self._lock:
+                self._loading.pop(key, None)
+            loading.set_exception(e)
+            raise
+        with self._lock:
+            entry = _CacheEntry(separator, size_bytes)
+            entry.users = 1
+            self._entries[key] = entry
+            self._loading.pop(key, None)
+            self._evict_over_budget()
+            self.logger.info(f"Model cache stats : {self.stats()}")
+        loading.set_result(None)
+        return entry
+
+    def _unpin(self, entry : _CacheEntry):
+        with self._lock:
+            entry.users -= 1
+            if entry.users == 0:
+                # pinned entries may have kept the cache over budget
+                self._evict_over_budget()
+
+    @contextmanager
+    def checkout(self, key : Hashable, model_name : str, factory : Callable[[], object]):
+        """
+        Yields a separator with `model_name` loaded for the given key, pinned
+        for the block. On a miss, `factory` builds a Separator with the model
+        loaded, which is then measured and inserted, evicting idle least
+        recently used entries if the budget is exceeded.
+        """
+        entry = self._acquire(key, model_name, factory)
+        try:
+            yield entry.separator
+        finally:
+            self._unpin(entry)
+
+    def evict(self, key : Hashable) -> bool:
+        """Drops a single idle entry, returns True if it was dropped"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.users:
+                return False
+            self._entries.pop(key)
+            self._release(key, entry)
+            return True
+
+    def clear(self):
+        """Drops every idle entry"""
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if not entry.users]:
+                self._release(key, self._entries.pop(key))
+
+    def _evict_over_budget(self):
+        # least recently used first, entries in use are skipped and evicted once idle
+        for key in list(self._entries):
+            if self.used_bytes <= self.budget_bytes or len(self._entries) <= 1:
+                break
+            entry = self._entries[key]
+            if entry.users:
+                continue
+            self._entries.pop(key)
+            self._release(key, entry)
+
+    def _release(self, key : Hashable, entry : _CacheEntry):
+        self.evictions += 1
+        self.logger.info(f"Evicting model {key} from cache ({entry.size_bytes} bytes)")
+        model_instance = getattr(entry.separator, "model_instance", None)
+        if model_instance is not None:
+            try:
+                model_instance.clear_gpu_cache()
+            except Exception as e:
+                self.logger.error(e)
+        entry.separator.model_instance = None
+        entry.separator = None
+        gc.collect()
+        _empty_gpu_cache()
+
+    def _estimate_size(self, separator, model_name : str, gpu_delta : int) -> int:
+        """
+        Uses the measured VRAM delta when the model landed on a GPU,
+        otherwise the checkpoint size on disk as a proxy for its RAM footprint
+        """
+        if gpu_delta > 0:
+            return gpu_delta
+        model_path = os.path.join(getattr(separator, "model_file_dir", ""), model_name)
+        if os.path.isfile(model_path) and os.path.getsize(model_path) > 1024 * 1024:
+            return os.path.getsize(model_path)
+        # yaml configs (demucs, mdxc) point to weights stored under other names
+        return MODEL_CACHE_DEFAULT_MODEL_MB * 1024 * 1024
+
+
+def _gpu_allocated_bytes() -> int:
+    torch = sys.modules.get("torch")
+    try:
+        if torch is not None and torch.cuda.is_available():
+            return torch.cuda.memory_allocated()
+    except Exception:
+        pass
+    return 0
+
+
+def _empty_gpu_cache():
+    torch = sys.modules.get("torch")
+    try:
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except Exception:
+        pass
+
+
+_model_cache : Optional[SeparatorModelCache] = None
+_model_cache_lock = threading.Lock()
+
+
+def get_model_cache() -> SeparatorModelCache:
+    """Returns the process wide model cache"""
+    global _model_cache
+    with _model_cache_lock:
+        if _model_cache is None:
+            _model_cache = SeparatorModelCache()
+        return _model_cache
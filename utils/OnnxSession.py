@@ -0,0 +1,140 @@
+import os
+import sys
+sys.path.append(os.path.basename(''))
+
+import threading
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from typing import Optional
+from utils.logger import get_logger
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": "ORT_DISABLE_ALL",
+    "basic": "ORT_ENABLE_BASIC",
+    "extended": "ORT_ENABLE_EXTENDED",
+    "all": "ORT_ENABLE_ALL",
+}
+EXECUTION_MODES = {
+    "sequential": "ORT_SEQUENTIAL",
+    "parallel": "ORT_PARALLEL",
+}
+OPTIMIZED_GRAPH_SUFFIX = ".ort_optimized.onnx"
+
+logger = get_logger("OnnxSession")
+
+# InferenceSession is patched module wide while a model loads, one load at a time
+_patch_lock = threading.Lock()
+
+
+def _env_flag(name : str, default : str) -> bool:
+    return os.environ.get(name, default).lower() in ("1", "true", "yes")
+
+
+@dataclass(frozen=True)
+class OnnxSessionConfig:
+    """ONNX Runtime session settings applied to every .onnx separator model"""
+
+    graph_optimization_level : str = "all"
+    intra_op_threads : int = 0
+    inter_op_threads : int = 0
+    execution_mode : str = "sequential"
+    enable_cpu_mem_arena : bool = True
+    enable_mem_pattern : bool = True
+    cache_optimized_graph : bool = True
+
+    def __post_init__(self):
+        if self.graph_optimization_level not in GRAPH_OPTIMIZATION_LEVELS:
+            raise ValueError(f"Invalid onnx graph optimization level: {self.graph_optimization_level}")
+        if self.execution_mode not in EXECUTION_MODES:
+            raise ValueError(f"Invalid onnx execution mode: {self.execution_mode}")
+
+    @classmethod
+    def from_env(cls) -> "OnnxSessionConfig":
+        return cls(
+            graph_optimization_level=os.environ.get("ONNX_GRAPH_OPTIMIZATION_LEVEL", "all").lower(),
+            intra_op_threads=int(os.environ.get("ONNX_INTRA_OP_THREADS", 0)),
+            inter_op_threads=int(os.environ.get("ONNX_INTER_OP_THREADS", 0)),
+            execution_mode=os.environ.get("ONNX_EXECUTION_MODE", "sequential").lower(),
+            enable_cpu_mem_arena=_env_flag("ONNX_ENABLE_CPU_MEM_ARENA", "true"),
+            enable_mem_pattern=_env_flag("ONNX_ENABLE_MEM_PATTERN", "true"),
+            cache_optimized_graph=_env_flag("ONNX_CACHE_OPTIMIZED_GRAPH", "true"),
+        )
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+def apply_session_config(options, config : OnnxSessionConfig, ort):
+    """Applies config onto an existing ort.SessionOptions, keeping fields the caller already set"""
+    options.graph_optimization_level = getattr(ort.GraphOptimizationLevel, GRAPH_OPTIMIZATION_LEVELS[config.graph_optimization_level])
+    options.execution_mode = getattr(ort.ExecutionMode, EXECUTION_MODES[config.execution_mode])
+    # 0 lets onnxruntime pick the thread count
+    options.intra_op_num_threads = config.intra_op_threads
+    options.inter_op_num_threads = config.inter_op_threads
+    options.enable_cpu_mem_arena = config.enable_cpu_mem_arena
+    options.enable_mem_pattern = config.enable_mem_pattern
+    return options
+
+
+def optimized_graph_path(model_path : str, config : OnnxSessionConfig, providers) -> str:
+    """
+    Path of the pre-optimized graph stored next to the model. Optimizations at
+    the 'all' level can be provider specific, so the provider is part of the name.
+    """
+    provider = "cpu"
+    if providers:
+        first = providers[0]
+        provider = (first[0] if isinstance(first, (tuple, list)) else first).replace("ExecutionProvider", "").lower()
+    base = os.path.splitext(model_path)[0]
+    return f"{base}.{config.graph_optimization_level}.{provider}{OPTIMIZED_GRAPH_SUFFIX}"
+
+
+@contextmanager
+def onnx_session_overrides(config : Optional[OnnxSessionConfig]):
+    """
+    Applies the session config to every InferenceSession created inside the
+    block, which is where audio-separator builds sessions for .onnx models.
+    With cache_optimized_graph, the first load saves the optimized graph next
+    to the model and later cold starts load that file without re-optimizing.
+    """
+    if config is None:
+        yield
+        return
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        yield
+        return
+
+    with _patch_lock:
+        original_session = ort.InferenceSession
+
+        def configured_session(path_or_bytes, sess_options=None, providers=None, provider_options=None, **kwargs):
+            options = apply_session_config(sess_options or ort.SessionOptions(), config, ort)
+            if not (config.cache_optimized_graph and isinstance(path_or_bytes, str)):
+                return original_session(path_or_bytes, sess_options=options, providers=providers, provider_options=provider_options, **kwargs)
+
+            optimized_path = optimized_graph_path(path_or_bytes, config, providers)
+            if os.path.isfile(optimized_path):
+                logger.debug("Loading pre-optimized onnx graph %s", optimized_path)
+                options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+                return original_session(optimized_path, sess_options=options, providers=providers, provider_options=provider_options, **kwargs)
+
+            # write to a temporary name, concurrent workers may optimize the same model
+            tmp_path = f"{optimized_path}.{uuid.uuid4().hex}.tmp"
+            options.optimized_model_filepath = tmp_path
+            session = original_session(path_or_bytes, sess_options=options, providers=providers, provider_options=provider_options, **kwargs)
+            try:
+                if os.path.isfile(tmp_path):
+                    os.replace(tmp_path, optimized_path)
+                    logger.info(f"Saved optimized onnx graph to {optimized_path}")
+            except OSError as e:
+                logger.error(f"Could not save optimized onnx graph: {e}")
+            return session
+
+        ort.InferenceSession = configured_session
+        try:
+            yield
+        finally:
+            ort.InferenceSession = original_session
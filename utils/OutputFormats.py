@@ -0,0 +1,62 @@
+import os
+import sys
+sys.path.append(os.path.basename(''))
+
+import re
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Union
+
+SUPPORTED_OUTPUT_FORMATS = ("wav", "flac", "mp3", "opus")
+LOSSY_OUTPUT_FORMATS = ("mp3", "opus")
+BITRATE_PATTERN = re.compile(r"^\d{1,3}k$")
+
+
+@dataclass(frozen=True)
+class OutputFormat:
+    """One rung of the output ladder, the bitrate only applies to lossy formats"""
+
+    name : str
+    bitrate : Optional[str] = None
+
+    def __post_init__(self):
+        if self.name not in SUPPORTED_OUTPUT_FORMATS:
+            raise ValueError(f"Invalid output format: {self.name}, expected one of {SUPPORTED_OUTPUT_FORMATS}")
+        if self.bitrate is not None:
+            if self.name not in LOSSY_OUTPUT_FORMATS:
+                raise ValueError(f"Output format {self.name} is lossless and takes no bitrate")
+            if not BITRATE_PATTERN.match(self.bitrate):
+                raise ValueError(f"Invalid bitrate: {self.bitrate}, expected e.g. 192k")
+
+    def encoder_args(self) -> List[str]:
+        return ["-b:a", self.bitrate] if self.bitrate else []
+
+    def __str__(self) -> str:
+        return f"{self.name}:{self.bitrate}" if self.bitrate else self.name
+
+
+def parse_output_formats(spec : Union[None, str, Sequence], default : Sequence[str]) -> List[OutputFormat]:
+    """
+    Parses the output_formats request argument. Entries are "mp3", "mp3:192k"
+    or {"format": "mp3", "bitrate": "192k"}. The first entry is the primary
+    output of each stem. Falls back to default when nothing is requested.
+    """
+    if not spec:
+        spec = default
+    if isinstance(spec, str):
+        spec = [spec]
+    formats = []
+    for entry in spec:
+        if isinstance(entry, dict):
+            output_format = OutputFormat(str(entry.get("format", "")).lower(), entry.get("bitrate"))
+        else:
+            name, _, bitrate = str(entry).lower().partition(":")
+            output_format = OutputFormat(name, bitrate or None)
+        if output_format.name in (f.name for f in formats):
+            raise ValueError(f"Output format {output_format.name} requested twice")
+        formats.append(output_format)
+    return formats
+
+
+def format_signature(formats : Sequence[OutputFormat]) -> List[str]:
+    """Stable description of the ladder, part of the result cache key"""
+    return [str(f) for f in formats]
@@ -0,0 +1,110 @@
+import os
+import sys
+sys.path.append(os.path.basename(''))
+
+import contextvars
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Dict, List, Tuple
+from utils.logger import get_logger
+from utils.exceptions import OutputUploadError
+from utils.StreamingEncoder import stream_encode_to_s3
+from utils.OutputFormats import OutputFormat
+from utils.Profiling import run_profiled
+
+### Encode and upload threads shared by all jobs of a pipeline
+OUTPUT_STAGE_WORKERS = int(os.environ.get("OUTPUT_STAGE_WORKERS", 8))
+
+
+class OutputStage:
+    """
+    Bounded thread pool that encodes and uploads job outputs concurrently.
+    All uploads go through the helper's process wide S3Transfer, whose client
+    is thread safe, so the connection pool is shared instead of one per upload.
+    """
+
+    def __init__(self, s3_helper, bucket_name : str, max_workers : int = OUTPUT_STAGE_WORKERS):
+        self.logger = get_logger("OutputStage")
+        self.s3_helper = s3_helper
+        self.bucket_name = bucket_name
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="OutputStage")
+
+    def batch(self) -> "OutputBatch":
+        """Starts the output tasks of one job"""
+        return OutputBatch(self)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+class OutputBatch:
+    """Output tasks of one job, waited on together with their errors aggregated"""
+
+    def __init__(self, stage : OutputStage):
+        self.stage = stage
+        self._futures : List[Tuple[str, str, Future]] = []
+        self._uploaded_files : Dict[str, str] = {}
+        self._lock = threading.Lock()
+        # primary s3 key of each delivered stem -> its key per output format
+        self.delivered : Dict[str, Dict[str, str]] = {}
+        self.bytes_by_format : Dict[str, int] = {}
+
+    def _submit(self, s3_key : str, output_format : str, fn, *args) -> Future:
+        # runs in the job's context, so its timings and profile count towards the job
+        future = self.stage._executor.submit(contextvars.copy_context().run, run_profiled, fn, *args)
+        self._futures.append((s3_key, output_format, future))
+        return future
+
+    def _upload(self, file_path : str, s3_key : str) -> int:
+        self.stage.s3_helper.upload_file(file_path, s3_key, self.stage.bucket_name)
+        with self._lock:
+            self._uploaded_files[s3_key] = file_path
+        return os.path.getsize(file_path)
+
+    def _stream_encode(self, file_path : str, s3_key : str, output_format : str, extra_args : List[str]) -> int:
+        return stream_encode_to_s3(self.stage.s3_helper.transfer, file_path, self.stage.bucket_name, s3_key, output_format, extra_args)
+
+    def upload(self, file_path : str, s3_key : str) -> Future:
+        return self._submit(s3_key, os.path.splitext(s3_key)[1].lstrip(".").lower(), self._upload, file_path, s3_key)
+
+    def stream_encode(self, file_path : str, s3_key : str, output_format : str, extra_args : List[str] = None) -> Future:
+        """Encodes file_path to output_format straight into the upload, no encoded file on disk"""
+        return self._submit(s3_key, output_format, self._stream_encode, file_path, s3_key, output_format, extra_args or [])
+
+    def deliver(self, file_path : str, s3_key_base : str, output_formats : List[OutputFormat]) -> Dict[str, str]:
+        """
+        Queues one upload per requested format of a stem, s3_key_base gets the
+        format extension. A stem already in a requested format without a bitrate
+        is uploaded as is, every other format is stream encoded.
+        Returns the s3 key per format, the first format is the primary one.
+        """
+        source_format = os.path.splitext(file_path)[1].lstrip(".").lower()
+        keys = {}
+        for output_format in output_formats:
+            s3_key = f"{s3_key_base}.{output_format.name}"
+            if output_format.name == source_format and not output_format.bitrate:
+                self.upload(file_path, s3_key)
+            else:
+                self.stream_encode(file_path, s3_key, output_format.name, output_format.encoder_args())
+            keys[output_format.name] = s3_key
+        self.delivered[next(iter(keys.values()))] = keys
+        return keys
+
+    def wait(self) -> Dict[str, str]:
+        """
+        Blocks until every task finished, returns the uploaded s3 keys mapped to
+        their local files, streamed outputs have none. Raises OutputUploadError
+        listing every failed task.
+        """
+        wait([future for _, _, future in self._futures])
+        errors = [(s3_key, future.exception()) for s3_key, _, future in self._futures if future.exception() is not None]
+        if errors:
+            for s3_key, error in errors:
+                self.stage.logger.error(f"Output task for {s3_key} failed : {error}")
+            raise OutputUploadError(
+                f"{len(errors)} of {len(self._futures)} output uploads failed: " + ", ".join(s3_key for s3_key, _ in errors),
+                errors=errors
+            )
+        for _, output_format, future in self._futures:
+            self.bytes_by_format[output_format] = self.bytes_by_format.get(output_format, 0) + future.result()
+        return dict(self._uploaded_files)
@@ -0,0 +1,118 @@
+import os
+import sys
+sys.path.append(os.path.basename(''))
+
+import atexit
+import multiprocessing
+import threading
+from collections import deque
+from dataclasses import replace
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from utils.logger import get_logger
+
+### Process pool execution, meant for CPU only nodes
+# inline: separate in this process, process_pool: fan chunks out to worker processes,
+# auto: process_pool when no CUDA device is visible
+SEPARATOR_EXECUTION_MODE = os.environ.get("SEPARATOR_EXECUTION_MODE", "inline").lower()
+SEPARATOR_THREADS_PER_WORKER = int(os.environ.get("SEPARATOR_THREADS_PER_WORKER", 2))
+SEPARATOR_POOL_WORKERS = int(os.environ.get("SEPARATOR_POOL_WORKERS", max(1, (os.cpu_count() or 1) // SEPARATOR_THREADS_PER_WORKER)))
+SEPARATOR_POOL_CHUNK_SECONDS = float(os.environ.get("SEPARATOR_POOL_CHUNK_SECONDS", 30))
+
+EXECUTION_MODES = ("inline", "process_pool", "auto")
+
+# set in each worker process by _init_worker
+_worker_separator = None
+
+
+def resolve_execution_mode(mode : str = SEPARATOR_EXECUTION_MODE) -> str:
+    """Returns inline or process_pool, resolving auto against the visible devices"""
+    if mode not in EXECUTION_MODES:
+        raise ValueError(f"Invalid separator execution mode: {mode}, expected one of {EXECUTION_MODES}")
+    if mode != "auto":
+        return mode
+    try:
+        import torch
+        return "inline" if torch.cuda.is_available() else "process_pool"
+    except ImportError:
+        return "process_pool"
+
+
+def _init_worker(output_dir : str, model_file_dir : str, output_format : str, threads : int, onnx_session_config):
+    """Pins the thread pools of the worker so workers x threads does not oversubscribe the cores"""
+    global _worker_separator
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(threads)
+    try:
+        import torch
+        torch.set_num_threads(threads)
+        torch.set_num_interop_threads(1)
+    except (ImportError, RuntimeError):
+        pass
+    from utils.AudioSeparator import AudioSeparator
+    if onnx_session_config is not None and onnx_session_config.intra_op_threads == 0:
+        onnx_session_config = replace(onnx_session_config, intra_op_threads=threads)
+    _worker_separator = AudioSeparator(output_dir=output_dir, model_file_dir=model_file_dir, output_format=output_format,
+                                       execution_mode="inline", onnx_session_config=onnx_session_config)
+
+
+def _separate_chunk(model_name : str, quality : Optional[str], chunk_path : str, output_names : Optional[Dict[str, str]],
+                    output_dir : Optional[str] = None) -> List[str]:
+    # each worker keeps its loaded models in its own model cache
+    worker_separator = _worker_separator.with_output_dir(output_dir) if output_dir else _worker_separator
+    with worker_separator.use_separator(model_name, quality) as separator:
+        return separator.separate(chunk_path, custom_output_names=output_names)
+
+
+class SeparatorProcessPool:
+    """
+    Pool of worker processes, each holding its own loaded separator models.
+    Chunks are submitted with a bounded number in flight and their results are
+    yielded in submission order, so the parent can stitch them as they finish.
+    """
+
+    def __init__(self, output_dir : str, model_file_dir : str, output_format : str,
+                 workers : int = SEPARATOR_POOL_WORKERS, threads_per_worker : int = SEPARATOR_THREADS_PER_WORKER,
+                 onnx_session_config = None):
+        self.logger = get_logger("SeparatorProcessPool")
+        self.output_dir = output_dir
+        self.model_file_dir = model_file_dir
+        self.output_format = output_format
+        self.workers = max(1, workers)
+        self.threads_per_worker = max(1, threads_per_worker)
+        self.onnx_session_config = onnx_session_config
+        self._executor : Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self.logger.info(f"Starting separator process pool with {self.workers} workers x {self.threads_per_worker} threads")
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    # spawn avoids forking a parent that already holds torch/CUDA state
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.output_dir, self.model_file_dir, self.output_format, self.threads_per_worker, self.onnx_session_config),
+                )
+                atexit.register(self.shutdown)
+            return self._executor
+
+    def separate_chunks(self, model_name : str, quality : Optional[str],
+                        chunks : Iterable[Tuple[str, Optional[Dict[str, str]]]], output_dir : Optional[str] = None) -> Iterator[List[str]]:
+        """Chunk outputs are written to output_dir, the pool's output dir by default"""
+        executor = self._get_executor()
+        max_in_flight = self.workers * 2
+        in_flight = deque()
+        for chunk_path, output_names in chunks:
+            in_flight.append(executor.submit(_separate_chunk, model_name, quality, chunk_path, output_names, output_dir))
+            if len(in_flight) >= max_in_flight:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+                self._executor = None
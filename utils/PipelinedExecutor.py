@@ -0,0 +1,173 @@
+import os
+import sys
+sys.path.append(os.path.basename(''))
+
+import contextvars
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional
+from utils.logger import get_logger
+from utils.Timings import record as record_timing
+from utils.Profiling import run_profiled
+
+### Workers per stage and the depth of the queues between them
+PIPELINE_INGEST_WORKERS = int(os.environ.get("PIPELINE_INGEST_WORKERS", 4))
+PIPELINE_DELIVERY_WORKERS = int(os.environ.get("PIPELINE_DELIVERY_WORKERS", 4))
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 2))
+### Jobs on the models at once, 0 sizes it from the device
+INFERENCE_CONCURRENCY = int(os.environ.get("INFERENCE_CONCURRENCY", 0))
+# VRAM one job needs with its models loaded, used when sizing from a GPU
+INFERENCE_JOB_MEMORY_GB = float(os.environ.get("INFERENCE_JOB_MEMORY_GB", 8))
+
+_STOP = object()
+
+
+def inference_slots() -> int:
+    """Concurrent inference jobs the device fits, a CPU box runs one job across all cores"""
+    if INFERENCE_CONCURRENCY > 0:
+        return INFERENCE_CONCURRENCY
+    try:
+        import torch
+        if torch.cuda.is_available():
+            total_gb = torch.cuda.get_device_properties(0).total_memory / (1024 ** 3)
+            return max(1, int(total_gb // INFERENCE_JOB_MEMORY_GB))
+    except Exception:
+        pass
+    return 1
+
+
+class _Stage:
+    """Worker threads of one stage reading from its input queue"""
+
+    def __init__(self, name : str, fn : Callable, workers : int, input_queue : queue.Queue):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.queue = input_queue
+        self.busy = 0
+        self.busy_seconds = 0.0
+        self.processed = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.threads : List[threading.Thread] = []
+
+
+class PipelinedExecutor:
+    """
+    Runs jobs through an ingest, an inference and a delivery stage, each with
+    its own worker threads. Stages are connected by bounded queues, so job N+1
+    downloads and job N-1 uploads while job N is on the model, and a slow
+    stage holds back the one before it instead of piling up decoded inputs.
+
+    ingest(*args) returns the job handed to the next stages, infer(job) runs
+    the models and deliver(job) returns the result of the job's future. Jobs
+    for which skip_inference(job) is true go straight to delivery. cleanup(*args)
+    runs once every job finished, whether it succeeded or not.
+    """
+
+    def __init__(self, name : str, ingest : Callable, infer : Callable, deliver : Callable,
+                 inference_workers : int = 1, ingest_workers : int = PIPELINE_INGEST_WORKERS,
+                 delivery_workers : int = PIPELINE_DELIVERY_WORKERS, queue_size : int = PIPELINE_QUEUE_SIZE,
+                 skip_inference : Optional[Callable] = None, cleanup : Optional[Callable] = None):
+        self.logger = get_logger(f"PipelinedExecutor.{name}")
+        self.name = name
+        self.skip_inference = skip_inference
+        self.cleanup = cleanup
+        self.started_at = time.monotonic()
+        # submissions are never refused, only the queues between stages are bounded
+        self._stages : Dict[str, _Stage] = {
+            "ingest": _Stage("ingest", ingest, ingest_workers, queue.Queue()),
+            "inference": _Stage("inference", infer, inference_workers, queue.Queue(maxsize=max(1, queue_size))),
+            "delivery": _Stage("delivery", deliver, delivery_workers, queue.Queue(maxsize=max(1, queue_size))),
+        }
+        for stage in self._stages.values():
+            for index in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(stage,), name=f"{name}-{stage.name}-{index}", daemon=True)
+                thread.start()
+                stage.threads.append(thread)
+
+    def submit(self, *args) -> Future:
+        """
+        Queues a job, the future resolves to what the delivery stage returned.
+        Every stage of the job runs in a copy of the caller's context, under
+        the caller's job profile if it has one.
+        """
+        future = Future()
+        future.set_running_or_notify_cancel()
+        self._stages["ingest"].queue.put((future, args, args, contextvars.copy_context(), time.perf_counter()))
+        return future
+
+    def _next_stage(self, stage : _Stage, job) -> Optional[_Stage]:
+        if stage.name == "ingest":
+            if self.skip_inference is not None and self.skip_inference(job):
+                return self._stages["delivery"]
+            return self._stages["inference"]
+        if stage.name == "inference":
+            return self._stages["delivery"]
+        return None
+
+    def _finish(self, future : Future, args : tuple, context : contextvars.Context, result = None, error : Optional[BaseException] = None):
+        if self.cleanup is not None:
+            try:
+                context.run(self.cleanup, *args)
+            except Exception as e:
+                self.logger.exception(e)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _work(self, stage : _Stage):
+        while True:
+            item = stage.queue.get()
+            if item is _STOP:
+                return
+            future, args, payload, context, queued_at = item
+            # time spent waiting for a free worker of the stage
+            context.run(record_timing, f"queue/{stage.name}", time.perf_counter() - queued_at)
+            with stage.lock:
+                stage.busy += 1
+            start = time.monotonic()
+            try:
+                result = context.run(run_profiled, stage.fn, *payload) if stage.name == "ingest" else context.run(run_profiled, stage.fn, payload)
+            except BaseException as e:
+                with stage.lock:
+                    stage.errors += 1
+                self._finish(future, args, context, error=e)
+                continue
+            finally:
+                with stage.lock:
+                    stage.busy -= 1
+                    stage.busy_seconds += time.monotonic() - start
+                    stage.processed += 1
+            next_stage = self._next_stage(stage, result if stage.name == "ingest" else payload)
+            if next_stage is None:
+                self._finish(future, args, context, result=result)
+            else:
+                # blocks while the next stage is backed up, which throttles this one
+                next_stage.queue.put((future, args, result if stage.name == "ingest" else payload, context, time.perf_counter()))
+
+    def metrics(self) -> Dict[str, Dict[str, float]]:
+        """Queue depth, busy workers and utilization per stage since the executor started"""
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        metrics = {}
+        for name, stage in self._stages.items():
+            with stage.lock:
+                metrics[name] = {
+                    "queue_depth": stage.queue.qsize(),
+                    "busy_workers": stage.busy,
+                    "workers": stage.workers,
+                    "processed": stage.processed,
+                    "errors": stage.errors,
+                    "utilization": round(stage.busy_seconds / (elapsed * stage.workers), 4),
+                }
+        return metrics
+
+    def shutdown(self):
+        for stage in self._stages.values():
+            for _ in stage.threads:
+                stage.queue.put(_STOP)
+            for thread in stage.threads:
+                thread.join()
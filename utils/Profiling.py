@@ -0,0 +1,236 @@
+import os
+import sys
+sys.path.append(os.path.basename(''))
+
+import contextvars
+import cProfile
+import io
+import pstats
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, Optional
+from utils.logger import get_logger
+
+### Rows of the cpu summary and of the allocation summary
+PROFILE_TOP_FUNCTIONS = int(os.environ.get("PROFILE_TOP_FUNCTIONS", 60))
+PROFILE_TOP_ALLOCATIONS = int(os.environ.get("PROFILE_TOP_ALLOCATIONS", 40))
+# stack frames kept per traced allocation, more frames cost more memory while tracing
+PROFILE_TRACEMALLOC_FRAMES = int(os.environ.get("PROFILE_TRACEMALLOC_FRAMES", 1))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/profiles")
+
+_current_profile : contextvars.ContextVar = contextvars.ContextVar("job_profile", default=None)
+# a thread already running a profiled call, nested calls join the outer profiler
+_active = threading.local()
+
+# jobs of the process in flight, profiled or not, and the profile tracing allocations for its job
+_jobs_lock = threading.Lock()
+_jobs_in_flight = 0
+_tracing_profile : Optional["JobProfile"] = None
+
+_ALLOCATION_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, cProfile.__file__),
+    tracemalloc.Filter(False, pstats.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+logger = get_logger("Profiling")
+
+
+def profile_requested(value) -> bool:
+    """Reads the profile request flag, which may come as a bool or a string"""
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes")
+    return bool(value)
+
+
+def _job_started(profile : Optional["JobProfile"]):
+    """
+    Counts the job in. tracemalloc slows down every thread of the process, so
+    allocations are only traced for a profiled job that runs alone, and the
+    tracing stops as soon as another job starts.
+    """
+    global _jobs_in_flight, _tracing_profile
+    with _jobs_lock:
+        _jobs_in_flight += 1
+        if _tracing_profile is not None:
+            _tracing_profile._stop_tracing("stopped early, another job started while it ran")
+            _tracing_profile = None
+        if profile is None:
+            return
+        if _jobs_in_flight == 1 and not tracemalloc.is_tracing():
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+            _tracing_profile = profile
+        else:
+            profile.allocations_note = "skipped, other jobs were in flight or tracemalloc was running when it started"
+
+
+def _job_finished(profile : Optional["JobProfile"]):
+    global _jobs_in_flight, _tracing_profile
+    with _jobs_lock:
+        _jobs_in_flight -= 1
+        if profile is not None and _tracing_profile is profile:
+            profile._stop_tracing(None)
+            _tracing_profile = None
+
+
+class JobProfile:
+    """
+    cProfile and tracemalloc capture of one job. cProfile only sees the thread
+    it is enabled on, so every stage of the job runs under its own profiler
+    and the stats are merged. tracemalloc is process wide and taxes every job,
+    so allocations are only traced while the profiled job is the only one in
+    flight, the allocation summary says when they were not. It is a snapshot
+    from the end of the stage that left the most memory traced.
+    """
+
+    def __init__(self, task_id : str):
+        self.task_id = task_id
+        self._lock = threading.Lock()
+        self._stats : Optional[pstats.Stats] = None
+        self._snapshot : Optional[tracemalloc.Snapshot] = None
+        self._snapshot_bytes = 0
+        self._peak_bytes = 0
+        # stages that ran without a profiler because another one held the interpreter
+        self.unprofiled_calls = 0
+        # why allocations were not traced for the whole job, None when they were
+        self.allocations_note : Optional[str] = None
+
+    def run(self, fn, *args):
+        if getattr(_active, "profiler", None) is not None:
+            return fn(*args)
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # python 3.12+ allows one profiler per interpreter
+            with self._lock:
+                self.unprofiled_calls += 1
+            return fn(*args)
+        _active.profiler = profiler
+        try:
+            return fn(*args)
+        finally:
+            profiler.disable()
+            _active.profiler = None
+            self._add(profiler)
+
+    def _snapshot_allocations(self):
+        """Keeps a snapshot of the traced allocations when more memory is traced than at the last one, under _jobs_lock"""
+        if _tracing_profile is not self or not tracemalloc.is_tracing():
+            return
+        traced_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        with self._lock:
+            self._peak_bytes = max(self._peak_bytes, peak_bytes)
+            if traced_bytes <= self._snapshot_bytes:
+                return
+        snapshot = tracemalloc.take_snapshot().filter_traces(_ALLOCATION_FILTERS)
+        with self._lock:
+            if traced_bytes > self._snapshot_bytes:
+                self._snapshot, self._snapshot_bytes = snapshot, traced_bytes
+
+    def _stop_tracing(self, note : Optional[str]):
+        """Called under _jobs_lock by the job accounting once this profile stops tracing allocations"""
+        self._snapshot_allocations()
+        tracemalloc.stop()
+        self.allocations_note = note
+
+    def _add(self, profiler : cProfile.Profile):
+        # a job starting elsewhere may stop the tracing meanwhile
+        with _jobs_lock:
+            self._snapshot_allocations()
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profiler)
+            else:
+                self._stats.add(profiler)
+
+    def _cpu_summary(self) -> str:
+        if self._stats is None:
+            return "No stage of the job ran under the profiler\n"
+        text = io.StringIO()
+        self._stats.stream = text
+        text.write(f"Profile of job {self.task_id}, stages run without a profiler : {self.unprofiled_calls}\n")
+        self._stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_TOP_FUNCTIONS)
+        self._stats.sort_stats(pstats.SortKey.TIME).print_stats(PROFILE_TOP_FUNCTIONS)
+        return text.getvalue()
+
+    def _allocation_summary(self) -> str:
+        lines = [f"Allocations of job {self.task_id}",
+                 f"Allocation tracing : {self.allocations_note or 'whole job'}",
+                 f"Peak traced memory : {self._peak_bytes / (1024 * 1024):.1f} MiB",
+                 f"Traced memory at the snapshot : {self._snapshot_bytes / (1024 * 1024):.1f} MiB", ""]
+        if self._snapshot is None:
+            lines.append("No allocation snapshot was taken")
+        else:
+            for statistic in self._snapshot.statistics("lineno")[:PROFILE_TOP_ALLOCATIONS]:
+                lines.append(str(statistic))
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory : str = PROFILE_DIR) -> Dict[str, str]:
+        """Writes the profile, its text summary and the allocation summary, returns their paths"""
+        os.makedirs(directory, exist_ok=True)
+        paths = {
+            "cpu_profile": os.path.join(directory, f"{self.task_id}_profile.prof"),
+            "cpu_summary": os.path.join(directory, f"{self.task_id}_profile.txt"),
+            "allocations": os.path.join(directory, f"{self.task_id}_allocations.txt"),
+        }
+        with self._lock:
+            if self._stats is not None:
+                self._stats.dump_stats(paths["cpu_profile"])
+            else:
+                del paths["cpu_profile"]
+            with open(paths["cpu_summary"], "w") as summary:
+                summary.write(self._cpu_summary())
+            with open(paths["allocations"], "w") as summary:
+                summary.write(self._allocation_summary())
+        return paths
+
+    def upload(self, s3_helper, bucket_name : str, key_prefix : str) -> Dict[str, str]:
+        """
+        Uploads the artifacts as <key_prefix>_profile.prof, _profile.txt and
+        _allocations.txt, returns their s3 keys. A failed upload is logged,
+        it never fails the job.
+        """
+        keys = {}
+        try:
+            for name, path in self.write().items():
+                s3_key = f"{key_prefix}{os.path.basename(path)[len(self.task_id):]}"
+                try:
+                    s3_helper.upload_file(path, s3_key, bucket_name)
+                    keys[name] = s3_key
+                finally:
+                    os.remove(path)
+            logger.info(f"Profile of {self.task_id} uploaded to {keys}")
+        except Exception as e:
+            logger.exception(e)
+        return keys
+
+
+@contextmanager
+def job_profile(task_id : str, enabled : bool):
+    """
+    Profiles the stages of the job started in the block when enabled. Every
+    job enters it, so allocation tracing knows which jobs are in flight.
+    Stages take part through run_profiled, without a profile they pay one
+    context variable lookup.
+    """
+    profile = JobProfile(task_id) if enabled else None
+    _job_started(profile)
+    token = _current_profile.set(profile)
+    try:
+        yield profile
+    finally:
+        _current_profile.reset(token)
+        _job_finished(profile)
+
+
+def run_profiled(fn, *args):
+    """Calls fn under the profiler of the current job, plainly outside a profiled job"""
+    profile = _current_profile.get()
+    if profile is None:
+        return fn(*args)
+    return profile.run(fn, *args)
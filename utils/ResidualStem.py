@@ -0,0 +1,87 @@
+import os
+import sys
+sys.path.append(os.path.basename(''))
+
+import numpy as np
+import soundfile as sf
+from utils.logger import get_logger
+
+INSTRUMENTAL_STRATEGIES = ("model", "residual")
+DEFAULT_INSTRUMENTAL_STRATEGY = os.environ.get("INSTRUMENTAL_STRATEGY", "model").lower()
+# seconds of the mix and the stem held in memory at a time
+RESIDUAL_BLOCK_SECONDS = int(os.environ.get("RESIDUAL_BLOCK_SECONDS", 30))
+
+logger = get_logger("ResidualStem")
+
+
+def resolve_instrumental_strategy(strategy : str = None) -> str:
+    """Returns the instrumental strategy to use, raises on an unknown one"""
+    strategy = (strategy or DEFAULT_INSTRUMENTAL_STRATEGY).lower()
+    if strategy not in INSTRUMENTAL_STRATEGIES:
+        raise ValueError(f"Invalid instrumental strategy: {strategy}, expected one of {INSTRUMENTAL_STRATEGIES}")
+    return strategy
+
+
+class _AlignedMix:
+    """
+    Reads the mix at the rate and channel count of the stem, in exact frame
+    counts, so it can be subtracted block by block. Past its end the mix reads
+    as silence.
+    """
+
+    def __init__(self, mix_path : str, stem_rate : int, channels : int):
+        self.source = sf.SoundFile(mix_path)
+        self.channels = channels
+        self.block_frames = self.source.samplerate * RESIDUAL_BLOCK_SECONDS
+        self.resampler = None
+        if self.source.samplerate != stem_rate:
+            # soxr ships with audio-separator through librosa, only needed when the model resampled the input
+            import soxr
+            self.resampler = soxr.ResampleStream(self.source.samplerate, stem_rate, self.source.channels, dtype="float32", quality="HQ")
+        self.pending = np.zeros((0, channels), dtype=np.float32)
+        self.exhausted = False
+
+    def __enter__(self) -> "_AlignedMix":
+        return self
+
+    def __exit__(self, *exc):
+        self.source.close()
+
+    def _next_block(self) -> np.ndarray:
+        block = self.source.read(self.block_frames, dtype="float32", always_2d=True)
+        self.exhausted = self.source.tell() >= self.source.frames or not len(block)
+        if self.resampler is not None:
+            block = self.resampler.resample_chunk(block, last=self.exhausted)
+        if block.shape[1] != self.channels:
+            block = np.repeat(block.mean(axis=1, keepdims=True), self.channels, axis=1)
+        return block.astype(np.float32, copy=False)
+
+    def read(self, frames : int) -> np.ndarray:
+        parts, buffered = [self.pending], len(self.pending)
+        while buffered < frames and not self.exhausted:
+            block = self._next_block()
+            parts.append(block)
+            buffered += len(block)
+        if buffered < frames:
+            parts.append(np.zeros((frames - buffered, self.channels), dtype=np.float32))
+        mix = np.concatenate(parts)
+        self.pending = mix[frames:]
+        return mix[:frames]
+
+
+def write_residual(mix_path : str, stem_path : str, output_path : str) -> str:
+    """
+    Writes mix - stem to output_path, sample aligned to the stem. Used to derive
+    the instrumental from the extracted vocals without a second model pass.
+    Both files are streamed in blocks, neither is held in memory.
+    """
+    with sf.SoundFile(stem_path) as stem, _AlignedMix(mix_path, stem.samplerate, stem.channels) as mix, \
+            sf.SoundFile(output_path, mode="w", samplerate=stem.samplerate, channels=stem.channels, subtype=stem.subtype) as target:
+        clip = stem.subtype.startswith("PCM")
+        for block in stem.blocks(blocksize=stem.samplerate * RESIDUAL_BLOCK_SECONDS, dtype="float32", always_2d=True):
+            residual = mix.read(len(block)) - block
+            if clip:
+                residual = np.clip(residual, -1.0, 1.0)
+            target.write(residual)
+    logger.debug("Wrote residual of %s - %s to %s", mix_path, stem_path, output_path)
+    return output_path
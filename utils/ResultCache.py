@@ -0,0 +1,219 @@
+import os
+import sys
+sys.path.append(os.path.basename(''))
+
+import hashlib
+import json
+import shutil
+import time
+import uuid
+from typing import Dict, Optional
+from utils.logger import get_logger
+from utils.Timings import span
+from utils.s3Utils import S3Helper
+
+### Stem result cache configuration
+STEM_CACHE_ENABLED = os.environ.get("STEM_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+STEM_CACHE_DIR = os.environ.get("STEM_CACHE_DIR", "/tmp/stem-cache")
+STEM_CACHE_MAX_MB = int(os.environ.get("STEM_CACHE_MAX_MB", 2048))
+STEM_CACHE_S3_PREFIX = os.environ.get("STEM_CACHE_S3_PREFIX", "cache/stems")
+
+MANIFEST_FILENAME = "manifest.json"
+OUTPUT_PREFIX = "conversions"
+# per run fields, a cache hit reports its own
+UNCACHED_RESPONSE_KEYS = ("task_id", "timings")
+
+
+class AudioDigest:
+    """
+    Incremental sha256 over decoded PCM. The stream format is hashed first so
+    the same samples at a different rate or width never collide.
+    """
+
+    def __init__(self, sample_rate : int, channels : int, sample_width : int):
+        self._hash = hashlib.sha256()
+        self._hash.update(f"{sample_rate}:{channels}:{sample_width}:".encode("utf-8"))
+
+    def update(self, pcm_chunk : bytes):
+        self._hash.update(pcm_chunk)
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+class StemResultCache:
+    """
+    Content addressed cache of delivered stems.
+
+    An entry is the set of objects a job uploaded under conversions/, plus a
+    manifest holding the job response. Entries live on local disk (size capped,
+    LRU evicted) and under a prefix in S3. On a hit the stems are copied to the
+    new task's conversions/ keys, so no inference runs.
+    """
+
+    def __init__(self, s3_helper : S3Helper, bucket_name : str, local_dir : str = STEM_CACHE_DIR,
+                 max_local_bytes : int = STEM_CACHE_MAX_MB * 1024 * 1024, s3_prefix : str = STEM_CACHE_S3_PREFIX,
+                 enabled : bool = STEM_CACHE_ENABLED):
+        self.logger = get_logger("StemResultCache")
+        self.s3_helper = s3_helper
+        self.bucket_name = bucket_name
+        self.local_dir = local_dir
+        self.max_local_bytes = max_local_bytes
+        self.s3_prefix = s3_prefix.strip("/")
+        self.enabled = enabled
+        if self.enabled:
+            os.makedirs(self.local_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(audio_digest : str, model_names : Dict[str, str], separator_params : dict, mode : str, **extra) -> str:
+        """Builds the cache key from the decoded audio hash and everything that changes the stems"""
+        payload = {
+            "audio": audio_digest,
+            "models": model_names,
+            "params": separator_params,
+            "mode": mode,
+            "extra": extra,
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def _task_prefix(self, task_id : str) -> str:
+        return f"{OUTPUT_PREFIX}/{task_id}_"
+
+    def _output_suffixes(self, response : dict, task_id : str) -> Dict[str, str]:
+        """Maps response fields that point to uploaded outputs to their task independent suffix"""
+        prefix = self._task_prefix(task_id)
+        return {
+            field: value[len(prefix):]
+            for field, value in response.items()
+            if isinstance(value, str) and value.startswith(prefix)
+        }
+
+    def _local_entry_dir(self, cache_key : str) -> str:
+        return os.path.join(self.local_dir, cache_key)
+
+    def _s3_entry_key(self, cache_key : str, suffix : str) -> str:
+        return f"{self.s3_prefix}/{cache_key}/{suffix}"
+
+    def _build_response(self, manifest : dict, task_id : str) -> dict:
+        response = dict(manifest["response"])
+        for field, suffix in manifest["outputs"].items():
+            response[field] = f"{self._task_prefix(task_id)}{suffix}"
+        return response
+
+    def lookup(self, cache_key : Optional[str], task_id : str) -> Optional[dict]:
+        """
+        Returns the job response with outputs copied to the task's keys,
+        or None on a miss. Failures are logged and treated as a miss.
+        """
+        if not self.enabled or not cache_key:
+            return None
+        try:
+            with span("cache_lookup"):
+                response = self._lookup_local(cache_key, task_id)
+                if response is None:
+                    response = self._lookup_s3(cache_key, task_id)
+            if response is not None:
+                self.logger.info(f"Stem cache hit for task {task_id} ({cache_key})")
+            else:
+                self.logger.debug("Stem cache miss for task %s (%s)", task_id, cache_key)
+            return response
+        except Exception as e:
+            self.logger.exception(f"Stem cache lookup failed for {cache_key}: {e}")
+            return None
+
+    def _lookup_local(self, cache_key : str, task_id : str) -> Optional[dict]:
+        entry_dir = self._local_entry_dir(cache_key)
+        manifest_path = os.path.join(entry_dir, MANIFEST_FILENAME)
+        if not os.path.isfile(manifest_path):
+            return None
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        for suffix in set(manifest["outputs"].values()):
+            local_path = os.path.join(entry_dir, suffix)
+            task_key = f"{self._task_prefix(task_id)}{suffix}"
+            if os.path.isfile(local_path):
+                self.s3_helper.upload_file(local_path, task_key, self.bucket_name)
+            else:
+                # outputs streamed straight to s3 have no local copy, the s3 entry holds them
+                self.s3_helper.copy_file(self._s3_entry_key(cache_key, suffix), task_key, self.bucket_name)
+        # bump recency for LRU eviction
+        os.utime(manifest_path)
+        return self._build_response(manifest, task_id)
+
+    def _lookup_s3(self, cache_key : str, task_id : str) -> Optional[dict]:
+        manifest = self.s3_helper.download_json(self._s3_entry_key(cache_key, MANIFEST_FILENAME), self.bucket_name)
+        if manifest is None:
+            return None
+        for suffix in set(manifest["outputs"].values()):
+            self.s3_helper.copy_file(self._s3_entry_key(cache_key, suffix), f"{self._task_prefix(task_id)}{suffix}", self.bucket_name)
+        return self._build_response(manifest, task_id)
+
+    def store(self, cache_key : Optional[str], task_id : str, response : dict, local_files : Optional[Dict[str, str]] = None):
+        """
+        Stores a finished job. `local_files` maps uploaded s3 keys to local
+        paths still on disk, those populate the local tier.
+        Failures are logged, a job never fails because of the cache.
+        """
+        if not self.enabled or not cache_key:
+            return
+        try:
+            outputs = self._output_suffixes(response, task_id)
+            if not outputs:
+                return
+            manifest = {
+                "created_at": time.time(),
+                "outputs": outputs,
+                "response": {k: v for k, v in response.items() if k not in outputs and k not in UNCACHED_RESPONSE_KEYS},
+            }
+            for suffix in set(outputs.values()):
+                self.s3_helper.copy_file(f"{self._task_prefix(task_id)}{suffix}", self._s3_entry_key(cache_key, suffix), self.bucket_name)
+            # manifest goes last, it marks the s3 entry as complete
+            self.s3_helper.upload_json(manifest, self._s3_entry_key(cache_key, MANIFEST_FILENAME), self.bucket_name)
+            self._store_local(cache_key, task_id, manifest, local_files or {})
+        except Exception as e:
+            self.logger.exception(f"Stem cache store failed for {cache_key}: {e}")
+
+    def _store_local(self, cache_key : str, task_id : str, manifest : dict, local_files : Dict[str, str]):
+        entry_dir = self._local_entry_dir(cache_key)
+        if os.path.isdir(entry_dir):
+            return
+        sources = {}
+        for suffix in set(manifest["outputs"].values()):
+            local_path = local_files.get(f"{self._task_prefix(task_id)}{suffix}")
+            # outputs without a local file are served from the s3 entry
+            if local_path and os.path.isfile(local_path):
+                sources[suffix] = local_path
+        if not sources:
+            return
+
+        tmp_dir = os.path.join(self.local_dir, f".{cache_key}.{uuid.uuid4().hex}")
+        os.makedirs(tmp_dir)
+        try:
+            for suffix, local_path in sources.items():
+                shutil.copyfile(local_path, os.path.join(tmp_dir, suffix))
+            with open(os.path.join(tmp_dir, MANIFEST_FILENAME), "w") as f:
+                json.dump(manifest, f)
+            os.replace(tmp_dir, entry_dir)
+        except OSError:
+            # another worker stored the same entry first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self._evict_local()
+
+    def _evict_local(self):
+        entries = []
+        total_bytes = 0
+        for name in os.listdir(self.local_dir):
+            entry_dir = os.path.join(self.local_dir, name)
+            manifest_path = os.path.join(entry_dir, MANIFEST_FILENAME)
+            if name.startswith(".") or not os.path.isfile(manifest_path):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(manifest_path), size, entry_dir))
+            total_bytes += size
+
+        for _, size, entry_dir in sorted(entries):
+            if total_bytes <= self.max_local_bytes:
+                break
+            self.logger.debug("Evicting stem cache entry %s", entry_dir)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_bytes -= size
@@ -0,0 +1,195 @@
+import os
+import sys
+sys.path.append(os.path.basename(''))
+
+import json
+import threading
+import time
+from typing import Dict, Optional, Tuple
+import boto3
+import botocore
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
+from utils.logger import get_logger
+from utils.Timings import record as record_timing
+
+### Connection pool and multipart settings shared by every transfer of the process
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", 50))
+S3_MULTIPART_THRESHOLD_MB = int(os.environ.get("S3_MULTIPART_THRESHOLD_MB", 16))
+S3_MULTIPART_CHUNK_MB = int(os.environ.get("S3_MULTIPART_CHUNK_MB", 16))
+S3_TRANSFER_CONCURRENCY = int(os.environ.get("S3_TRANSFER_CONCURRENCY", 10))
+### Retries, adaptive mode backs off and rate limits the client on throttling
+S3_RETRY_MODE = os.environ.get("S3_RETRY_MODE", "adaptive")
+S3_MAX_ATTEMPTS = int(os.environ.get("S3_MAX_ATTEMPTS", 10))
+# S3_ENDPOINT_URL points the client at a local S3 stand-in
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL") or None
+
+MISSING_KEY_CODES = ('404', 'NoSuchKey', 'NotFound')
+
+logger = get_logger("S3Transfer")
+
+
+def make_transfer_config(chunk_mb : int = S3_MULTIPART_CHUNK_MB, threshold_mb : int = S3_MULTIPART_THRESHOLD_MB,
+                         max_concurrency : int = S3_TRANSFER_CONCURRENCY) -> TransferConfig:
+    return TransferConfig(
+        multipart_threshold=threshold_mb * 1024 * 1024,
+        multipart_chunksize=chunk_mb * 1024 * 1024,
+        max_concurrency=max_concurrency,
+        use_threads=True,
+    )
+
+
+class TransferMetrics:
+    """Bytes and seconds per transfer direction, summed over the process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals : Dict[str, Dict[str, float]] = {}
+
+    def record(self, direction : str, s3_key : str, num_bytes : int, seconds : float):
+        with self._lock:
+            totals = self._totals.setdefault(direction, {"transfers": 0, "bytes": 0, "seconds": 0.0})
+            totals["transfers"] += 1
+            totals["bytes"] += num_bytes
+            totals["seconds"] += seconds
+        # transfers also count towards the stages of the job they ran for
+        record_timing(direction, seconds)
+        rate = num_bytes / seconds / (1024 * 1024) if seconds > 0 else 0.0
+        logger.debug("%s %s : %s bytes in %.3fs (%.2f MB/s)", direction, s3_key, num_bytes, seconds, rate)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """Totals per direction with their average bytes/sec"""
+        with self._lock:
+            snapshot = {direction: dict(totals) for direction, totals in self._totals.items()}
+        for totals in snapshot.values():
+            totals["bytes_per_second"] = totals["bytes"] / totals["seconds"] if totals["seconds"] > 0 else 0.0
+        return snapshot
+
+
+class _ByteCounter:
+    """Transfer callback summing the bytes boto3 reports, called from its worker threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.bytes = 0
+
+    def __call__(self, num_bytes : int):
+        with self._lock:
+            self.bytes += num_bytes
+
+
+class S3Transfer:
+    """
+    S3 transfers of the process. Wraps one thread safe boto3 client with a
+    sized connection pool and adaptive retries, runs uploads, downloads and
+    copies as managed multipart transfers and records bytes/sec per transfer.
+    Use get_s3_transfer() instead of building one per job.
+    """
+
+    def __init__(self, aws_access_key : Optional[str], aws_secret_key : Optional[str], aws_region : Optional[str],
+                 endpoint_url : Optional[str] = S3_ENDPOINT_URL, transfer_config : Optional[TransferConfig] = None):
+        # boto3's default session is not thread safe, every client gets its own
+        session = boto3.session.Session(
+            aws_access_key_id=aws_access_key,
+            aws_secret_access_key=aws_secret_key,
+            region_name=aws_region,
+        )
+        self.client = session.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            config=Config(
+                max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                retries={"mode": S3_RETRY_MODE, "max_attempts": S3_MAX_ATTEMPTS},
+            ),
+        )
+        self.transfer_config = transfer_config or make_transfer_config()
+        self.metrics = TransferMetrics()
+
+    def upload_file(self, local_path : str, bucket_name : str, s3_key : str, extra_args : Optional[dict] = None):
+        counter = _ByteCounter()
+        start = time.perf_counter()
+        self.client.upload_file(local_path, bucket_name, s3_key, ExtraArgs=extra_args, Config=self.transfer_config, Callback=counter)
+        self.metrics.record("upload", s3_key, counter.bytes, time.perf_counter() - start)
+
+    def upload_fileobj(self, fileobj, bucket_name : str, s3_key : str, transfer_config : Optional[TransferConfig] = None) -> int:
+        """Uploads a readable stream, returns the bytes uploaded"""
+        counter = _ByteCounter()
+        start = time.perf_counter()
+        self.client.upload_fileobj(fileobj, bucket_name, s3_key, Config=transfer_config or self.transfer_config, Callback=counter)
+        self.metrics.record("upload", s3_key, counter.bytes, time.perf_counter() - start)
+        return counter.bytes
+
+    def download_file(self, bucket_name : str, s3_key : str, local_path : str):
+        counter = _ByteCounter()
+        start = time.perf_counter()
+        self.client.download_file(bucket_name, s3_key, local_path, Config=self.transfer_config, Callback=counter)
+        self.metrics.record("download", s3_key, counter.bytes, time.perf_counter() - start)
+
+    def download_fileobj(self, bucket_name : str, s3_key : str, fileobj, extra_args : Optional[dict] = None):
+        """Downloads into a writable stream, non seekable streams such as pipes get the parts in order"""
+        counter = _ByteCounter()
+        start = time.perf_counter()
+        self.client.download_fileobj(bucket_name, s3_key, fileobj, ExtraArgs=extra_args, Config=self.transfer_config, Callback=counter)
+        self.metrics.record("download", s3_key, counter.bytes, time.perf_counter() - start)
+
+    def get_object(self, bucket_name : str, s3_key : str) -> dict:
+        return self.client.get_object(Bucket=bucket_name, Key=s3_key)
+
+    def copy(self, source_key : str, dest_key : str, bucket_name : str):
+        """Server side copy inside the bucket, large objects are copied in parts"""
+        counter = _ByteCounter()
+        start = time.perf_counter()
+        self.client.copy({"Bucket": bucket_name, "Key": source_key}, bucket_name, dest_key, Config=self.transfer_config, Callback=counter)
+        self.metrics.record("copy", dest_key, counter.bytes, time.perf_counter() - start)
+
+    def head(self, bucket_name : str, s3_key : str) -> dict:
+        return self.client.head_object(Bucket=bucket_name, Key=s3_key)
+
+    def exists(self, bucket_name : str, s3_key : str) -> bool:
+        try:
+            self.client.head_object(Bucket=bucket_name, Key=s3_key)
+            return True
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in MISSING_KEY_CODES:
+                return False
+            raise
+
+    def prefix_exists(self, bucket_name : str, prefix : str) -> bool:
+        response = self.client.list_objects_v2(Bucket=bucket_name, Prefix=prefix, MaxKeys=1)
+        return 'Contents' in response
+
+    def delete(self, bucket_name : str, s3_key : str):
+        self.client.delete_object(Bucket=bucket_name, Key=s3_key)
+
+    def put_json(self, data : dict, bucket_name : str, s3_key : str):
+        body = json.dumps(data).encode("utf-8")
+        start = time.perf_counter()
+        self.client.put_object(Bucket=bucket_name, Key=s3_key, Body=body, ContentType="application/json")
+        self.metrics.record("upload", s3_key, len(body), time.perf_counter() - start)
+
+    def get_json(self, bucket_name : str, s3_key : str):
+        """Returns the parsed json object, or None if the key does not exist"""
+        try:
+            start = time.perf_counter()
+            body = self.client.get_object(Bucket=bucket_name, Key=s3_key)['Body'].read()
+            self.metrics.record("download", s3_key, len(body), time.perf_counter() - start)
+            return json.loads(body)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in MISSING_KEY_CODES:
+                return None
+            raise
+
+
+_transfers : Dict[Tuple, S3Transfer] = {}
+_transfers_lock = threading.Lock()
+
+
+def get_s3_transfer(aws_access_key : Optional[str], aws_secret_key : Optional[str], aws_region : Optional[str]) -> S3Transfer:
+    """Process wide S3Transfer per credentials, every helper and job shares its client and pool"""
+    key = (aws_access_key, aws_secret_key, aws_region, S3_ENDPOINT_URL)
+    with _transfers_lock:
+        transfer = _transfers.get(key)
+        if transfer is None:
+            transfer = S3Transfer(aws_access_key, aws_secret_key, aws_region)
+            _transfers[key] = transfer
+        return transfer
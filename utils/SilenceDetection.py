@@ -0,0 +1,208 @@
+import os
+import sys
+sys.path.append(os.path.basename(''))
+
+import numpy as np
+import soundfile as sf
+from dataclasses import dataclass, field
+from typing import Callable, Iterator, List, Optional, Tuple
+from utils.logger import get_logger
+from utils.Timings import span
+
+### Silence skipping configuration
+SILENCE_SKIP_ENABLED = os.environ.get("SILENCE_SKIP_ENABLED", "true").lower() in ("1", "true", "yes")
+SILENCE_THRESHOLD_DB = float(os.environ.get("SILENCE_THRESHOLD_DB", -60))
+SILENCE_MIN_SECONDS = float(os.environ.get("SILENCE_MIN_SECONDS", 2.0))
+# audio kept on each side of a skipped span, so models see the real onset/decay
+SILENCE_PADDING_SECONDS = float(os.environ.get("SILENCE_PADDING_SECONDS", 0.1))
+SILENCE_FRAME_SECONDS = 0.02
+READ_BLOCK_SECONDS = 30
+
+logger = get_logger("SilenceDetection")
+
+
+def resolve_skip_silence(skip_silence = None) -> bool:
+    """Returns whether to skip silence, the request flag may come as a bool or a string"""
+    if skip_silence is None:
+        return SILENCE_SKIP_ENABLED
+    if isinstance(skip_silence, str):
+        return skip_silence.strip().lower() in ("1", "true", "yes")
+    return bool(skip_silence)
+
+
+@dataclass
+class SilenceMap:
+    """Silent spans of an input, as [start, stop) frame ranges at the input sample rate"""
+
+    sample_rate : int
+    total_frames : int
+    spans : List[Tuple[int, int]] = field(default_factory=list)
+
+    @property
+    def skipped_frames(self) -> int:
+        return sum(stop - start for start, stop in self.spans)
+
+    @property
+    def skipped_fraction(self) -> float:
+        if not self.total_frames:
+            return 0.0
+        return round(self.skipped_frames / self.total_frames, 4)
+
+    def kept_regions(self) -> List[Tuple[int, int]]:
+        """Complement of the silent spans"""
+        regions = []
+        cursor = 0
+        for start, stop in self.spans:
+            if start > cursor:
+                regions.append((cursor, start))
+            cursor = stop
+        if cursor < self.total_frames:
+            regions.append((cursor, self.total_frames))
+        return regions
+
+
+def _frame_energy_db(samples : np.ndarray, frame_length : int) -> np.ndarray:
+    """Mean power per frame in dBFS, over all channels"""
+    n_frames = int(np.ceil(len(samples) / frame_length))
+    padded = np.zeros((n_frames * frame_length, samples.shape[1]), dtype=np.float32)
+    padded[:len(samples)] = samples
+    power = np.mean(np.square(padded.reshape(n_frames, frame_length, samples.shape[1])), axis=(1, 2))
+    return 10.0 * np.log10(np.maximum(power, 1e-20))
+
+
+def _silent_runs(mask : np.ndarray) -> List[Tuple[int, int]]:
+    """[start, stop) index runs where mask is True"""
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return list(zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+
+
+def detect_silence(file_path : str, threshold_db : float = SILENCE_THRESHOLD_DB, min_seconds : float = SILENCE_MIN_SECONDS,
+                   padding_seconds : float = SILENCE_PADDING_SECONDS) -> SilenceMap:
+    """Energy pre-pass over the input in fixed blocks, returns the silent spans longer than min_seconds"""
+    info = sf.info(file_path)
+    frame_length = max(1, int(SILENCE_FRAME_SECONDS * info.samplerate))
+    block_frames = frame_length * max(1, int(READ_BLOCK_SECONDS / SILENCE_FRAME_SECONDS))
+
+    energies = [
+        _frame_energy_db(block, frame_length)
+        for block in sf.blocks(file_path, blocksize=block_frames, dtype="float32", always_2d=True)
+    ]
+    silence_map = SilenceMap(sample_rate=info.samplerate, total_frames=info.frames)
+    if not energies:
+        return silence_map
+
+    mask = np.concatenate(energies) < threshold_db
+    min_frames = int(min_seconds * info.samplerate)
+    padding = int(padding_seconds * info.samplerate)
+    for run_start, run_stop in _silent_runs(mask):
+        start = int(run_start) * frame_length
+        stop = min(int(run_stop) * frame_length, info.frames)
+        # pad inside the span, except at the file boundaries where there is nothing to preserve
+        start = start + padding if start > 0 else 0
+        stop = stop - padding if stop < info.frames else stop
+        if stop - start >= min_frames:
+            silence_map.spans.append((start, stop))
+    return silence_map
+
+
+def compact_audio(file_path : str, silence_map : SilenceMap, output_path : str) -> str:
+    """Writes only the non silent regions of file_path, back to back"""
+    with sf.SoundFile(file_path) as source, \
+            sf.SoundFile(output_path, mode="w", samplerate=source.samplerate, channels=source.channels, subtype=source.subtype) as target:
+        for start, stop in silence_map.kept_regions():
+            source.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                block = source.read(min(remaining, source.samplerate * READ_BLOCK_SECONDS), dtype="float32", always_2d=True)
+                if not len(block):
+                    break
+                target.write(block)
+                remaining -= len(block)
+    return output_path
+
+
+def _expansion_plan(silence_map : SilenceMap, sample_rate : int) -> Iterator[Tuple[bool, int]]:
+    """
+    Yields (is_silence, length) segments at sample_rate, which rebuild the
+    original timeline from a compacted stem. The stem may use a different
+    sample rate than the input, offsets are scaled accordingly.
+    """
+    ratio = sample_rate / silence_map.sample_rate
+    compact_cursor = 0
+    output_cursor = 0
+    for start, stop in silence_map.kept_regions():
+        gap = int(round(start * ratio)) - output_cursor
+        if gap > 0:
+            yield True, gap
+            output_cursor += gap
+        compact_stop = compact_cursor + (stop - start)
+        length = int(round(compact_stop * ratio)) - int(round(compact_cursor * ratio))
+        yield False, length
+        output_cursor += length
+        compact_cursor = compact_stop
+    trailing = int(round(silence_map.total_frames * ratio)) - output_cursor
+    if trailing > 0:
+        yield True, trailing
+
+
+def expand_audio(file_path : str, silence_map : Optional[SilenceMap], output_path : Optional[str] = None, channels : int = 0,
+                 transform : Optional[Callable[[np.ndarray], np.ndarray]] = None) -> str:
+    """
+    Splices the skipped silence back into a stem produced from the compacted
+    input, block by block, so the stem is never held in memory. Writes to
+    output_path, in place without one. transform is applied to every block
+    read, e.g. a conversion to `channels` channels. Without a silence map
+    the stem only goes through transform. Returns the written path.
+    """
+    target_path = output_path or f"{os.path.splitext(file_path)[0]}.expanding{os.path.splitext(file_path)[1]}"
+    with sf.SoundFile(file_path) as source:
+        channels = channels or source.channels
+        block_frames = source.samplerate * READ_BLOCK_SECONDS
+        plan = _expansion_plan(silence_map, source.samplerate) if silence_map is not None else [(False, source.frames)]
+        with sf.SoundFile(target_path, mode="w", samplerate=source.samplerate, channels=channels, subtype=source.subtype) as target:
+            for is_silence, length in plan:
+                if is_silence:
+                    for start in range(0, length, block_frames):
+                        target.write(np.zeros((min(block_frames, length - start), channels), dtype=np.float32))
+                    continue
+                for block in source.blocks(blocksize=block_frames, frames=length, dtype="float32", always_2d=True):
+                    target.write(transform(block) if transform is not None else block)
+    if output_path is None:
+        os.replace(target_path, file_path)
+    return output_path or file_path
+
+
+class SilenceSkipper:
+    """
+    Pipeline helper: detects silence in a job input and hands out a compacted
+    input for the models. The silence map restores the timeline of each stem.
+    """
+
+    def __init__(self, input_path : str, enabled : bool = SILENCE_SKIP_ENABLED):
+        self.input_path = input_path
+        self.silence_map = None
+        if enabled:
+            try:
+                with span("silence"):
+                    self.silence_map = detect_silence(input_path)
+            except RuntimeError as e:
+                logger.error(f"Silence detection failed for {input_path}: {e}")
+
+    @property
+    def active(self) -> bool:
+        return self.silence_map is not None and bool(self.silence_map.spans)
+
+    @property
+    def skipped_fraction(self) -> float:
+        return self.silence_map.skipped_fraction if self.silence_map is not None else 0.0
+
+    def compacted_input(self) -> str:
+        """Path the models should run on, the original input when nothing is skipped"""
+        if not self.active:
+            return self.input_path
+        base, ext = os.path.splitext(self.input_path)
+        compact_path = f"{base}_active{ext}"
+        with span("silence"):
+            compact_audio(self.input_path, self.silence_map, compact_path)
+        logger.info(f"Skipping {self.skipped_fraction * 100:.1f}% silent audio in {self.input_path}")
+        return compact_path
@@ -0,0 +1,106 @@
+import os
+import sys
+sys.path.append(os.path.basename(''))
+
+import shutil
+import tempfile
+import numpy as np
+import soundfile as sf
+from collections import OrderedDict
+from functools import partial
+from typing import Dict, List, Optional
+from pydantic import GetCoreSchemaHandler
+from pydantic_core import core_schema
+from utils.logger import get_logger
+from utils.SilenceDetection import SilenceMap, expand_audio
+from utils.Timings import span
+
+### Scratch space for intermediate stems. Disk backed by default, float32 stems of long multi stem jobs
+### run into GBs, which a container's /dev/shm (64MB under docker) cannot hold. Point it at /dev/shm to opt in
+STAGE_SCRATCH_ROOT = os.environ.get("STAGE_SCRATCH_ROOT", tempfile.gettempdir())
+
+
+def convert_channels(samples : np.ndarray, channels : int) -> np.ndarray:
+    """Down/up mixes a (frames, channels) array to the given channel count"""
+    if channels not in (1, 2):
+        raise ValueError("Invalid channel type")
+    if samples.shape[1] == channels:
+        return samples
+    if channels == 1:
+        return samples.mean(axis=1, keepdims=True)
+    return np.repeat(samples[:, :1], channels, axis=1)
+
+
+class StagePipeline:
+    """
+    Runs the chained separator stages of one job.
+
+    audio-separator only reads and writes files, so each model stage still
+    hands its stems over as files, but they live in a per job scratch dir
+    instead of the output dir. Transforms of our own (channel conversion,
+    residuals, silence splicing) stream float32 blocks, and every delivered stem
+    is encoded exactly once into the output dir. Bytes written are counted per stage.
+    """
+
+    def __init__(self, separator, task_id : str, output_dir : str, quality : Optional[str] = None,
+                 silence_map : Optional[SilenceMap] = None, scratch_root : str = STAGE_SCRATCH_ROOT):
+        self.logger = get_logger("StagePipeline")
+        self.task_id = task_id
+        self.output_dir = output_dir
+        self.quality = quality
+        self.silence_map = silence_map
+        os.makedirs(scratch_root, exist_ok=True)
+        self.scratch_dir = tempfile.mkdtemp(prefix=f"{task_id}_stages_", dir=scratch_root)
+        # separator view writing its stems into the scratch dir, models stay shared
+        self.separator = separator.with_output_dir(self.scratch_dir)
+        self.bytes_written : Dict[str, int] = OrderedDict()
+
+    @classmethod
+    def __get_pydantic_core_schema__(
+        cls, source_type: type, handler: GetCoreSchemaHandler
+    ) -> core_schema.CoreSchema:
+        return core_schema.is_instance_schema(cls)
+
+    def __enter__(self) -> "StagePipeline":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record(self, stage : str, paths : List[str]):
+        written = sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+        self.bytes_written[stage] = self.bytes_written.get(stage, 0) + written
+
+    def scratch_path(self, file_name : str) -> str:
+        return os.path.join(self.scratch_dir, file_name)
+
+    def separate(self, stage : str, model_name : str, input_path : str, custom_output_names : Optional[Dict[str, str]] = None) -> List[str]:
+        """Runs one model stage, returns the full scratch paths of its stems"""
+        output_files = self.separator.run_extractor(model_name, input_path, custom_output_names=custom_output_names, quality=self.quality)
+        stem_paths = [self.scratch_path(file_name) for file_name in output_files]
+        self.record(stage, stem_paths)
+        self.logger.debug("Stage %s wrote %s bytes : %s", stage, self.bytes_written[stage], output_files)
+        return stem_paths
+
+    def deliver(self, stem_path : str, channels : int = 0, file_name : Optional[str] = None) -> str:
+        """
+        Encodes a stem into the output dir once, applying the channel conversion
+        and the silence splice block by block. Stems needing neither are moved as is.
+        Returns the file name relative to the output dir.
+        """
+        file_name = file_name or os.path.basename(stem_path)
+        output_path = os.path.join(self.output_dir, file_name)
+        needs_silence = self.silence_map is not None and bool(self.silence_map.spans)
+        info = sf.info(stem_path)
+        if not needs_silence and (not channels or channels == info.channels):
+            shutil.move(stem_path, output_path)
+        else:
+            with span("convert"):
+                expand_audio(stem_path, self.silence_map if needs_silence else None, output_path, channels=channels,
+                             transform=partial(convert_channels, channels=channels) if channels else None)
+            os.remove(stem_path)
+        self.record("deliver", [output_path])
+        return file_name
+
+    def close(self):
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
@@ -0,0 +1,81 @@
+import os
+import sys
+sys.path.append(os.path.basename(''))
+
+import subprocess
+import threading
+from typing import List, Sequence
+from utils.logger import get_logger
+from utils.exceptions import StreamingEncodeError
+from utils.S3Transfer import S3Transfer, make_transfer_config
+from utils.Timings import span
+
+### Streaming encoder settings
+FFMPEG_BINARY = os.environ.get("FFMPEG_BINARY", "ffmpeg")
+STREAM_PART_SIZE_MB = int(os.environ.get("STREAM_PART_SIZE_MB", 8))
+
+# container args per output format, the encoder writes the result to stdout
+STREAM_ENCODER_ARGS = {
+    "wav": ["-f", "wav"],
+    "mp3": ["-f", "mp3"],
+    "flac": ["-f", "flac"],
+    "opus": ["-c:a", "libopus", "-f", "ogg"],
+}
+
+logger = get_logger("StreamingEncoder")
+
+
+class _CountingReader:
+    """File like view of the encoder stdout counting the bytes handed to the upload"""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.bytes_read = 0
+
+    def read(self, size : int = -1) -> bytes:
+        data = self._stream.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def encoder_command(input_path : str, output_format : str, extra_args : Sequence[str] = ()) -> List[str]:
+    if output_format not in STREAM_ENCODER_ARGS:
+        raise ValueError(f"Unsupported streaming output format: {output_format}")
+    return [FFMPEG_BINARY, "-nostdin", "-v", "error", "-i", input_path,
+            *extra_args, *STREAM_ENCODER_ARGS[output_format], "pipe:1"]
+
+
+def stream_encode_to_s3(transfer : S3Transfer, input_path : str, bucket_name : str, s3_key : str, output_format : str = "mp3",
+                        extra_args : Sequence[str] = (), command : Sequence[str] = None) -> int:
+    """
+    Encodes input_path with ffmpeg and pipes the encoded stream straight into
+    an S3 multipart upload, no encoded file is written locally.
+    Returns the number of bytes uploaded.
+    """
+    # encoding overlaps the upload, the upload is also timed on its own
+    with span(f"encode/{output_format}"):
+        command = list(command or encoder_command(input_path, output_format, extra_args))
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # drain stderr on the side, a full pipe would stall the encoder
+        stderr_chunks = []
+        stderr_thread = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True)
+        stderr_thread.start()
+
+        reader = _CountingReader(process.stdout)
+        # the stream length is unknown, parts are buffered in memory so they stay smaller than file transfers
+        config = make_transfer_config(chunk_mb=STREAM_PART_SIZE_MB, threshold_mb=STREAM_PART_SIZE_MB)
+        try:
+            transfer.upload_fileobj(reader, bucket_name, s3_key, transfer_config=config)
+        except Exception:
+            process.kill()
+            process.wait()
+            raise
+        return_code = process.wait()
+        stderr_thread.join()
+        if return_code != 0:
+            # the upload completed with a truncated stream, do not leave it behind
+            transfer.delete(bucket_name, s3_key)
+            stderr = b"".join(stderr_chunks).decode(errors="replace").strip()
+            raise StreamingEncodeError(f"Encoder exited with {return_code} for {input_path}: {stderr}")
+        logger.debug("Streamed %s bytes of %s to s3://%s/%s", reader.bytes_read, output_format, bucket_name, s3_key)
+        return reader.bytes_read
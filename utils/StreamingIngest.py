@@ -0,0 +1,190 @@
+import os
+import sys
+sys.path.append(os.path.basename(''))
+
+import contextvars
+import struct
+import subprocess
+import threading
+from dataclasses import dataclass
+from typing import Callable, Optional, Tuple
+import numpy as np
+import soundfile as sf
+from utils.logger import get_logger
+from utils.exceptions import AudioIngestError
+from utils.ResultCache import AudioDigest
+from utils.StreamingEncoder import FFMPEG_BINARY
+from utils.InputCache import INPUT_CACHE_DIR, S3InputCache, TeeWriter
+from utils.Timings import span
+
+### Where decoded inputs land. Disk backed, next to the input cache by default, so cached
+### sources are hard linked beside the decoded input instead of copied across filesystems
+INGEST_DIR = os.environ.get("INGEST_DIR", os.path.dirname(os.path.abspath(INPUT_CACHE_DIR)))
+INGEST_READ_BYTES = int(os.environ.get("INGEST_READ_KB", 1024)) * 1024
+# containers ffmpeg can decode from a pipe, mp4/m4a keep their index at the end and need a seekable file
+STREAMABLE_INPUT_FORMATS = tuple(os.environ.get("STREAMABLE_INPUT_FORMATS", "wav,flac,mp3,ogg,aac,webm,aiff").split(","))
+# decoded samples are float32, lossless for every input width
+INGEST_SAMPLE_WIDTH = 4
+
+logger = get_logger("StreamingIngest")
+
+
+@dataclass(frozen=True)
+class IngestedAudio:
+    """Decoded input of a job, the digest covers the decoded samples"""
+
+    path : str
+    digest : str
+    sample_rate : int
+    channels : int
+    frames : int
+
+    @property
+    def duration_seconds(self) -> float:
+        return self.frames / self.sample_rate
+
+
+def _read_exact(stream, size : int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def _read_wav_stream_header(stream) -> Tuple[int, int]:
+    """Consumes the header of a streamed wav up to its sample data, returns (sample_rate, channels)"""
+    header = _read_exact(stream, 12)
+    if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+        raise AudioIngestError("Decoder produced no wav stream")
+    sample_rate = channels = None
+    while True:
+        chunk = _read_exact(stream, 8)
+        if len(chunk) < 8:
+            raise AudioIngestError("Decoder stream ended before the audio data")
+        chunk_id, chunk_size = chunk[:4], struct.unpack("<I", chunk[4:])[0]
+        if chunk_id == b"data":
+            if not sample_rate:
+                raise AudioIngestError("Decoder stream has no fmt chunk")
+            return sample_rate, channels
+        # the data chunk size is unset on a pipe, the other chunks are small
+        body = _read_exact(stream, chunk_size + chunk_size % 2)
+        if chunk_id == b"fmt ":
+            _, channels, sample_rate = struct.unpack("<HHI", body[:8])
+
+
+def decoder_command(input_path : str = "pipe:0") -> list:
+    return [FFMPEG_BINARY, "-nostdin", "-v", "error", "-i", input_path, "-map", "0:a:0",
+            "-c:a", "pcm_f32le", "-f", "wav", "pipe:1"]
+
+
+def _decode(command : list, output_path : str, feeder : Optional[Callable] = None) -> IngestedAudio:
+    """
+    Runs the decoder, hashing the float32 samples and writing them to output_path
+    as they come out. feeder writes the encoded input into the decoder stdin
+    from its own thread, so the download overlaps decoding and hashing.
+    """
+    process = subprocess.Popen(command, stdin=subprocess.PIPE if feeder else subprocess.DEVNULL,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr_chunks = []
+    stderr_thread = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True)
+    stderr_thread.start()
+    feeder_errors = []
+    feeder_thread = None
+    if feeder:
+        def feed():
+            try:
+                feeder(process.stdin)
+            except Exception as e:
+                feeder_errors.append(e)
+            finally:
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+        # the download is timed into the job that started the decode
+        feeder_thread = threading.Thread(target=contextvars.copy_context().run, args=(feed,), daemon=True)
+        feeder_thread.start()
+
+    frames = 0
+    raise_error = None
+    try:
+        sample_rate, channels = _read_wav_stream_header(process.stdout)
+        digest = AudioDigest(sample_rate, channels, INGEST_SAMPLE_WIDTH)
+        frame_bytes = channels * INGEST_SAMPLE_WIDTH
+        block_bytes = max(frame_bytes, INGEST_READ_BYTES - INGEST_READ_BYTES % frame_bytes)
+        with sf.SoundFile(output_path, "w", samplerate=sample_rate, channels=channels, subtype="FLOAT", format="WAV") as output:
+            while True:
+                block = _read_exact(process.stdout, block_bytes)
+                # a truncated last frame means a broken stream, the exit code reports it
+                block = block[:len(block) - len(block) % frame_bytes]
+                if not block:
+                    break
+                digest.update(block)
+                output.write(np.frombuffer(block, dtype="<f4").reshape(-1, channels))
+                frames += len(block) // frame_bytes
+    except Exception as e:
+        process.kill()
+        raise_error = e
+    return_code = process.wait()
+    if feeder_thread is not None:
+        feeder_thread.join()
+    stderr_thread.join()
+    if raise_error is not None or return_code != 0 or feeder_errors or not frames:
+        if os.path.isfile(output_path):
+            os.remove(output_path)
+        stderr = b"".join(stderr_chunks).decode(errors="replace").strip()
+        # a failed download starves the decoder, it is the root cause when both failed
+        cause = feeder_errors[0] if feeder_errors else raise_error
+        raise AudioIngestError(f"Decoding to {output_path} failed with exit code {return_code}: {cause or stderr or 'no audio'}") from cause
+    return IngestedAudio(output_path, digest.hexdigest(), sample_rate, channels, frames)
+
+
+def ingested_path(task_id : str, ingest_dir : str = INGEST_DIR) -> str:
+    os.makedirs(ingest_dir, exist_ok=True)
+    return os.path.join(ingest_dir, f"{task_id}_input.wav")
+
+
+def ingest_local_audio(input_path : str, output_path : str) -> IngestedAudio:
+    """Decodes a local file into a float32 wav, hashing the samples on the way"""
+    with span("decode"):
+        return _decode(decoder_command(input_path), output_path)
+
+
+def ingest_s3_audio(transfer, bucket_name : str, s3_key : str, output_path : str, input_cache : Optional[S3InputCache] = None) -> IngestedAudio:
+    """
+    Streams an S3 object through the decoder into a float32 wav at output_path.
+    Download, decode and hashing overlap and the encoded object never touches
+    the disk. Containers that cannot be decoded from a pipe are downloaded next
+    to output_path first. With an input cache, cached objects are decoded from
+    disk and streamed ones are written to the cache on the way.
+    """
+    file_ext = os.path.splitext(s3_key)[1].lstrip(".").lower()
+    # downloads and links to cached objects, a link outlives the eviction of its entry
+    source_path = f"{os.path.splitext(output_path)[0]}_source.{file_ext}"
+    try:
+        if input_cache is not None:
+            cached_path, etag = input_cache.lookup(bucket_name, s3_key, source_path)
+            if cached_path is not None:
+                return ingest_local_audio(cached_path, output_path)
+            if file_ext not in STREAMABLE_INPUT_FORMATS:
+                return ingest_local_audio(input_cache.fetch(bucket_name, s3_key, source_path), output_path)
+            with input_cache.download_lock(bucket_name, s3_key, etag, source_path) as cached_path:
+                if cached_path is not None:
+                    return ingest_local_audio(cached_path, output_path)
+                logger.debug("Streaming s3://%s/%s into %s and the input cache", bucket_name, s3_key, output_path)
+                with input_cache.writer(bucket_name, s3_key, etag) as cache_file:
+                    with span("decode"):
+                        return _decode(decoder_command(), output_path, lambda stdin: transfer.download_fileobj(
+                            bucket_name, s3_key, TeeWriter(stdin, cache_file)))
+        if file_ext in STREAMABLE_INPUT_FORMATS:
+            logger.debug("Streaming s3://%s/%s into %s", bucket_name, s3_key, output_path)
+            with span("decode"):
+                return _decode(decoder_command(), output_path, lambda stdin: transfer.download_fileobj(bucket_name, s3_key, stdin))
+        transfer.download_file(bucket_name, s3_key, source_path)
+        return ingest_local_audio(source_path, output_path)
+    finally:
+        if os.path.isfile(source_path):
+            os.remove(source_path)
@@ -0,0 +1,91 @@
+import os
+import sys
+sys.path.append(os.path.basename(''))
+
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+from utils.logger import log_context
+
+_current_timings : contextvars.ContextVar = contextvars.ContextVar("job_timings", default=None)
+
+
+class JobTimings:
+    """
+    Wall seconds per stage of one job. Spans of the same name add up, spans
+    from threads running side by side (uploads, the streamed download) are
+    all counted, so stages can sum to more than the job's total.
+    """
+
+    def __init__(self, task_id : str):
+        self.task_id = task_id
+        self.started_at = time.perf_counter()
+        self._lock = threading.Lock()
+        self._stages : Dict[str, Dict[str, float]] = {}
+
+    def add(self, name : str, seconds : float):
+        with self._lock:
+            stage = self._stages.setdefault(name, {"seconds": 0.0, "count": 0})
+            stage["seconds"] += seconds
+            stage["count"] += 1
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            stages = {name: {"seconds": round(stage["seconds"], 4), "count": stage["count"]} for name, stage in self._stages.items()}
+        return {"total_seconds": round(time.perf_counter() - self.started_at, 4), "stages": stages}
+
+    def log(self, logger, **fields):
+        """One structured record per job, for finding slow stages in production logs"""
+        logger.info("job_timings", extra={"fields": {"event": "job_timings", "task_id": self.task_id, **fields, **self.as_dict()}})
+
+
+def current_timings() -> Optional[JobTimings]:
+    """Timings of the job running in this context, None outside a job"""
+    return _current_timings.get()
+
+
+@contextmanager
+def job_timings(task_id : str):
+    """
+    Makes a new JobTimings the current one for the block and tags its log
+    records with the task_id. Work handed to other threads keeps both when it
+    is submitted with contextvars.copy_context().run.
+    """
+    timings = JobTimings(task_id)
+    token = _current_timings.set(timings)
+    try:
+        with log_context(task_id=task_id):
+            yield timings
+    finally:
+        _current_timings.reset(token)
+
+
+@contextmanager
+def span(name : str):
+    """Times the block into the current job, a no-op outside a job"""
+    timings = _current_timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+
+def attach_timings(out_obj : dict) -> dict:
+    """Adds the timings of the current job so far to a job result"""
+    timings = _current_timings.get()
+    if timings is not None:
+        out_obj["timings"] = timings.as_dict()
+    return out_obj
+
+
+def record(name : str, seconds : float):
+    """Adds an already measured duration to the current job"""
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.add(name, seconds)
@@ -1,25 +1,24 @@
 import os
 
-import boto3
 import botocore
 from .logger import get_logger
+from .S3Transfer import S3Transfer, get_s3_transfer
 
 from .exceptions import AWSAccessKeyNotExistsException, AWSSecretKeyNotExistsException
 
 
 class S3Helper:
+    """Facade over the process wide S3Transfer, keeps the key first argument order of this module"""
+
     def __init__(self, AWS_ACCESS_KEY : str, AWS_SECRET_KEY : str, region_name : str) -> None:
-        self.s3 = boto3.client("s3", 
-                            aws_access_key_id = AWS_ACCESS_KEY, 
-                            aws_secret_access_key = AWS_SECRET_KEY,
-                            region_name = region_name
-                            )
+        self.transfer : S3Transfer = get_s3_transfer(AWS_ACCESS_KEY, AWS_SECRET_KEY, region_name)
+        self.s3 = self.transfer.client
 
         self.logger = get_logger("S3Helper")
     
     def get_file(self, file_path, bucket_name : str = 'lalals'):
         try:
-            s3_obj =  self.s3.get_object(Bucket = bucket_name, Key = file_path)
+            s3_obj = self.transfer.get_object(bucket_name, file_path)
             return s3_obj
         except Exception as e:
             self.logger.exception(e)
@@ -27,14 +26,14 @@ class S3Helper:
     
     def download_file(self, file_path_s3 : str, file_path_local : str, bucket_name : str = "lalals"):
         try:
-            self.s3.download_file(bucket_name, file_path_s3, file_path_local)
+            self.transfer.download_file(bucket_name, file_path_s3, file_path_local)
         except Exception as e:
             self.logger.exception(e)
             raise e
     
     def upload_file(self, file_path_local : str, file_path_s3 : str, bucket_name : str = "lalals"):
         try:
-            self.s3.upload_file(file_path_local, bucket_name, file_path_s3)
+            self.transfer.upload_file(file_path_local, bucket_name, file_path_s3)
             return file_path_s3
         except Exception as e:
             self.logger.exception(e)
@@ -42,7 +41,7 @@ class S3Helper:
     
     def delete_file(self, s3_path : str, bucket_name : str = "lalals"):
         try:
-            self.s3.delete_object(Bucket = bucket_name, Key = s3_path)
+            self.transfer.delete(bucket_name, s3_path)
             return True
         except Exception as e:
             self.logger.error(e)
@@ -52,7 +51,7 @@ class S3Helper:
         try:
             filename = file_path.split('/')[-1]
             s3_key = f"files/{filename}"
-            self.s3.upload_file(file_path, bucket_name, s3_key)
+            self.transfer.upload_file(file_path, bucket_name, s3_key)
             return s3_key
         except Exception as e:
             self.logger.error(e)
@@ -61,15 +60,10 @@ class S3Helper:
     
     def validate_file_exists(self, file_key, bucket_name):
         try:
-            self.s3.head_object(Bucket=bucket_name, Key=file_key)
-            return True  # File exists
+            return self.transfer.exists(bucket_name, file_key)
         except botocore.exceptions.ClientError as e:
             self.logger.error(e)
-            if e.response['Error']['Code'] == '404':
-                return False  # File does not exist
-            else:
-                self.logger.error(e)
-                return False  # Other error occurred
+            return False  # Other error occurred, missing keys already return False
     
     def validate_folder_exists(self, folder_path, bucket_name):
         """
@@ -80,11 +74,7 @@ class S3Helper:
         :return: True if the folder path exists, False otherwise
         """
         try:
-            response = self.s3.list_objects_v2(Bucket=bucket_name, Prefix=folder_path, MaxKeys=1)
-            if 'Contents' in response:
-                return True  # Folder path exists (at least one object with this prefix)
-            else:
-                return False  # Folder path does not exist (no objects with this prefix)
+            return self.transfer.prefix_exists(bucket_name, folder_path)
         except botocore.exceptions.ClientError as e:
             self.logger.error(e)
             return False    
@@ -17,3 +17,24 @@ class OutputNameConfigNotFoundException(Exception):
     def __init__(self, message:str = ''):
         super().__init__(message)
         self.message = message
+
+class AudioProbeError(Exception):
+    def __init__(self, message:str = ''):
+        super().__init__(message)
+        self.message = message
+
+class OutputUploadError(Exception):
+    def __init__(self, message:str = '', errors:list = None):
+        super().__init__(message)
+        self.message = message
+        self.errors = errors or []
+
+class StreamingEncodeError(Exception):
+    def __init__(self, message:str = ''):
+        super().__init__(message)
+        self.message = message
+
+class AudioIngestError(Exception):
+    def __init__(self, message:str = ''):
+        super().__init__(message)
+        self.message = message
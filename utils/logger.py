@@ -1,30 +1,174 @@
+import atexit
+import contextvars
+import copy
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+### Level of every logger and per logger overrides, e.g. LOG_LEVELS="AudioPipeline=INFO,OutputStage=WARNING".
+### An override of "PipelinedExecutor" also covers "PipelinedExecutor.AudioUtilities"
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "DEBUG")
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+### "text" writes the plain format, "json" one object per line for log shippers
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").lower()
+# records are written by a background thread, so logging I/O stays off the request threads
+LOG_ASYNC = os.environ.get("LOG_ASYNC", "true").lower() in ("1", "true", "yes")
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 
 logger_cache = {}
+_cache_lock = threading.Lock()
+_log_context : contextvars.ContextVar = contextvars.ContextVar("log_context", default={})
+_handler = None
+_listener = None
+
+
+def _parse_levels(spec : str) -> dict:
+    levels = {}
+    for item in spec.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip()
+    return levels
+
+
+_logger_levels = _parse_levels(LOG_LEVELS)
+
+
+def _level_for(logger_name : str, default : str) -> int:
+    """Most specific LOG_LEVELS entry for the logger, else the given level"""
+    name = logger_name
+    while name:
+        if name in _logger_levels:
+            return getattr(logging, _logger_levels[name].upper(), logging.DEBUG)
+        name = name.rpartition(".")[0]
+    return getattr(logging, default.upper(), logging.DEBUG)
+
+
+@contextmanager
+def log_context(**fields):
+    """Adds the fields, e.g. task_id, to every record logged in the block and in work it hands off"""
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """Copies the log context of the logging thread onto the record"""
+
+    def filter(self, record):
+        context = _log_context.get()
+        if context:
+            record.context = context
+        return True
 
-def get_logger(logger_name, level="DEBUG"):
-    global logger_cache
 
-    if logger_name in logger_cache:
-        return logger_cache[logger_name]
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record. The log context and structured fields passed
+    as extra={"fields": {...}} become top level keys.
+    """
 
-    logger = logging.getLogger(logger_name)
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        entry.update(getattr(record, "context", {}))
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """The plain format with the log context and structured fields appended"""
+
+    def format(self, record):
+        text = super().format(record)
+        extra = {**getattr(record, "context", {}), **getattr(record, "fields", {})}
+        if extra:
+            text = f"{text} {json.dumps(extra, default=str)}"
+        return text
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on the listener's queue. Only the message is merged here,
+    args may be mutated once the call returns, the formatting happens on
+    the listener thread.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # tracebacks hold frames of the logging thread, render them while they are valid
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _make_formatter() -> logging.Formatter:
+    return JsonFormatter() if LOG_FORMAT == "json" else TextFormatter(TEXT_FORMAT)
+
+
+def _shared_handler() -> logging.Handler:
+    """One handler for every logger, behind a queue and a listener thread when LOG_ASYNC is set"""
+    global _handler, _listener
+    if _handler is not None:
+        return _handler
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(_make_formatter())
+    if LOG_ASYNC:
+        log_queue = queue.SimpleQueue()
+        _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        _listener.start()
+        # flush what is queued when the worker exits
+        atexit.register(_listener.stop)
+        handler = _QueueHandler(log_queue)
+    else:
+        handler = stream_handler
+    handler.addFilter(ContextFilter())
+    _handler = handler
+    return _handler
+
+
+def get_logger(logger_name, level=None):
+    """
+    Logger writing through the shared handler. LOG_LEVELS overrides the level
+    per logger, then the level argument, then LOG_LEVEL. Pass arguments the
+    lazy way, logger.debug("Got %s", value), so disabled levels skip formatting.
+    """
+    global logger_cache
 
-    # Clear existing handlers to prevent duplicate logs
-    if logger.hasHandlers():
-        logger.handlers.clear()
+    with _cache_lock:
+        if logger_name in logger_cache:
+            return logger_cache[logger_name]
 
-    level = getattr(logging, level.upper(), logging.DEBUG)
-    logger.setLevel(level)
+        logger = logging.getLogger(logger_name)
 
-    ch = logging.StreamHandler()
-    ch.setLevel(level)
+        # Clear existing handlers to prevent duplicate logs
+        if logger.hasHandlers():
+            logger.handlers.clear()
 
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
+        logger.setLevel(_level_for(logger_name, level or LOG_LEVEL))
+        logger.addHandler(_shared_handler())
 
-    logger_cache[logger_name] = logger
+        logger_cache[logger_name] = logger
 
     return logger
 
@@ -33,7 +177,8 @@ if __name__ == "__main__":
     logger2 = get_logger("BeamUtils", level="INFO")
 
     logger1.debug("Voice path exists, checking files...")
-    logger2.info("This is an info message")
+    with log_context(task_id="example"):
+        logger2.info("This is an info message for %s", "a task")
     logger1.warning("This is a warning message")
-    logger2.error("This is an error message")
-    logger1.critical("This is a critical message")
\ No newline at end of file
+    logger2.error("This is an error message", extra={"fields": {"stage": "example"}})
+    logger1.critical("This is a critical message")
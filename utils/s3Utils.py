@@ -1,17 +1,17 @@
 
-import boto3
 import os
 from .dirUtils import unzip_file
 from .logger import get_logger
+from .S3Transfer import S3Transfer, get_s3_transfer
 from pydantic import GetCoreSchemaHandler
 from pydantic_core import core_schema
 
 class S3Helper:
+    """Facade over the process wide S3Transfer, cheap to build per job"""
+
     def __init__(self, aws_access_key : str, aws_secret_key : str, aws_region : str) -> None:
-        self.s3 = boto3.client("s3", 
-                               aws_access_key_id = aws_access_key,
-                               aws_secret_access_key = aws_secret_key,
-                               region_name = aws_region)
+        self.transfer : S3Transfer = get_s3_transfer(aws_access_key, aws_secret_key, aws_region)
+        self.s3 = self.transfer.client
         self.logger = get_logger("S3Helper")
 
     @classmethod
@@ -22,7 +22,7 @@ class S3Helper:
         
     def download_zip_file(self, bucket_name : str, s3_key : str, local_file_path : str, extract_folder : str):
         try:
-            self.s3.download_file(bucket_name, s3_key, local_file_path)
+            self.transfer.download_file(bucket_name, s3_key, local_file_path)
             if not os.path.exists(local_file_path):
                 raise FileNotFoundError("Error during file download")
             unzip_file(local_file_path, extract_folder)
@@ -33,14 +33,14 @@ class S3Helper:
         
     def download_file(self, bucket_name : str, s3_key : str, local_file_path : str):
         try:
-            self.s3.download_file(bucket_name, s3_key, local_file_path)
+            self.transfer.download_file(bucket_name, s3_key, local_file_path)
         except Exception as e:
             self.logger.error(e)
             raise e 
 
     def upload_file(self, filename, key, bucket_name):
         try:
-            self.s3.upload_file(filename, bucket_name, key)
+            self.transfer.upload_file(filename, bucket_name, key)
         except Exception as e:
             self.logger.error(e)
             raise e 
@@ -49,8 +49,33 @@ class S3Helper:
         try:
             filename = file_path.split('/')[-1]
             s3_key = f"files/{filename}"
-            self.s3.upload_file(file_path, bucket_name, s3_key)
+            self.transfer.upload_file(file_path, bucket_name, s3_key)
             return s3_key
         except Exception as e:
             self.logger.error(e)
             return ''
+
+    def copy_file(self, source_key : str, dest_key : str, bucket_name : str):
+        """Server side copy of an object inside the bucket"""
+        try:
+            self.transfer.copy(source_key, dest_key, bucket_name)
+            return dest_key
+        except Exception as e:
+            self.logger.error(e)
+            raise e
+
+    def upload_json(self, data : dict, key : str, bucket_name : str):
+        try:
+            self.transfer.put_json(data, bucket_name, key)
+            return key
+        except Exception as e:
+            self.logger.error(e)
+            raise e
+
+    def download_json(self, key : str, bucket_name : str):
+        """Returns the parsed json object, or None if the key does not exist"""
+        try:
+            return self.transfer.get_json(bucket_name, key)
+        except Exception as e:
+            self.logger.error(e)
+            raise e